@@ -0,0 +1,124 @@
+"""
+Inference Batcher
+
+Collects pending (context, question) requests of many users for a short
+window and runs them through DMN_PLUS.predict in a single session.run,
+then scatters pred/prob_top_k back to every waiting caller.
+"""
+import threading
+import time
+
+import numpy as np
+
+from queue import Queue, Empty
+
+
+class _Pending:
+    __slots__ = ('inputs', 'input_len', 'question', 'q_len', 'event', 'pred', 'prob', 'error')
+
+    def __init__(self, inputs, input_len, question, q_len):
+        self.inputs = inputs
+        self.input_len = input_len
+        self.question = question
+        self.q_len = q_len
+        self.event = threading.Event()
+        self.pred = None
+        self.prob = None
+        self.error = None
+
+
+class InferenceBatcher:
+
+    def __init__(self, model, session, max_sen_len, pad_region, max_batch_size=32, max_wait_ms=5):
+        """
+        :param model: DMN_PLUS
+        :param session: tf session the model was restored into
+        :param pad_region: (max_input_len, max_sen_len, embed_size) rows the contexts are padded with
+        :param max_batch_size: flush as soon as this many requests are pending
+        :param max_wait_ms: flush at the latest this long after the first request arrived
+        """
+        self.model = model
+        self.session = session
+        self.max_sen_len = max_sen_len
+        self.pad_region = pad_region
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = Queue()
+
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.fill_hist = [0] * (max_batch_size + 1)  # batch size -> number of batches
+
+        self.worker = threading.Thread(target=self._loop, name='dmn-batcher')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def predict(self, inputs, input_len, question, q_len):
+        """
+        blocking, same result layout as DMN_PLUS.predict for a batch of one
+        :param inputs: (input_len, max_sen_len, embed_size) context, padded here;
+                       only read before predict returns, so a view of the session buffer is fine
+        :param input_len: number of real context sentences
+        :param question: (max_sen_len, embed_size)
+        :param q_len: question length
+        :return: pred, (top_k values, top_k indices)
+        """
+        pending = _Pending(inputs, input_len, question, q_len)
+        self.queue.put(pending)
+        pending.event.wait()
+        if pending.error:
+            raise pending.error
+        return pending.pred, pending.prob
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                inputs = np.empty((len(batch),) + self.pad_region.shape, dtype=np.float32)
+                for i, p in enumerate(batch):
+                    inputs[i, :p.input_len] = p.inputs[:p.input_len]
+                    inputs[i, p.input_len:] = self.pad_region[p.input_len:]
+                questions = np.stack([np.asarray(p.question, dtype=np.float32) for p in batch])
+                pred, prob_top = self.model.predict(self.session,
+                                                    inputs, [p.input_len for p in batch],
+                                                    self.max_sen_len, questions,
+                                                    [p.q_len for p in batch])
+                values, indices = prob_top
+                for i, p in enumerate(batch):
+                    p.pred = pred[i:i + 1]
+                    p.prob = (values[i:i + 1], indices[i:i + 1])
+            except Exception as e:
+                for p in batch:
+                    p.error = e
+            finally:
+                for p in batch:
+                    p.event.set()
+            with self._stats_lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.fill_hist[len(batch)] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            mean = float(self.requests) / self.batches if self.batches else 0.0
+            return {"batches": self.batches, "requests": self.requests,
+                    "mean_batch_size": mean,
+                    "mean_fill": mean / self.max_batch_size,
+                    "pending": self.queue.qsize(),
+                    "max_batch_size": self.max_batch_size,
+                    "max_wait_ms": self.max_wait_ms,
+                    "batch_size_hist": {str(size): count for size, count in enumerate(self.fill_hist) if count}}
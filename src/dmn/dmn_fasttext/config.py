@@ -48,6 +48,17 @@ class Config(object):
 
     train_mode = True
 
+    # cross user inference batching, see batcher.py
+    batch_infer = True
+    max_infer_batch_size = 32
+    max_infer_wait_ms = 5
+
+    # utterance -> embedded block lru, see embedding_cache.py
+    embedding_cache_size = 4096
+
+    # processes tokenizing the dialogs in preprocessing, 1 to stay in process
+    tokenize_workers = os.cpu_count() or 1
+
     vocab_size = 7464
 
     split_sentences = True
@@ -19,7 +19,7 @@ grandfatherdir = os.path.dirname(os.path.dirname(
 
 sys.path.insert(0, grandfatherdir)
 sys.path.append(grandfatherdir)
-from utils.query_util import tokenize
+from utils.query_util import tokenize, tokenize_many
 from utils.translator import Translator
 from dmn.dmn_fasttext.config import Config
 from gensim.models.wrappers import FastText
@@ -83,11 +83,9 @@ def parse_dialogs_per_response(sentences, lines, candid_dic, char=1):
     '''
         Parse dialogs provided in the babi tasks format
     '''
-    data = []
-    context = []
-    u = None
-    r = None
-    # print(candid_dic)
+    # (answer, u, r, salt, placeholder) of every turn, None where a dialog ends,
+    # so that all the texts are tokenized in one batch
+    turns = []
     for line in lines:
         line = line.strip()
         if line:
@@ -105,31 +103,42 @@ def parse_dialogs_per_response(sentences, lines, candid_dic, char=1):
                         print('warning candidate is not listed..', r)
                         continue
                     a = candid_dic[r]
-                u = tokenize(u, char=char)
                 if config.fix_vocab:
                     r = translator.en2cn(r)
-                r = tokenize(r, char=char)
                 placeholder = salt == 'placeholder'
                 if config.fix_vocab:
                     salt = translator.en2cn(salt)
-                salt = tokenize(salt, char=char)
-
-                sentences.add(','.join(u))
-                sentences.add(','.join(r))
-                sentences.add(','.join(salt))
-
-                # print(u)
-                # temporal encoding, and utterance/response encoding
-                # data.append((context[:],u[:],candid_dic[' '.join(r)]))
-                data.append((context[:], u[:], a))
-                context.append(u)
-                # r = r if placeholder == 'placeholder' else r + salt
-                context.append(r)
-                if not placeholder:
-                    context.append(salt)
+                turns.append((a, u, r, salt, placeholder))
         else:
+            turns.append(None)
+
+    texts = (text for turn in turns if turn for text in turn[1:4])
+    tokens = tokenize_many(texts, char=char, workers=config.tokenize_workers)
+    data = []
+    context = []
+    for turn in turns:
+        if turn is None:
             # clear context
             context = []
+            continue
+        a, _, _, _, placeholder = turn
+        u = next(tokens)
+        r = next(tokens)
+        salt = next(tokens)
+
+        sentences.add(','.join(u))
+        sentences.add(','.join(r))
+        sentences.add(','.join(salt))
+
+        # print(u)
+        # temporal encoding, and utterance/response encoding
+        # data.append((context[:],u[:],candid_dic[' '.join(r)]))
+        data.append((context[:], u[:], a))
+        context.append(u)
+        # r = r if placeholder == 'placeholder' else r + salt
+        context.append(r)
+        if not placeholder:
+            context.append(salt)
     # print(data)
     sentences.add(config.EMPTY)
     return data
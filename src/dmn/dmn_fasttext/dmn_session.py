@@ -21,16 +21,35 @@ sys.path.insert(0, grandfatherdir)
 
 from utils.query_util import tokenize
 from utils.translator import Translator
+from utils.log_util import debug
 
 from dmn.dmn_fasttext.config import Config
-from dmn.dmn_fasttext.vector_helper import getVector
+from dmn.dmn_fasttext.vector_helper import getVectors
 from dmn.dmn_fasttext.dmn_plus import DMN_PLUS
+from dmn.dmn_fasttext.batcher import InferenceBatcher
+from dmn.dmn_fasttext.embedding_cache import EmbeddingCache
 
 translator = Translator()
 
 
+class SessionBlocks:
+    """
+    constant EMPTY/PAD context blocks shared by all sessions of a model,
+    pad_region is the (max_input_len, max_sen_len, embed_size) tail the
+    context is padded with before predict
+    """
+
+    def __init__(self, config, max_sen_len, max_input_len):
+        self.empty, self.pad = getVectors([[config.EMPTY] * max_sen_len,
+                                           [config.PAD] * max_sen_len], max_sen_len)
+        self.pad_region = np.repeat(self.pad[np.newaxis], max_input_len, axis=0)
+        self.empty.flags.writeable = False
+        self.pad.flags.writeable = False
+        self.pad_region.flags.writeable = False
+
+
 class DmnSession():
-    def __init__(self, session, model, config, metadata, char=2):
+    def __init__(self, session, model, config, metadata, char=2, blocks=None, batcher=None, cache=None):
         self.u = None
         self.r = None
         self.session = session
@@ -40,64 +59,84 @@ class DmnSession():
         self.w2idx = metadata['w2idx']
         self.max_sen_len = metadata['max_sen_len']
         self.max_input_len = metadata['max_input_len']
-        # self.context = [[data_helper.ff_embedding_local(self.config.EMPTY) for _ in range(self.max_sen_len)]]
-        self.context = [[getVector(self.config.EMPTY)
-                         for _ in range(self.max_sen_len)]]
-        self.context_raw = [[self.config.EMPTY]]
         self.char = char
+        self.batcher = batcher
+        self.cache = cache if cache else EmbeddingCache(self.max_sen_len, tokenize, translator.en2cn, size=64)
+        # constant EMPTY/PAD blocks are read only and shared by all sessions
+        self.blocks = blocks if blocks else SessionBlocks(config, self.max_sen_len, self.max_input_len)
+        # preallocated context, the first length rows are the last sentences
+        # oldest first; context_raw holds their tokens in lockstep
+        self.max_memory_size = min(config.max_memory_size, self.max_input_len)
+        self.memory = np.empty((self.max_memory_size, self.max_sen_len, config.embed_size),
+                               dtype=np.float32)
+        self.length = 0
+        self.clear_memory()
+
+    @property
+    def context(self):
+        # view, valid until the next append/clear
+        return self.memory[:self.length]
+
+    def inputs(self):
+        """
+        (max_input_len, max_sen_len, embed_size) model input, context + pad region
+        """
+        return np.concatenate([self.context, self.blocks.pad_region[self.length:]])
+
+    def _embed(self, tokens):
+        # (max_sen_len, embed_size), padded with PAD, one gather with an embedding export
+        return getVectors([tokens], self.max_sen_len)[0]
+
+    def _append(self, tokens, block):
+        if self.length == self.max_memory_size:
+            # drop the oldest, at most max_memory_size - 1 blocks move
+            self.memory[:-1] = self.memory[1:]
+            self.length -= 1
+            self.context_raw = self.context_raw[1:]
+        self.memory[self.length] = block
+        self.length += 1
+        self.context_raw.append(tokens[:self.max_sen_len])
 
     def append_memory(self, m):
         if not m:
             return
-        m = translator.en2cn(m)
-        m = tokenize(m, self.char)
-        print('appending memory..', m)
-        q_vector = m + \
-                   [self.config.PAD for _ in range(
-                       self.max_sen_len - len(m))]
-        q_vector = [getVector(word) for word in q_vector]
-        self.context.append(q_vector)
-        self.context = self.context[-self.config.max_memory_size:]
+        m, _, block = self.cache.get(m, self.char, translate=True)
+        debug('appending memory..', m)
+        self._append(m, block)
 
     def clear_memory(self, history=0):
         if history == 0:
             # self.context = [[data_helper.ff_embedding_local(self.config.EMPTY) for _ in range(self.max_sen_len)]]
-            self.context = [[getVector(self.config.EMPTY)
-                             for _ in range(self.max_sen_len)]]
+            self.memory[0] = self.blocks.empty
+            self.length = 1
+            self.context_raw = [[self.config.EMPTY]]
             # self.context = [[]]
-        else:
-            self.context = self.context[-history:]
+        elif history < self.length:
+            self.memory[:history] = self.memory[self.length - history:self.length]
+            self.length = history
+            self.context_raw = self.context_raw[-history:]
+
+    def dump_context(self):
+        return [list(tokens) for tokens in self.context_raw]
+
+    def load_context(self, context_raw):
+        """
+        rebuild the context from raw tokens, see dump_context
+        """
+        self.length = 0
+        self.context_raw = []
+        for tokens in context_raw[-self.max_memory_size:]:
+            tokens = list(tokens)
+            self._append(tokens, self.blocks.empty if tokens == [self.config.EMPTY] else self._embed(tokens))
 
     def reply(self, msg):
         line = msg.strip().lower()
         if line == 'clear':
-            # self.context = [[data_helper.ff_embedding_local(self.config.EMPTY) for _ in range(self.max_sen_len)]]
-            self.context = [[getVector(self.config.EMPTY)
-                             for _ in range(self.max_sen_len)]]
+            self.clear_memory()
             reply_msg = ['memory cleared!']
             top_prob = [0]
         else:
-            inputs = []
-            questions = []
-
-            q = tokenize(line, self.char)
-            q_len=len(q)
-            q = q[:self.max_sen_len]
-            self.context_raw.append(q)
-            q_vector = q + \
-                       [self.config.PAD for _ in range(
-                               self.max_sen_len - len(q))]
-            q_vector = [getVector(word) for word in q_vector]
-
-            inp_vector = self.context
-            pad_vector = [getVector(self.config.PAD)
-                          for _ in range(self.max_sen_len)]
-            inp_vector = inp_vector + \
-                         [pad_vector for _ in range(
-                                 self.max_input_len - len(inp_vector))]
-
-            inputs.append(inp_vector)
-            questions.append(q_vector)
+            q, q_len, q_vector = self.cache.get(line, self.char)
 
             # with tf.Session() as session:
             #     session.run(tf.global_variables_initializer())
@@ -112,27 +151,22 @@ class DmnSession():
             #     output = session.run(top_predict_proba, feed_dict={
             #         qp: questions, ql: [self.max_sen_len], ip: inputs, il: [len(self.context)], dp: self.config.dropout})
 
-            pred, top_prob = self.model.predict(self.session,
-                                                inputs, [len(self.context)], self.max_sen_len, questions,
-                                                [q_len])
+            if self.batcher:
+                # the batcher pads the context view while filling its batch array
+                pred, top_prob = self.batcher.predict(self.context, self.length, q_vector, q_len)
+            else:
+                pred, top_prob = self.model.predict(self.session,
+                                                    self.inputs()[np.newaxis], [self.length], self.max_sen_len,
+                                                    q_vector[np.newaxis], [q_len])
 
             # print('pred:', pred, top_prob)
             # indices = output.indices.tolist()[0]
             # values = output.values.tolist()[0]
 
             reply_msg = [self.idx2candid[ind] for ind in pred]
-            r = reply_msg[0]
-            r = translator.en2cn(r)
-            r = tokenize(r, self.char)
-            r = r[:self.max_sen_len]
-            self.context_raw.append(r)
-            r_vector = r + \
-                       [self.config.PAD for _ in range(self.max_sen_len - len(r))]
-            r_vector = [getVector(word) for word in r_vector]
-            self.context.append(q_vector)
-            self.context.append(r_vector)
-            if len(self.context) > self.config.max_memory_size:
-                self.context = self.context[-self.config.max_memory_size:]
+            r, _, r_vector = self.cache.get(reply_msg[0], self.char, translate=True)
+            self._append(q, q_vector)
+            self._append(r, r_vector)
 
         return reply_msg[0], top_prob[0]
 
@@ -140,9 +174,21 @@ class DmnSession():
 class DmnInfer:
     def __init__(self):
         self.config = Config()
+        self.char = 2 if self.config.word else 1
         with open(self.config.metadata_path, 'rb') as f:
             self.metadata = pickle.load(f)
         self.model = self._load_model()
+        self.blocks = SessionBlocks(self.config, self.metadata['max_sen_len'], self.metadata['max_input_len'])
+        # the replies are a closed set, embed them once
+        self.cache = EmbeddingCache(self.metadata['max_sen_len'], tokenize, translator.en2cn,
+                                    size=self.config.embedding_cache_size)
+        self.cache.warm(self.metadata['idx2candid'].values(), self.char)
+        self.batcher = None
+        if self.config.batch_infer:
+            self.batcher = InferenceBatcher(self.model, self.session, self.metadata['max_sen_len'],
+                                            self.blocks.pad_region,
+                                            max_batch_size=self.config.max_infer_batch_size,
+                                            max_wait_ms=self.config.max_infer_wait_ms)
 
     def _load_model(self):
         self.session = tf.Session()
@@ -179,9 +225,8 @@ class DmnInfer:
         # #     self.config.ckpt_path + 'dmn.weights.meta')
         # # graph = tf.get_default_graph()
 
-        char = 2 if self.config.word else 1
         isess = DmnSession(self.session, self.model,
-                           self.config, self.metadata, char)
+                           self.config, self.metadata, self.char, self.blocks, self.batcher, self.cache)
         return isess
 
 
@@ -0,0 +1,95 @@
+"""
+Embedding Cache
+
+LRU of ready (max_sen_len, embed_size) float32 blocks keyed by
+(text, char mode, translated). User utterances repeat a lot and the replies
+appended as memory come from the closed set idx2candid, which is embedded
+once at load (warm) and never evicted.
+
+Cached blocks and token lists are shared by all sessions, treat them as read only.
+"""
+import threading
+
+from collections import OrderedDict
+
+from dmn.dmn_fasttext.vector_helper import getVectors
+
+CACHE_SIZE = 4096  # about 12KB per entry with max_sen_len 10 and 300 dims
+
+
+class EmbeddingCache:
+
+    def __init__(self, max_sen_len, tokenize, translate, size=CACHE_SIZE):
+        """
+        :param tokenize: callable(text, char) -> tokens
+        :param translate: callable(text) -> text, applied to model replies (en2cn)
+        """
+        self.max_sen_len = max_sen_len
+        self.tokenize = tokenize
+        self.translate = translate
+        self.size = size
+        self.pinned = dict()
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _tokens(self, text, char, translate):
+        if translate:
+            text = self.translate(text)
+        tokens = self.tokenize(text, char)
+        return tokens[:self.max_sen_len], len(tokens)
+
+    def get(self, text, char, translate=False):
+        """
+        :return: (tokens cut at max_sen_len, length before the cut, block)
+        """
+        key = (text, char, translate)
+        entry = self.pinned.get(key)
+        if entry is not None:
+            with self.lock:
+                self.hits += 1
+            return entry
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        tokens, length = self._tokens(text, char, translate)
+        block = getVectors([tokens], self.max_sen_len)[0]
+        block.flags.writeable = False
+        entry = (tokens, length, block)
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def warm(self, texts, char, translate=True):
+        """
+        embeds a closed set of texts in one batch and pins them
+        """
+        keys = []
+        tokens_list = []
+        for text in set(texts):
+            tokens, length = self._tokens(text, char, translate)
+            keys.append(((text, char, translate), length))
+            tokens_list.append(tokens)
+        if not keys:
+            return
+        blocks = getVectors(tokens_list, self.max_sen_len)
+        blocks.flags.writeable = False
+        for (key, length), tokens, block in zip(keys, tokens_list, blocks):
+            self.pinned[key] = (tokens, length, block)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries), "max_size": self.size, "pinned": len(self.pinned),
+                "hits": self.hits, "misses": self.misses,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0}
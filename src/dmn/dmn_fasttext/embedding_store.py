@@ -0,0 +1,198 @@
+"""
+Embedding Store
+
+Read only export of the word2vec model used by vector_helper:
+    <prefix>.vocab  one word per line, the word of line i is row i + 1
+    <prefix>.npy    float32 matrix (vocab + 1, dim), row 0 is the zero PAD row
+
+The matrix is opened with mmap_mode='r' so every process serving the model
+shares the same pages, and a batch of token lists is turned into a
+(n, max_len, dim) array with a single gather. Words missing from the vocab
+get the same vector getVector gives them, the mean of their char vectors
+(unknown chars count as zeros), computed once and kept aside.
+
+    python dmn/dmn_fasttext/embedding_store.py --model /opt/word2vec/benebot_vector/word2vec.bin \
+        --out /opt/word2vec/benebot_vector/word2vec_export
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+parentdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(parentdir)
+
+PAD_ID = 0
+OOV_ID = -1
+MAX_OOV = 100000  # cached oov vectors, dropped all at once when exceeded
+
+
+class EmbeddingStore:
+
+    def __init__(self, prefix, pad='PAD'):
+        self.prefix = prefix
+        self.pad = pad
+        self.matrix = np.load(prefix + '.npy', mmap_mode='r')
+        self.dim = self.matrix.shape[1]
+        self.vocab = dict()
+        with open(prefix + '.vocab', encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                self.vocab[line.rstrip('\n')] = i + 1
+        self.zero = np.zeros(self.dim, dtype=np.float32)
+        self.zero.flags.writeable = False
+        self._oov = dict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, word):
+        return word.strip() in self.vocab
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def word_id(self, word):
+        if word == self.pad:
+            return PAD_ID
+        return self.vocab.get(word.strip(), OOV_ID)
+
+    def _oov_vector(self, word):
+        vector = self._oov.get(word)
+        if vector is None:
+            # getVectorBySentence over the chars of the word
+            if word:
+                ids = [self.vocab.get(c.strip(), PAD_ID) for c in word]
+                vector = np.asarray(self.matrix[ids].mean(axis=0), dtype=np.float32)
+            else:
+                vector = self.zero
+            with self._lock:
+                if len(self._oov) >= MAX_OOV:
+                    self._oov.clear()
+                self._oov[word] = vector
+        return vector
+
+    def vector(self, word):
+        """
+        float32 (dim,), same values as vector_helper.getVector
+        """
+        i = self.word_id(word)
+        if i == OOV_ID:
+            return self._oov_vector(word)
+        return np.asarray(self.matrix[i])
+
+    def sentence_vector(self, words):
+        """
+        same values as BenebotVector.getVectorBySentence
+        """
+        if not words:
+            return np.zeros(self.dim, dtype=np.float32)
+        vectors = []
+        for word in words:
+            i = self.vocab.get(word.strip(), OOV_ID)
+            if i != OOV_ID:
+                vectors.append(self.matrix[i])
+            elif len(word) == 1:
+                vectors.append(self.zero)
+            else:
+                vectors.append(self.sentence_vector(word))
+        return np.mean(vectors, axis=0).astype(np.float32)
+
+    def ids(self, token_lists, max_len):
+        """
+        int32 (n, max_len) row ids, short lists are padded with PAD_ID and long
+        ones cut; returns the oov positions as well
+        """
+        ids = np.full((len(token_lists), max_len), PAD_ID, dtype=np.int32)
+        oov = []
+        for n, tokens in enumerate(token_lists):
+            for k, word in enumerate(tokens[:max_len]):
+                i = self.word_id(word)
+                if i == OOV_ID:
+                    oov.append((n, k, word))
+                    i = PAD_ID
+                ids[n, k] = i
+        return ids, oov
+
+    def batch(self, token_lists, max_len):
+        """
+        float32 (n, max_len, dim) in one gather
+        """
+        ids, oov = self.ids(token_lists, max_len)
+        out = self.matrix[ids]
+        for n, k, word in oov:
+            out[n, k] = self._oov_vector(word)
+        return out
+
+    def block(self, tokens, max_len):
+        """
+        float32 (max_len, dim), one padded sentence
+        """
+        return self.batch([tokens], max_len)[0]
+
+
+def exists(prefix):
+    return os.path.exists(prefix + '.npy') and os.path.exists(prefix + '.vocab')
+
+
+def export(model_path, prefix):
+    """
+    writes <prefix>.vocab and <prefix>.npy from a gensim Word2Vec model
+    """
+    import gensim
+    model = gensim.models.Word2Vec.load(model_path)
+    wv = model.wv
+    words = wv.index_to_key if hasattr(wv, 'index_to_key') else wv.index2word
+    dim = model.vector_size
+    # skip what the lookup could never reach, vector_helper strips every word
+    words = [w for w in words if w == w.strip() and '\n' not in w]
+    tmp = prefix + '.tmp.npy'
+    matrix = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(len(words) + 1, dim))
+    matrix[PAD_ID] = 0.0
+    for i, word in enumerate(words):
+        matrix[i + 1] = wv[word]
+    matrix.flush()
+    del matrix
+    with open(prefix + '.vocab.tmp', 'w', encoding='utf-8') as f:
+        for word in words:
+            f.write(word + '\n')
+    os.rename(tmp, prefix + '.npy')
+    os.rename(prefix + '.vocab.tmp', prefix + '.vocab')
+    print('exported', len(words), 'words of dim', dim, 'to', prefix)
+
+
+def check(model_path, prefix, max_len=10):
+    """
+    compares the store against the gensim path of vector_helper and times both
+    """
+    from dmn.dmn_fasttext import vector_helper
+    store = EmbeddingStore(prefix)
+    sentences = [['我', '想', '买', '手机'], ['api', 'call', '华为', 'PAD'], ['科沃斯机器人', '在哪里'], []]
+    start = time.time()
+    for _ in range(100):
+        legacy = np.asarray([[vector_helper.getVector(w) for w in s + ['PAD'] * (max_len - len(s))]
+                             for s in sentences], dtype=np.float32)
+    legacy_time = time.time() - start
+    start = time.time()
+    for _ in range(100):
+        batch = store.batch(sentences, max_len)
+    batch_time = time.time() - start
+    assert batch.shape == legacy.shape, (batch.shape, legacy.shape)
+    assert np.allclose(batch, legacy, atol=1e-6)
+    print('getVector {0:.2f}ms, store {1:.2f}ms per batch'.format(legacy_time * 10, batch_time * 10))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='/opt/word2vec/benebot_vector/word2vec.bin')
+    parser.add_argument('--out', default='/opt/word2vec/benebot_vector/word2vec_export')
+    parser.add_argument('--check', action='store_true', help='compare an existing export with the model')
+    args = parser.parse_args()
+    if args.check:
+        check(args.model, args.out)
+    else:
+        export(args.model, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,23 @@
 import sys
 import os
+import threading
 import gensim
 import numpy as np
 
+from collections import OrderedDict
+
 from dmn.dmn_fasttext.config import Config
+from dmn.dmn_fasttext import embedding_store
 
 config = Config()
 loop_word = 0
 dim_shrink = 1
 sentence_vector_dict = {}
+SENTENCE_CACHE_SIZE = 20000  # candidate sentence vectors kept by getSentenceVectors
 
 path = '/opt/word2vec/benebot_vector/word2vec.bin'
+# exported by embedding_store.py, used instead of the gensim model when present
+export_prefix = '/opt/word2vec/benebot_vector/word2vec_export'
 
 
 class Singleton(type):
@@ -83,10 +90,18 @@ class BenebotVector(metaclass=Singleton):
         return result
 
 
-bv = BenebotVector(path)
+store = None
+bv = None
+if embedding_store.exists(export_prefix):
+    print('load word vector export')
+    store = embedding_store.EmbeddingStore(export_prefix, pad=config.PAD)
+else:
+    bv = BenebotVector(path)
 
 
 def getVector(word, embedding_dim=300):
+    if store:
+        return store.vector(word)
     if word == config.PAD:
         return np.array([0.0] * embedding_dim)
     vector = bv.getVectorByWord(word)
@@ -97,14 +112,89 @@ def getVector(word, embedding_dim=300):
         words = [w for w in word]
         return bv.getVectorBySentence(words)
 
+
+def getVectors(token_lists, max_len, embedding_dim=300):
+    """
+    float32 (n, max_len, embedding_dim), token lists padded with PAD and cut at max_len
+    """
+    if store:
+        return store.batch(token_lists, max_len)
+    return np.asarray([[getVector(word, embedding_dim) for word in
+                        tokens[:max_len] + [config.PAD] * (max_len - len(tokens))]
+                       for tokens in token_lists], dtype=np.float32).reshape(
+        (len(token_lists), max_len, embedding_dim))
+
+
+def getSentenceVector(words):
+    if store:
+        return store.sentence_vector(words)
+    return bv.getVectorBySentence(words)
+
+
 def computeSentenceSim(sent1, sent2):
-    u = bv.getVectorBySentence(sent1)
-    v = bv.getVectorBySentence(sent2)
+    u = getSentenceVector(sent1)
+    v = getSentenceVector(sent2)
 
     c = np.dot(u, v) / np.linalg.norm(u) / np.linalg.norm(v)
     return c
 
 
+sentence_cache = OrderedDict()
+sentence_cache_lock = threading.Lock()
+
+
+def getSentenceVectors(token_lists, cache=True):
+    """
+    float32 (k, dim) sentence vectors, repeated candidates come from an lru
+    keyed by their tokens
+    """
+    vectors = []
+    for tokens in token_lists:
+        key = tuple(tokens)
+        vector = None
+        if cache:
+            with sentence_cache_lock:
+                vector = sentence_cache.get(key)
+                if vector is not None:
+                    sentence_cache.move_to_end(key)
+        if vector is None:
+            vector = np.asarray(getSentenceVector(tokens), dtype=np.float32)
+            if cache:
+                with sentence_cache_lock:
+                    sentence_cache[key] = vector
+                    while len(sentence_cache) > SENTENCE_CACHE_SIZE:
+                        sentence_cache.popitem(last=False)
+        vectors.append(vector)
+    if not vectors:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack(vectors)
+
+
+def computeSentenceSims(sent1, sents2):
+    """
+    cosine of sent1 against every token list of sents2 in one step,
+    nan where a vector is zero, as computeSentenceSim gives
+    """
+    if not len(sents2):
+        return np.zeros(0)
+    u = np.asarray(getSentenceVector(sent1), dtype=np.float32)
+    v = getSentenceVectors(sents2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return v.dot(u) / np.linalg.norm(u) / np.linalg.norm(v, axis=1)
+
+
+def mostSimilar(sent1, sents2):
+    """
+    :return: (best cosine, index into sents2), (-10, -1) when every score is nan
+    """
+    scores = computeSentenceSims(sent1, sents2)
+    valid = ~np.isnan(scores)
+    if not valid.any():
+        return -10, -1
+    best = int(np.argmax(np.where(valid, scores, -np.inf)))
+    return float(scores[best]), best
+
+
 def embedding_lookup(sequence_num, sequence_length, embedding_dim, input_x, maintain=0):
     for sentence_index in range(sequence_num):
         sentence_str = input_x[sentence_index]
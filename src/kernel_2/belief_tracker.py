@@ -20,7 +20,6 @@ sys.path.append(grandfatherdir)
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
-from SolrClient import SolrClient
 
 import sys
 from graph.node import Node
@@ -28,6 +27,7 @@ from graph.belief_graph import Graph
 from utils.cn2arab import *
 import utils.query_util as query_util
 import utils.solr_util as solr_util
+from utils.log_util import debug
 
 class BeliefTracker:
     # static
@@ -83,7 +83,6 @@ class BeliefTracker:
 
     guide_url = "http://localhost:11403/solr/sc_sale_gen/select?defType=edismax&indent=on&wt=json"
     # tokenizer_url = "http://localhost:5000/pos?q="
-    solr = SolrClient('http://localhost:11403/solr')
 
     def kernel(self, query):
         response = self.r_walk_with_pointer_with_clf(
@@ -112,7 +111,7 @@ class BeliefTracker:
         # self.use_wild_card(wild_card)
         if wild_card and self.exploit_once:
             self.exploit_wild_card(wild_card=wild_card)
-        print(self.requested_slots)
+        debug(self.requested_slots)
         api, avails = self.issue_api()
         if api.startswith('api_call_search'):
             should_clear_memory = True
@@ -128,7 +127,7 @@ class BeliefTracker:
         # self.use_wild_card(wild_card)
         if wild_card and self.exploit_once:
             self.exploit_wild_card(wild_card=wild_card)
-        print(self.requested_slots)
+        debug(self.requested_slots)
         api, avails = self.issue_api()
         return api, avails
 
@@ -254,6 +253,32 @@ class BeliefTracker:
         if slot in self.requested_slots:
             self.requested_slots.remove(slot)
 
+    def dump_state(self):
+        """
+        plain python snapshot of the per user fields, nodes are referred to by id
+        """
+        ambiguity_slots = dict()
+        for key, nodes in self.ambiguity_slots.items():
+            ambiguity_slots[key] = [node.id for node in nodes]
+        return (dict(self.filling_slots), list(self.requested_slots), self.machine_state,
+                self.search_node.id, ambiguity_slots, dict(self.avails),
+                dict(self.numerical_slots), dict(self.wild_card), dict(self.place_holder),
+                self.exploit_once)
+
+    def load_state(self, state):
+        filling_slots, requested_slots, self.machine_state, search_node, ambiguity_slots, \
+            avails, numerical_slots, wild_card, place_holder, self.exploit_once = state
+        self.filling_slots = dict(filling_slots)
+        self.requested_slots = list(requested_slots)
+        self.search_node = self.belief_graph.get_node_by_id(search_node)
+        self.ambiguity_slots = dict()
+        for key, ids in ambiguity_slots.items():
+            self.ambiguity_slots[key] = [self.belief_graph.get_node_by_id(id) for id in ids]
+        self.avails = dict(avails)
+        self.numerical_slots = dict(numerical_slots)
+        self.wild_card = dict(wild_card)
+        self.place_holder = dict(place_holder)
+
     def clear_memory(self):
         self.filling_slots.clear()
         self.requested_slots.clear()
@@ -465,7 +490,7 @@ class BeliefTracker:
                 flag = True
             if not flag:
                 if 'number' in wild_card:
-                    print(self.get_requested_field())
+                    debug(self.get_requested_field())
                     self.fill_slot(given_slot, wild_card['number'])
                     flag = True
             return flag
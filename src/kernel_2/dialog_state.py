@@ -0,0 +1,166 @@
+"""
+Dialog State
+
+Per-user mutable state of a dialog. Everything heavy (belief graph, classifier,
+render, rule plugin) lives once in MainKernel and is shared by all users; a
+DialogState only carries the belief tracker slots and the classifier session
+context of a single user.
+"""
+import threading
+import time
+import logging
+import traceback
+
+from collections import OrderedDict
+
+from kernel_2.session_store import encode_record, decode_record, StaleSessionError
+
+MAX_USERS = 10000
+USER_TTL = 30 * 60  # seconds a user may stay idle before its state is dropped
+
+
+class DialogState:
+    __slots__ = ('user', 'belief_tracker', 'sess', 'base_counter', 'last_access', 'lock', 'version', 'unsaved')
+
+    def __init__(self, user, belief_tracker, sess):
+        self.user = user
+        self.belief_tracker = belief_tracker
+        self.sess = sess
+        self.base_counter = 0
+        self.last_access = time.time()
+        # serializes concurrent requests of the same user
+        self.lock = threading.RLock()
+        # version of the record in the session store this state was loaded from
+        self.version = 0
+        # the last commit failed, this state is newer than the stored one
+        self.unsaved = False
+
+    def clear(self):
+        self.belief_tracker.clear_memory()
+        if self.sess:
+            self.sess.clear_memory()
+        self.base_counter = 0
+
+    def dump(self):
+        context = self.sess.dump_context() if self.sess else None
+        return encode_record(self.belief_tracker.dump_state() + (self.base_counter, context))
+
+    def restore(self, record):
+        state = decode_record(record)
+        self.belief_tracker.load_state(state[:-2])
+        self.base_counter, context = state[-2:]
+        if self.sess and context is not None:
+            self.sess.load_context(context)
+
+
+class DialogStateManager:
+    """
+    LRU + idle TTL container of DialogState, states are created on demand
+    """
+
+    def __init__(self, factory, max_size=MAX_USERS, ttl=USER_TTL, store=None):
+        """
+        :param factory: callable(user) -> DialogState
+        :param max_size: maximum number of states kept, least recently used go first
+        :param ttl: idle seconds after which a state is dropped
+        :param store: optional SessionStore, states are then loaded from it on
+                      every request and written back by commit
+        """
+        self.factory = factory
+        self.store = store
+        self.conflicts = 0
+        self.max_size = max_size
+        self.ttl = ttl
+        self.created = 0
+        self.evicted = 0
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        now = time.time()
+        with self._lock:
+            state = self._states.get(user)
+            if state is not None and now - state.last_access > self.ttl:
+                del self._states[user]
+                self.evicted += 1
+                state = None
+            if state is None:
+                state = self.factory(user)
+                self._states[user] = state
+                self.created += 1
+            else:
+                self._states.move_to_end(user)
+            state.last_access = now
+            self._expire(now)
+        if self.store:
+            self._sync(state)
+        return state
+
+    def _sync(self, state):
+        with state.lock:
+            record, version = self.store.load(state.user)
+            if state.unsaved:
+                # keep the turns the store could not take, the next commit retries them
+                state.version = version if record is not None else 0
+                return
+            if record is None:
+                if state.version:
+                    # dropped by the store, start over
+                    state.clear()
+                state.version = 0
+            elif version != state.version:
+                state.restore(record)
+                state.version = version
+
+    def commit(self, state):
+        """
+        write the state back to the store after a turn
+        """
+        if not self.store:
+            return
+        try:
+            state.version = self.store.save(state.user, state.dump(), state.version)
+            state.unsaved = False
+        except StaleSessionError:
+            # another worker wrote this user meanwhile, its turn wins
+            self.conflicts += 1
+            state.version = -1
+            state.unsaved = False
+            logging.warning('C@user:{}##session_conflict'.format(state.user))
+        except Exception:
+            state.version = -1
+            state.unsaved = True
+            logging.error('C@user:{}##session_store_error:{}'.format(state.user, traceback.format_exc()))
+
+    def drop(self, user):
+        if self.store:
+            self.store.delete(user)
+        with self._lock:
+            return self._states.pop(user, None)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+
+    def _expire(self, now):
+        # ordered by last access, so the stale ones are always in front
+        while self._states:
+            user, state = next(iter(self._states.items()))
+            if len(self._states) > self.max_size or now - state.last_access > self.ttl:
+                del self._states[user]
+                self.evicted += 1
+            else:
+                break
+
+    def __contains__(self, user):
+        return user in self._states
+
+    def __len__(self):
+        return len(self._states)
+
+    def stats(self):
+        return {"size": len(self._states), "max_size": self.max_size, "ttl": self.ttl,
+                "created": self.created, "evicted": self.evicted,
+                "store": type(self.store).__name__ if self.store else None,
+                "store_stats": self.store.stats() if hasattr(self.store, 'stats') else None,
+                "conflicts": self.conflicts}
@@ -0,0 +1,408 @@
+"""
+Inference Service
+
+Loads DmnInfer (or MemInfer) once in a standalone process and serves
+classification over a unix domain socket, so that web workers do not hold a
+tensorflow session each and can be forked freely.
+
+The server is stateless: every request carries the raw context tokens of the
+user (see DmnSession.dump_context) and gets the updated context back.
+RemoteSession keeps that context on the client side and offers the same
+reply/append_memory/clear_memory contract as DmnSession.
+
+protocol: every frame is a 4 byte big endian length followed by utf-8 json
+    {"op": "info"}
+    {"op": "reply", "context": [[tokens]], "msg": "..."}
+    {"op": "append_memory", "context": [[tokens]], "m": "..."}
+    {"op": "clear_memory", "context": [[tokens]], "history": 0}
+    {"op": "batch", "items": [request, ...]}
+replies are {"ok": true, ...} or {"ok": false, "error": "..."}
+
+    python kernel_2/infer_service.py --clf dmn --socket /tmp/memory_infer.sock
+    python kernel_2/infer_service.py --test --clf stub
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+grandfatherdir = os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(parentdir)
+sys.path.append(grandfatherdir)
+
+SOCKET_PATH = '/tmp/memory_infer.sock'
+HEADER = struct.Struct('>I')
+BATCH_WORKERS = 32
+
+
+def send_frame(sock, obj):
+    data = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_frame(sock):
+    header = _recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exact(sock, HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+
+def _to_list(prob):
+    return prob.tolist() if hasattr(prob, 'tolist') else prob
+
+
+class InferEngine:
+    """
+    runs protocol requests against a loaded DmnInfer/MemInfer
+    """
+
+    def __init__(self, infer, clf):
+        self.infer = infer
+        self.clf = clf
+        self.empty = infer.get_session().dump_context()
+        self.pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
+    def handle(self, request):
+        try:
+            op = request['op']
+            if op == 'batch':
+                # run concurrently so the dmn batcher can put them in one session.run
+                items = list(self.pool.map(self._handle_item, request['items']))
+                return {"ok": True, "items": items}
+            if op == 'info':
+                return {"ok": True, "clf": self.clf, "empty": self.empty}
+            sess = self.infer.get_session()
+            sess.load_context(request['context'])
+            if op == 'reply':
+                reply, prob = sess.reply(request['msg'])
+                return {"ok": True, "reply": reply, "prob": _to_list(prob),
+                        "context": sess.dump_context()}
+            if op == 'append_memory':
+                sess.append_memory(request['m'])
+            elif op == 'clear_memory':
+                sess.clear_memory(request.get('history', 0))
+            else:
+                return {"ok": False, "error": "unknown op " + str(op)}
+            return {"ok": True, "context": sess.dump_context()}
+        except Exception:
+            traceback.print_exc()
+            return {"ok": False, "error": traceback.format_exc()}
+
+    def _handle_item(self, item):
+        # a nested batch would wait on the pool it runs in, enough of them hang it
+        if isinstance(item, dict) and item.get('op') == 'batch':
+            return {"ok": False, "error": "batch inside a batch"}
+        return self.handle(item)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            request = recv_frame(self.request)
+            if request is None:
+                return
+            send_frame(self.request, self.server.engine.handle(request))
+
+
+class InferServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, engine, path=SOCKET_PATH):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.engine = engine
+        self.path = path
+        socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        os.chmod(path, 0o660)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class InferError(Exception):
+    pass
+
+
+class InferClient:
+    """
+    talks to InferServer, one connection per thread;
+    can stand in for DmnInfer/MemInfer in MainKernel as it offers get_session
+    """
+
+    def __init__(self, path=SOCKET_PATH, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._empty = None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock:
+            sock.close()
+
+    def call(self, op, **kwargs):
+        request = dict(kwargs)
+        request['op'] = op
+        for retry in range(2):
+            sock = getattr(self._local, 'sock', None) or self._connect()
+            try:
+                send_frame(sock, request)
+                response = recv_frame(sock)
+                if response is not None:
+                    break
+            except (socket.timeout, OSError):
+                if retry:
+                    self._close()
+                    raise
+            # server went away, reconnect once
+            self._close()
+        else:
+            raise InferError('inference server closed the connection')
+        if not response.get('ok'):
+            raise InferError(response.get('error'))
+        return response
+
+    def empty_context(self):
+        if self._empty is None:
+            self._empty = self.call('info')['empty']
+        return [list(tokens) for tokens in self._empty]
+
+    def get_session(self):
+        return RemoteSession(self)
+
+    def reply_batch(self, sessions, msgs):
+        """
+        one round trip for many users, results in the order of sessions
+        """
+        items = [{"op": "reply", "context": sess.context, "msg": msg}
+                 for sess, msg in zip(sessions, msgs)]
+        results = []
+        for sess, item in zip(sessions, self.call('batch', items=items)['items']):
+            if not item.get('ok'):
+                raise InferError(item.get('error'))
+            sess.context = item['context']
+            results.append((item['reply'], item['prob']))
+        return results
+
+
+class RemoteSession:
+
+    def __init__(self, client, context=None):
+        self.client = client
+        self.context = context if context is not None else client.empty_context()
+
+    def reply(self, msg):
+        response = self.client.call('reply', context=self.context, msg=msg)
+        self.context = response['context']
+        return response['reply'], response['prob']
+
+    def append_memory(self, m):
+        if not m:
+            return
+        self.context = self.client.call('append_memory', context=self.context, m=m)['context']
+
+    def clear_memory(self, history=0):
+        if history == 0:
+            self.context = self.client.empty_context()
+        else:
+            self.context = self.context[-history:]
+
+    def dump_context(self):
+        return [list(tokens) for tokens in self.context]
+
+    def load_context(self, context):
+        self.context = [list(tokens) for tokens in context]
+
+
+def load_infer(clf):
+    if clf == 'memory':
+        from memory.memn2n_session import MemInfer
+        config = {"metadata_dir": os.path.join(grandfatherdir, 'model/memn2n/processed/metadata.pkl'),
+                  "data_dir": os.path.join(grandfatherdir, 'model/memn2n/processed/data.pkl'),
+                  "ckpt_dir": os.path.join(grandfatherdir, 'model/memn2n/ckpt')}
+        return MemInfer(config)
+    from dmn.dmn_fasttext.dmn_session import DmnInfer
+    return DmnInfer()
+
+
+class StubSession:
+    """
+    a deterministic stand in for DmnSession, the answer depends on the context
+    """
+
+    def __init__(self):
+        self.context = [['PAD']]
+
+    def reply(self, msg):
+        reply = 'api_call_{}_{}'.format(len(self.context), msg)
+        self.context.append(list(msg))
+        self.context.append(list(reply))
+        return reply, [len(self.context) / 10.0, len(msg) / 10.0]
+
+    def append_memory(self, m):
+        if m:
+            self.context.append(list(m))
+
+    def clear_memory(self, history=0):
+        if history == 0:
+            self.context = [['PAD']]
+        else:
+            self.context = self.context[-history:]
+
+    def dump_context(self):
+        return [list(tokens) for tokens in self.context]
+
+    def load_context(self, context):
+        self.context = [list(tokens) for tokens in context]
+
+
+class StubInfer:
+
+    def get_session(self):
+        return StubSession()
+
+
+def test(clf='stub', path='/tmp/memory_infer_test.sock'):
+    """
+    runs server and client on the same box and checks the remote session
+    answers exactly like an in process one; clf stub needs no model
+    """
+    infer = StubInfer() if clf == 'stub' else load_infer(clf)
+    server = InferServer(InferEngine(infer, clf), path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        client = InferClient(path)
+        remote = client.get_session()
+        local = infer.get_session()
+        for q in ['你好', '我要买手机', '华为', 'api_call_request_price']:
+            r_reply, r_prob = remote.reply(q)
+            l_reply, l_prob = local.reply(q)
+            assert r_reply == l_reply, (q, r_reply, l_reply)
+            assert remote.context == local.dump_context()
+            print(q, r_reply, r_prob)
+        remote.append_memory('api_call_request_brand')
+        local.append_memory('api_call_request_brand')
+        assert remote.context == local.dump_context()
+        remote.clear_memory(history=1)
+        local.clear_memory(history=1)
+        assert remote.context == local.dump_context()
+        remote.clear_memory()
+        assert remote.context == client.empty_context()
+
+        # the context round trip: a session picked up from a dumped context
+        local.load_context(remote.dump_context())
+        assert remote.reply('空调')[0] == local.reply('空调')[0]
+        assert remote.context == local.dump_context()
+
+        # one round trip for many users, same answers as one by one
+        others = [client.get_session() for _ in range(8)]
+        msgs = ['空调{}'.format(i) for i in range(len(others))]
+        batch = client.reply_batch(others, msgs)
+        for sess, msg, (reply, _) in zip(others, msgs, batch):
+            single = infer.get_session()
+            assert single.reply(msg)[0] == reply
+            assert sess.context == single.dump_context()
+        print(batch[0])
+
+        # concurrent clients, each on its own connection
+        errors = []
+
+        def user(i):
+            try:
+                sess = client.get_session()
+                own = infer.get_session()
+                for j in range(20):
+                    msg = '{}_{}'.format(i, j)
+                    assert sess.reply(msg)[0] == own.reply(msg)[0]
+                assert sess.context == own.dump_context()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=user, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors, errors
+
+        # error frames, the connection stays usable after them
+        for op, kwargs in [('unknown', {}), ('reply', {'msg': 'no context'})]:
+            try:
+                client.call(op, **kwargs)
+                assert False, op
+            except InferError:
+                pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        send_frame(sock, {"op": "batch", "items": [{"op": "info"}, {"op": "bogus"}]})
+        items = recv_frame(sock)['items']
+        assert items[0]['ok'] and not items[1]['ok'], items
+        # nested batches are refused instead of waiting on the pool they run in
+        nested = {"op": "batch", "items": [{"op": "info"}]}
+        send_frame(sock, {"op": "batch", "items": [nested] * (BATCH_WORKERS * 2) + [{"op": "info"}]})
+        items = recv_frame(sock)['items']
+        assert not any(item['ok'] for item in items[:-1]) and items[-1]['ok'], items[0]
+        sock.close()
+        assert remote.reply('你好')[0]
+        print('infer service test passed')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clf', choices={'dmn', 'memory', 'stub'}, default='dmn',
+                        help='stub answers without a model, for --test')
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    parser.add_argument('--test', action='store_true', help='run server and client in this process')
+    args = parser.parse_args()
+    if args.test:
+        test(args.clf)
+        return
+    server = InferServer(InferEngine(load_infer(args.clf), args.clf), args.socket)
+    print('inference service listening on', args.socket)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -33,7 +33,10 @@ import time
 import schedule
 import threading
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from queue import Queue
 
 
 parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -45,8 +48,6 @@ import traceback
 # for pickle
 from graph.belief_graph import Graph
 from kernel_2.belief_tracker import BeliefTracker
-from memory.memn2n_session import MemInfer
-from dmn.dmn_fasttext.dmn_session import DmnInfer
 from utils.cn2arab import *
 
 import utils.query_util as query_util
@@ -56,14 +57,16 @@ from qa.iqa import Qa as QA
 import memory.config as config
 from kernel_2.render import Render
 from kernel_2.rule_base_plugin import RuleBasePlugin
+from kernel_2.dialog_state import DialogState, DialogStateManager, MAX_USERS, USER_TTL
+from kernel_2.infer_service import InferClient
+from kernel_2.session_store import create_store
+from kernel_2.metrics import KernelMetrics
+from utils.log_util import setup_logging, log_corpus, debug, set_debug
 
 SCHED_TIME = 10 # set schedule time for memory clear
+BATCH_WORKERS = 32 # users served concurrently by kernel_batch, match the dmn batch size
 
-current_date = time.strftime("%Y.%m.%d")
-logging.basicConfig(handlers=[logging.FileHandler(os.path.join(grandfatherdir,
-                                                               'logs/log_corpus_' + current_date + '.log'), 'w',
-                                                  'utf-8')],
-                    format='%(asctime)s %(message)s', datefmt='%Y.%m.%dT%H:%M:%S', level=logging.INFO)
+setup_logging()
 
 
 # os.environ['CUDA_VISIBLE_DEVICES'] = config.CUDA_DEVICE
@@ -76,27 +79,43 @@ class MainKernel:
 
     def __init__(self, config):
         self.config = config
-        self.belief_tracker = BeliefTracker(config)
+        if 'debug' in config:
+            set_debug(config['debug'])
         # self.render = Render(self.belief_tracker, config)
         self._load_render(config)
         self._load_rule_plugin(config)
-        self.base_counter = 0
         self.base_clear_memory = 2
+        self.clf = None
 
         # thread = threading.Thread(target=self.sched)
         # thread.start()
 
         if config['clf'] == 'memory':
             self._load_memory(config)
-            self.sess = self.memory.get_session()
+            self.clf = self.memory
         elif config['clf'] == 'dmn':
             self._load_dmn(config)
-            self.sess = self.dmn.get_session()
+            self.clf = self.dmn
+        elif config['clf'] == 'remote':
+            # model served by kernel_2/infer_service.py, no tensorflow in this process
+            self.clf = InferClient(config['infer_socket'])
         else:
-            self.sess = Multilabel_Clf.load(
+            self.gbdt = Multilabel_Clf.load(
                 model_path=config['gbdt_model_path'])
 
+        # per user state, the kernel itself is shared by all users
+        self.states = DialogStateManager(self.new_state,
+                                         max_size=config.get('max_users', MAX_USERS),
+                                         ttl=config.get('user_ttl', USER_TTL),
+                                         store=create_store(config))
+        self.metrics = KernelMetrics()
+
+    def new_state(self, user):
+        sess = self.clf.get_session() if self.clf else None
+        return DialogState(user, BeliefTracker(self.config), sess)
+
     def _load_memory(self, config):
+        from memory.memn2n_session import MemInfer
         if not MainKernel.static_memory:
             self.memory = MemInfer(config)
             MainKernel.static_memory = self.memory
@@ -105,12 +124,14 @@ class MainKernel:
 
     def _load_rule_plugin(self, config):
         if not MainKernel.static_rule_plugin:
-            self.rule_plugin = RuleBasePlugin(config)
+            # the one of the render, so a reload and the stats cover check_buy too
+            self.rule_plugin = Render.static_rule_plugin or RuleBasePlugin(config)
             MainKernel.static_rule_plugin = self.rule_plugin
         else:
             self.rule_plugin = MainKernel.static_rule_plugin
 
     def _load_dmn(self, config):
+        from dmn.dmn_fasttext.dmn_session import DmnInfer
         if not MainKernel.static_dmn:
             self.dmn = DmnInfer()
             MainKernel.static_dmn = self.dmn
@@ -125,21 +146,77 @@ class MainKernel:
             self.render = MainKernel.static_render
 
     def kernel(self, q, user='solr', recursive=True):
+        timer = self.metrics.timer()
+        state = self.states.get(user)
+        with state.lock:
+            try:
+                result = self._kernel(q, user, state, timer, recursive)
+            except Exception:
+                self.metrics.record(timer, error=True)
+                raise
+            self.states.commit(state)
+            timer.mark('session')
+        self.metrics.record(timer)
+        return result
+
+    def kernel_batch(self, pairs, workers=None):
+        """
+        runs many (user, query) turns, the turns of one user in the given order
+        and different users concurrently, so that their classifier calls meet in
+        the inference batcher and solr lookups overlap.
+        yields (index, user, query, result) as soon as a turn is done, index is
+        the position in pairs; a failed turn yields {'error': ...} and the
+        user's next turns still run.
+        """
+        turns = OrderedDict()
+        total = 0
+        for index, (user, q) in enumerate(pairs):
+            turns.setdefault(user, []).append((index, q))
+            total += 1
+        if not total:
+            return
+        done = Queue()
+
+        def run(user, user_turns):
+            for index, q in user_turns:
+                try:
+                    result = self.kernel(q, user)
+                except Exception:
+                    logging.error("C@user:{}##error_details:{}".format(user, traceback.format_exc()))
+                    result = {'error': traceback.format_exc()}
+                done.put((index, user, q, result))
+
+        workers = workers or self.config.get('batch_workers', BATCH_WORKERS)
+        with ThreadPoolExecutor(max_workers=min(workers, len(turns))) as pool:
+            for user, user_turns in turns.items():
+                pool.submit(run, user, user_turns)
+            for _ in range(total):
+                yield done.get()
+
+    def _kernel(self, q, user, state, timer, recursive=True):
+        belief_tracker = state.belief_tracker
+        sess = state.sess
         q_time=time.time()
         start = time.time()
+        if recursive:
+            # a retry comes from the clf stage, its time is not session time
+            timer.mark('session')
         q = self.rule_plugin.filter(q)
         q = self.rule_plugin.pre_replace(q)
-        print("before:",q)
+        debug("before:",q)
         q=self.rule_plugin.introduction(q)
-        print("after:",q)
+        debug("after:",q)
+        timer.mark('filter')
         # q=self.rule_plugin.rewrite(q)
         # print(q)
         result = {"answer": "null", "media": "null", 'from': "memory", "sim": 0}
         if not q:
             result = {"answer": "", "media": "null", 'from': "noise", "sim": 0, 'class':'unk'}
+            timer.api = 'noise'
             return result
         range_rendered, wild_card = self.range_render(q)
-        print(range_rendered, wild_card)
+        debug(range_rendered, wild_card)
+        timer.mark('range_render')
         prob = -1
         response = ''
         memory = ''
@@ -148,52 +225,55 @@ class MainKernel:
             pass
         else:
             if q.lower() == 'clear':
-                self.belief_tracker.clear_memory()
-                self.sess.clear_memory()
+                belief_tracker.clear_memory()
+                sess.clear_memory()
+                timer.api = 'clear'
                 return 'memory cleared@@[]'
             exploited = False
             prefix = ''
-            if self.belief_tracker.shall_exploit_range():
-                # exploited = self.belief_tracker.exploit_wild_card(wild_card)
+            if belief_tracker.shall_exploit_range():
+                # exploited = belief_tracker.exploit_wild_card(wild_card)
                 # if exploited:
-                #     response, avails = self.belief_tracker.issue_api()
+                #     response, avails = belief_tracker.issue_api()
                 #     memory = ''
                 #     api = 'api_call_slot_range_exploit'
                     # if response.startswith('api_call_search'):
                     #     print('clear memory')
-                    #     self.sess.clear_memory()
-                    #     self.belief_tracker.clear_memory()
+                    #     sess.clear_memory()
+                    #     belief_tracker.clear_memory()
                     #     memory = ''
                 pass
             if not exploited:
-                _api, prob = self.sess.reply(range_rendered)
+                _api, prob = sess.reply(range_rendered)
                 api = self.rule_plugin.fix(q, _api)
-                print(_api, api, prob[0][0], prob)
+                debug(_api, api, prob[0][0], prob)
                 score = float(prob[0][0])
 
                 if score < 0.5:
                     api = 'api_call_base'
                 response = api
+                timer.api = api
+                timer.mark('clf')
                 if api.startswith('reserved_'):
-                    print('miss placing cls...')
-                    self.belief_tracker.clear_memory()
-                    self.sess.clear_memory()
+                    debug('miss placing cls...')
+                    belief_tracker.clear_memory()
+                    sess.clear_memory()
                     if recursive:
-                        return self.kernel(q, user, False)
+                        return self._kernel(q, user, state, timer, False)
                 if api.startswith('api_call_base') \
                         or api.startswith('api_call_query_location') or api.startswith('api_call_faq'):
                     memory = ''
                     response = api
-                    self.base_counter += 1
-                    if self.base_counter >= self.base_clear_memory and api.startswith('api_call_base'):
-                        self.base_counter = 0
-                        print('clear memory due to base...')
-                        self.belief_tracker.clear_memory()
-                        self.sess.clear_memory()
+                    state.base_counter += 1
+                    if state.base_counter >= self.base_clear_memory and api.startswith('api_call_base'):
+                        state.base_counter = 0
+                        debug('clear memory due to base...')
+                        belief_tracker.clear_memory()
+                        sess.clear_memory()
                         if recursive:
-                            return self.kernel(q, user, False)
+                            return self._kernel(q, user, state, timer, False)
                 else:
-                    self.base_counter = 0
+                    state.base_counter = 0
 
 
                 if api.startswith('api_call_slot'):
@@ -201,24 +281,24 @@ class MainKernel:
                         response = api
                         avails = []
                     elif api == 'api_call_slot_whatever':
-                        response, avails = self.belief_tracker.defaulting_call(
+                        response, avails = belief_tracker.defaulting_call(
                             q, wild_card)
                         prefix = self.render.random_prefix()
                     else:
                         api_json = self.api_call_slot_json_render(api)
-                        response, avails, should_clear_memory = self.belief_tracker.memory_kernel(
+                        response, avails, should_clear_memory = belief_tracker.memory_kernel(
                             q, api_json, wild_card)
                         if should_clear_memory:
-                            print('restart xinhua bookstore session..')
-                            self.sess.clear_memory(history=2)
+                            debug('restart xinhua bookstore session..')
+                            sess.clear_memory(history=2)
                         if response.startswith('api_call_search'):
-                            self.sess.clear_memory()
+                            sess.clear_memory()
                     memory = response
-                    print('tree rendered..', response)
+                    debug('tree rendered..', response)
                     if response.startswith('api_call_search'):
                         # print('clear memory')
-                        # self.sess.clear_memory()
-                        # self.belief_tracker.clear_memory()
+                        # sess.clear_memory()
+                        # belief_tracker.clear_memory()
                         memory = ''
 
                 else: #added on 2017-12-28
@@ -226,41 +306,43 @@ class MainKernel:
                    pass
 
                 if api == 'api_call_deny_all':
-                    response, avails = self.belief_tracker.deny_call(slot=None)
+                    response, avails = belief_tracker.deny_call(slot=None)
                     memory = response
                     prefix = self.render.random_prefix()
-                    print('tree rendered after deny..', response)
+                    debug('tree rendered after deny..', response)
                 if api == 'api_call_deny_brand':
-                    response, avails = self.belief_tracker.deny_call(
+                    response, avails = belief_tracker.deny_call(
                         slot='brand')
                     memory = response
                     prefix = self.render.random_prefix()
-                    print('tree rendered after deny brand..', response)
+                    debug('tree rendered after deny brand..', response)
                     # print(response, type(response))
                     # elif api.startswith('api_call_base') or api.startswith('api_call_greet'):
-                    #     # self.sess.clear_memory()
+                    #     # sess.clear_memory()
                     #     matched, answer, score = self.interactive.get_responses(
                     #         query=q)
                     #     response = answer
                     #     memory = api
                     #     avails = []
-            self.sess.append_memory(memory)
-            self.rule_plugin.request_clear_memory(response, self.sess, self.belief_tracker)
-            render = self.render.render(q, response, self.belief_tracker.avails, prefix)
+                timer.mark('belief_tracker')
+            sess.append_memory(memory)
+            self.rule_plugin.request_clear_memory(response, sess, belief_tracker)
+            timer.mark('memory')
+            render = self.render.render(q, response, belief_tracker.avails, prefix)
             if str(render['answer']).startswith('api_call_'):
                 response='api_call_base'
-                render = self.render.render(q, response, self.belief_tracker.avails, prefix)
+                render = self.render.render(q, response, belief_tracker.avails, prefix)
 
             render['answer'] = self.rule_plugin.replace(render['answer'])
+            timer.mark('render')
             for key, value in render.items():
                 result[key] = value
             # render = api
-            logging.info("C@user:{}##model:{}##query:{}##class:{}##prob:{}##render:{}".format(
-                user, 'memory', q, api, prob, render))
+            log_corpus(user=user, model='memory', query=q, api=api, prob=prob, render=render)
             # result = render
             result['sentence'] = q
             result['score'] = float(prob[0][0])
-            result['class'] = api + '->' + response# + '/' + 'avail_vals#{}'.format(str(self.belief_tracker.avails))
+            result['class'] = api + '->' + response# + '/' + 'avail_vals#{}'.format(str(belief_tracker.avails))
             a_time=time.time()
             result['qtime'] = q_time
             result['atime'] = a_time
@@ -271,19 +353,20 @@ class MainKernel:
                 result['uid'] = 'uid_undefined'
             if 'media'in result and result['media'] and result['media'] is not 'null':
                 result['timeout'] = 15
+            timer.mark('log')
             return result
 
     def gbdt_reply(self, q, requested=None):
         if requested:
-            print(requested + '$' + q)
-            classes, probs = self.sess.predict(requested + '$' + q)
+            debug(requested + '$' + q)
+            classes, probs = self.gbdt.predict(requested + '$' + q)
         else:
-            classes, probs = self.sess.predict(q)
+            classes, probs = self.gbdt.predict(q)
 
-        print(probs)
+        debug(probs)
         api = dict()
         for c in classes:
-            print(c)
+            debug(c)
             key, value = c.split(':')
             api[key] = value
         return api
@@ -300,9 +383,11 @@ class MainKernel:
             api_json[key] = value
         return api_json
 
-    def clear(self):
-        self.belief_tracker.clear_memory()
-        self.sess.clear_memory()
+    def clear(self, user='solr'):
+        state = self.states.get(user)
+        with state.lock:
+            state.clear()
+            self.states.commit(state)
 
     def sched(self):
         schedule.every(SCHED_TIME).seconds.do(self.clear)
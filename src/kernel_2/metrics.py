@@ -0,0 +1,175 @@
+"""
+Kernel Metrics
+
+Per stage latency of MainKernel.kernel, bucketed by api family
+(api_call_base, api_call_slot, api_call_query_location, ...).
+
+A StageTimer lives on the stack of a single request and only reads the clock
+at every mark, the shared histograms are touched once per request under one
+lock. Histograms have fixed millisecond buckets so memory stays constant and
+percentiles are read off the cumulative counts.
+"""
+import bisect
+import threading
+import time
+
+# upper bounds in ms, roughly 1.5x apart, the last bucket catches everything above
+BUCKETS = (0.1, 0.25, 0.5, 1, 1.5, 2, 3, 5, 7.5, 10, 15, 20, 30, 50, 75, 100,
+           150, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000, float('inf'))
+
+# session covers the state store sync/commit and waiting for the user lock
+STAGES = ('session', 'filter', 'range_render', 'clf', 'belief_tracker', 'memory', 'render', 'log', 'total')
+
+FAMILIES = ('api_call_slot', 'api_call_query_location', 'api_call_base', 'api_call_faq',
+            'api_call_deny', 'api_call_request', 'api_call_greet', 'api_call_search', 'reserved')
+
+
+def api_family(api):
+    if not api:
+        return 'unk'
+    for family in FAMILIES:
+        if api.startswith(family):
+            return family
+    return '_'.join(api.split(',')[0].split(':')[0].split('_')[:3])
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        """
+        linear interpolation inside the bucket the p-th observation falls in
+        """
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = BUCKETS[i - 1] if i else 0.0
+                high = min(BUCKETS[i], self.max)
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "p50": self.percentile(0.5),
+                "p95": self.percentile(0.95),
+                "p99": self.percentile(0.99),
+                "max": self.max}
+
+
+class StageTimer:
+    """
+    mark(stage) charges the time since the previous mark to stage,
+    repeated stages (the recursive kernel call) add up
+    """
+    __slots__ = ('start', 'last', 'stages', 'api')
+
+    def __init__(self):
+        self.start = self.last = time.time()
+        self.stages = dict()
+        self.api = None
+
+    def mark(self, stage):
+        now = time.time()
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self.last) * 1000
+        self.last = now
+
+    def total(self):
+        return (self.last - self.start) * 1000
+
+
+class KernelMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.since = time.time()
+        self.histograms = dict()  # (family, stage) -> Histogram
+        self.requests = dict()
+        self.errors = dict()
+
+    def timer(self):
+        return StageTimer()
+
+    def record(self, timer, error=False):
+        timer.mark('end')
+        family = 'error' if error and not timer.api else api_family(timer.api)
+        total = timer.total()
+        with self.lock:
+            self.requests[family] = self.requests.get(family, 0) + 1
+            if error:
+                self.errors[family] = self.errors.get(family, 0) + 1
+            for stage, ms in timer.stages.items():
+                if stage != 'end':
+                    self._histogram(family, stage).observe(ms)
+            self._histogram(family, 'total').observe(total)
+
+    def _histogram(self, family, stage):
+        key = (family, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return histogram
+
+    def reset(self):
+        with self.lock:
+            self.since = time.time()
+            self.histograms.clear()
+            self.requests.clear()
+            self.errors.clear()
+
+    def snapshot(self):
+        """
+        {family: {requests, errors, error_rate, stages: {stage: summary}}} in ms
+        """
+        with self.lock:
+            result = dict()
+            for family, requests in self.requests.items():
+                errors = self.errors.get(family, 0)
+                result[family] = {"requests": requests, "errors": errors,
+                                  "error_rate": float(errors) / requests,
+                                  "stages": dict()}
+            for (family, stage), histogram in self.histograms.items():
+                result[family]['stages'][stage] = histogram.summary()
+            return {"since": self.since, "families": result}
+
+
+def test():
+    import random
+    metrics = KernelMetrics()
+    for i in range(10000):
+        timer = metrics.timer()
+        timer.api = random.choice(['api_call_base', 'api_call_slot_brand:华为', 'api_call_query_location_1'])
+        for stage in STAGES[:-1]:
+            timer.stages[stage] = random.expovariate(1.0 / 5)
+        metrics.record(timer, error=random.random() < 0.01)
+    start = time.time()
+    for i in range(10000):
+        timer = metrics.timer()
+        for stage in STAGES[:-1]:
+            timer.mark(stage)
+        timer.api = 'api_call_base'
+        metrics.record(timer)
+    print('overhead per request {0:.1f}us'.format((time.time() - start) / 10000 * 1e6))
+    for family, value in metrics.snapshot()['families'].items():
+        print(family, value['requests'], value['error_rate'], value['stages']['clf'])
+
+
+if __name__ == '__main__':
+    test()
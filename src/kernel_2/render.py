@@ -51,11 +51,9 @@ from utils.mongodb_client import Mongo
 from qa.iqa import Qa as QA
 from kernel_2.ad_kernel import AdKernel
 from kernel_2.rule_base_plugin import RuleBasePlugin
+from utils.log_util import setup_logging
 
-current_date = time.strftime("%Y.%m.%d")
-logging.basicConfig(handlers=[logging.FileHandler(os.path.join(grandfatherdir,
-                    'logs/log_corpus_' + current_date + '.log'), 'w', 'utf-8')],
-                    format='%(asctime)s %(message)s', datefmt='%Y.%m.%dT%H:%M:%S', level=logging.INFO)
+setup_logging()
 
 class Render:
 
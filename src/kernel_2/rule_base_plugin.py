@@ -32,6 +32,8 @@ import traceback
 import time
 import hashlib
 import re
+import functools
+import threading
 
 import numpy as np
 
@@ -45,66 +47,151 @@ import utils.solr_util as solr_util
 from qa.iqa import Qa as QA
 from kernel_2.ad_kernel import AdKernel
 from utils.mongodb_client import Mongo
-current_date = time.strftime("%Y.%m.%d")
-logging.basicConfig(handlers=[logging.FileHandler(os.path.join(grandfatherdir,
-                    'logs/log_corpus_' + current_date + '.log'), 'w', 'utf-8')],
-                    format='%(asctime)s %(message)s', datefmt='%Y.%m.%dT%H:%M:%S', level=logging.INFO)
+from utils.log_util import setup_logging, debug
+from utils.multi_replace import MultiReplacer
+
+setup_logging()
+
+REWRITE_PATTERN = re.compile(r'.*[查|找|搜].*[书].*')
+INTRODUCTION_PATTERNS = (re.compile(r'.*[介绍|了解].*[书店].*'),
+                         re.compile(r'.*[书店].*[介绍|了解].*'))
+BUY_PATTERN = re.compile(r'.*[买|卖|购].*')
+
+
+@functools.lru_cache(maxsize=4096)
+def _fix_values(api):
+    components = api.split('_')[-1]
+    return tuple(component.split(":")[1] for component in components.split(","))
+
+
+class RuleStats:
+    """
+    calls, hits and time per rule, kept across reloads
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rules = dict()  # name -> [calls, hits, seconds]
+
+    def record(self, name, hit, start):
+        elapsed = time.time() - start
+        with self.lock:
+            entry = self.rules.get(name)
+            if entry is None:
+                entry = self.rules[name] = [0, 0, 0.0]
+            entry[0] += 1
+            entry[1] += 1 if hit else 0
+            entry[2] += elapsed
+
+    def snapshot(self):
+        with self.lock:
+            return {name: {"calls": calls, "hits": hits,
+                           "mean_us": seconds / calls * 1e6 if calls else 0.0}
+                    for name, (calls, hits, seconds) in self.rules.items()}
+
+
+class RuleSet:
+    """
+    everything a request reads, compiled once and never changed afterwards;
+    a reload builds a new one
+    """
+
+    def __init__(self, key_words, noise_keywords, replacement, pre_replacement,
+                 api_list=('api_call_faq_info',), should_clear_list=('api_call_request_reg.complete',)):
+        self.api_list = tuple(api_list)
+        self.should_clear_list = frozenset(should_clear_list)
+        self.key_words = tuple(key_words)
+        # the first key word of the file found in q, as the linear scan did
+        self.key_word_automaton = MultiReplacer([(key, key) for key in self.key_words])
+        self.noise_keywords = frozenset(noise_keywords)
+        self.replacer = MultiReplacer(replacement)
+        self.pre_replacer = MultiReplacer(pre_replacement)
+
+    def find_key_word(self, q):
+        found = self.key_word_automaton.present(q)
+        return self.key_words[min(found)] if found else None
+
 
 class RuleBasePlugin:
 
     def __init__(self, config):
         self.mongdb = Mongo(ip='10.89.100.12', db_name='bookstore')
         self.config = config
-        self._load(config)
+        self.stats = RuleStats()
+        self.reload_lock = threading.Lock()
+        self.rules = self._load(config)
 
-    def reload(self):
-        self._load(self.config)
+    def reload(self, block=True):
+        """
+        builds the new rules in a thread next to the live ones and swaps them
+        in with one assignment; requests keep using the old rules meanwhile
+        """
+        errors = []  # of this reload only, concurrent reloads keep their own
+
+        def build():
+            with self.reload_lock:
+                try:
+                    self.rules = self._load(self.config)
+                except Exception as e:
+                    errors.append(e)
+                    traceback.print_exc()
+
+        thread = threading.Thread(target=build, daemon=True)
+        thread.start()
+        if block:
+            thread.join()
+            if errors:
+                raise errors[0]
+        return thread
 
     def _load(self, config):
-        self.api_list = ['api_call_faq_info']
-        self.should_clear_list = ['api_call_request_reg.complete']
-        self._load_key_word_file(config['key_word_file'])
-        self._load_noise_filter(config['noise_keyword_file'])
-        self._load_post_filter(config['machine_profile'])
-        # self._load_pre_filter(config['synonym'])
-        self._load_pre_filter()
+        return RuleSet(key_words=self._load_key_word_file(config['key_word_file']),
+                       noise_keywords=self._load_noise_filter(config['noise_keyword_file']),
+                       replacement=self._load_post_filter(config['machine_profile']),
+                       # pre_replacement=self._load_pre_filter(config['synonym'])
+                       pre_replacement=self._load_pre_filter())
 
     def _load_key_word_file(self, key_word_file):
-        self.key_words = []
+        key_words = []
         with open(key_word_file, 'r') as f:
             for line in f:
                 line = line.strip('\n')
-                self.key_words.append(line)
+                key_words.append(line)
+        return key_words
 
     def _load_noise_filter(self, noise_file):
-        self.noise_keywords = set()
+        noise_keywords = set()
         with open(noise_file, 'r') as f:
             for line in f:
                 line = line.strip('\n')
-                self.noise_keywords.add(line)
+                noise_keywords.add(line)
+        return noise_keywords
 
     def _load_post_filter(self, replace_file):
-        self.replacement = dict()
+        replacement = dict()
         with open(replace_file, 'r') as f:
             for line in f:
                 line = line.strip('\n')
                 a, b = line.split('#')
-                self.replacement[a] = b
+                replacement[a] = b
+        return replacement
 
     def _load_pre_filter(self):
-        self.pre_replacement = dict()
+        pre_replacement = dict()
         result_list = self.mongdb.search(field={'given': 1, '_id': 0, 'matched': 1},
                                     collection='synonym')
         for each_dict in result_list:
-            self.pre_replacement[each_dict['given']] = each_dict['matched']
+            pre_replacement[each_dict['given']] = each_dict['matched']
+        return pre_replacement
 
     # def _load_pre_filter(self, replace_file):
-    #     self.pre_replacement = dict()
+    #     pre_replacement = dict()
     #     with open(replace_file, 'r') as f:
     #         for line in f:
     #             line = line.strip('\n')
     #             a, b = line.split('#')
-    #             self.pre_replacement[a] = b
+    #             pre_replacement[a] = b
+    #     return pre_replacement
 
     def replace(self, q):
         """
@@ -112,10 +199,11 @@ class RuleBasePlugin:
         :param q:
         :return:
         """
-        for key, value in self.replacement.items():
-            q = q.replace(key, value)
-
-        return q
+        start = time.time()
+        # the entries in file order, as a loop of str.replace would apply them
+        replaced = self.rules.replacer.replace(q)
+        self.stats.record('replace', replaced != q, start)
+        return replaced
 
     def pre_replace(self, q):
         """
@@ -123,76 +211,81 @@ class RuleBasePlugin:
         :param q:
         :return:
         """
-        for key, value in self.pre_replacement.items():
-            q = q.replace(key, value)
-
-        return q
+        start = time.time()
+        replaced = self.rules.pre_replacer.replace(q)
+        self.stats.record('pre_replace', replaced != q, start)
+        return replaced
 
     def request_clear_memory(self, api, sess, belief_tracker):
-        if api.startswith('api_call_search') or api in self.should_clear_list:
+        if api.startswith('api_call_search') or api in self.rules.should_clear_list:
             sess.clear_memory(0)
             belief_tracker.clear_memory()
-            print('rule base cleared..')
+            debug('rule base cleared..')
 
     def filter(self, q):
-        if q in self.noise_keywords or len(q) <= 1:
+        start = time.time()
+        noise = q in self.rules.noise_keywords or len(q) <= 1
+        self.stats.record('filter', noise, start)
+        if noise:
             return ''
         return q
 
     def fix(self, q, api):
+        start = time.time()
+        rules = self.rules  # one ruleset for the whole call
         should_fix = False
-        for listed in self.api_list:
+        for listed in rules.api_list:
             if api.startswith(listed):
                 should_fix = True
                 break
         if not should_fix:
+            self.stats.record('fix', False, start)
             return api
 
-        components = api.split('_')[-1]
-        values = [component.split(":")[1] for component in components.split(",")]
+        values = _fix_values(api)
         if len(values) == 0:
+            self.stats.record('fix', False, start)
             return api
 
+        fixed = api
         for value in values:
             if value not in q:
-                key = self.find_key_word(q)
+                key = rules.find_key_word(q)
                 if key:
-                    api = api.replace(value, key)
-        return api
+                    fixed = fixed.replace(value, key)
+        self.stats.record('fix', fixed != api, start)
+        return fixed
 
     def find_key_word(self, q):
-        for key in self.key_words:
-            if key in q:
-                return key
-        return None
+        start = time.time()
+        key = self.rules.find_key_word(q)
+        self.stats.record('find_key_word', key is not None, start)
+        return key
 
     def rewrite(self,q):
-        pattern=r'.*[查|找|搜].*[书].*'
-        res1=re.findall(pattern,q)
-        print(res1)
-        if len(res1):
+        start = time.time()
+        match = REWRITE_PATTERN.search(q)
+        debug(match)
+        if match:
             qq=q+"在哪里"
         else:
             qq=q
+        self.stats.record('rewrite', match is not None, start)
         return qq
 
     def introduction(self,q):
-        pattern1=r'.*[介绍|了解].*[书店].*'
-        pattern2 = r'.*[书店].*[介绍|了解].*'
-        res1 = re.findall(pattern1, q)
-        res2 = re.findall(pattern2, q)
-
-        if len(res1) or len(res2):
+        start = time.time()
+        hit = any(pattern.search(q) for pattern in INTRODUCTION_PATTERNS)
+        if hit:
             q='我不太了解你们书店'
+        self.stats.record('introduction', hit, start)
         return q
 
     def check_buy(self,q):
-        pattern=r'.*[买|卖|购].*'
-        res=re.findall(pattern,q)
-        if len(res):
-            return True
-        else:
-            return False
+        start = time.time()
+        hit = BUY_PATTERN.search(q) is not None
+        self.stats.record('check_buy', hit, start)
+        return hit
 
 if __name__ == "__main__":
     config = {"belief_graph": "../../model/graph/belief_graph.pkl",
@@ -0,0 +1,392 @@
+"""
+Session Store
+
+Keeps the serialized DialogState of every user outside of the web process so
+that any worker (or node) can serve any user. A record is a compact pickle of
+plain python values (see DialogState.dump) and every save is checked against
+the version that was loaded, a concurrent write by another worker raises
+StaleSessionError instead of silently overwriting it.
+
+backends:
+    memory  in process dict, for a single worker
+    sqlite  file on local disk in WAL mode, shared by all workers of a box
+    shm     fixed size hash table in a memory mapped file under /dev/shm
+"""
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import time
+
+RECORD_FORMAT = 1
+
+
+class StaleSessionError(Exception):
+    pass
+
+
+def encode_record(state):
+    return pickle.dumps((RECORD_FORMAT, state), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_record(data):
+    fmt, state = pickle.loads(data)
+    if fmt != RECORD_FORMAT:
+        raise ValueError('unknown session record format {}'.format(fmt))
+    return state
+
+
+class SessionStore:
+    """
+    load(user) -> (record, version), (None, 0) for an unknown user
+    save(user, record, version) -> new version, raises StaleSessionError
+    if the stored version is no longer the one that was loaded
+    """
+
+    def load(self, user):
+        raise NotImplementedError
+
+    def save(self, user, record, version):
+        raise NotImplementedError
+
+    def delete(self, user):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+
+    def __init__(self):
+        self.records = dict()
+        self.lock = threading.Lock()
+
+    def load(self, user):
+        with self.lock:
+            return self.records.get(user, (None, 0))
+
+    def save(self, user, record, version):
+        with self.lock:
+            _, current = self.records.get(user, (None, 0))
+            if current != version:
+                raise StaleSessionError(user)
+            self.records[user] = (record, version + 1)
+            return version + 1
+
+    def delete(self, user):
+        with self.lock:
+            self.records.pop(user, None)
+
+
+class SqliteSessionStore(SessionStore):
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute('CREATE TABLE IF NOT EXISTS sessions '
+                             '(user TEXT PRIMARY KEY, version INTEGER NOT NULL, record BLOB NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def load(self, user):
+        row = self._conn().execute('SELECT record, version FROM sessions WHERE user=?',
+                                   (user,)).fetchone()
+        if row is None:
+            return None, 0
+        return bytes(row[0]), row[1]
+
+    def save(self, user, record, version):
+        conn = self._conn()
+        if version == 0:
+            cursor = conn.execute('INSERT OR IGNORE INTO sessions (user, version, record) VALUES (?, 1, ?)',
+                                  (user, sqlite3.Binary(record)))
+        else:
+            cursor = conn.execute('UPDATE sessions SET record=?, version=version+1 WHERE user=? AND version=?',
+                                  (sqlite3.Binary(record), user, version))
+        if cursor.rowcount != 1:
+            raise StaleSessionError(user)
+        return version + 1
+
+    def delete(self, user):
+        self._conn().execute('DELETE FROM sessions WHERE user=?', (user,))
+
+
+class ShmSessionStore(SessionStore):
+    """
+    open addressing hash table of fixed size slots in a memory mapped file,
+    shared by all processes mapping the same path. A slot is locked with
+    fcntl for other processes and with a striped lock for threads of this one.
+    A new user claims a slot with its whole probe window locked, so two new
+    users never take the same slot. When the window is full the least
+    recently written slot is reused, that eviction is counted and logged.
+    A record too large for a slot goes to the spill store, keyed by the key
+    hash, the slot then only holds the version.
+
+    slot layout: key hash u64 | written at f64 | version u32 | length u32 | record
+    """
+    SLOT_HEADER = struct.Struct('<QdII')
+    PROBE = 8
+    STRIPES = 64
+    SPILLED = 0xFFFFFFFF  # length of a slot whose record is in the spill store
+
+    def __init__(self, path='/dev/shm/memory_sessions', slots=65536, slot_size=4096, spill=None):
+        """
+        :param spill: SessionStore for records larger than a slot, they raise ValueError without one
+        """
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.spill = spill
+        self.spilled = 0  # writes of this process that went to the spill store
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o660)
+        size = slots * slot_size
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.locks = [threading.Lock() for _ in range(self.STRIPES)]
+        self.evictions = 0  # by this process
+
+    @staticmethod
+    def _hash(user):
+        # 0 marks an empty slot
+        return int.from_bytes(hashlib.sha1(user.encode('utf-8')).digest()[:8], 'little') or 1
+
+    def _header(self, slot):
+        return self.SLOT_HEADER.unpack_from(self.map, slot * self.slot_size)
+
+    def _lock(self, slot):
+        lock = self.locks[slot % self.STRIPES]
+        lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.slot_size, slot * self.slot_size)
+        return lock
+
+    def _unlock(self, slot, lock):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot_size, slot * self.slot_size)
+        lock.release()
+
+    def _lock_window(self, slots):
+        # in slot order, so concurrent claims never wait on each other in a cycle
+        return [(slot, self._lock(slot)) for slot in sorted(set(slots))]
+
+    def _unlock_window(self, locked):
+        for slot, lock in reversed(locked):
+            self._unlock(slot, lock)
+
+    def _probe(self, key):
+        start = key % self.slots
+        return [(start + i) % self.slots for i in range(self.PROBE)]
+
+    def _find(self, key):
+        for slot in self._probe(key):
+            if self._header(slot)[0] == key:
+                return slot
+        return None
+
+    def load(self, user):
+        key = self._hash(user)
+        slot = self._find(key)
+        if slot is None:
+            return None, 0
+        lock = self._lock(slot)
+        try:
+            stored, _, version, length = self._header(slot)
+            if stored != key:
+                return None, 0
+            if length == self.SPILLED:
+                record = self.spill.load(str(key))[0]
+                return (record, version) if record is not None else (None, 0)
+            offset = slot * self.slot_size + self.SLOT_HEADER.size
+            return bytes(self.map[offset:offset + length]), version
+        finally:
+            self._unlock(slot, lock)
+
+    def save(self, user, record, version):
+        if len(record) > self.slot_size - self.SLOT_HEADER.size and self.spill is None:
+            raise ValueError('session record of {} bytes exceeds slot size'.format(len(record)))
+        key = self._hash(user)
+        slot = self._find(key)
+        if slot is not None:
+            lock = self._lock(slot)
+            try:
+                stored, _, current, _ = self._header(slot)
+                if stored == key:
+                    if current != version:
+                        raise StaleSessionError(user)
+                    return self._write(slot, key, record, version)
+            finally:
+                self._unlock(slot, lock)
+            # evicted or deleted since _find
+        if version != 0:
+            raise StaleSessionError(user)
+        return self._claim(user, key, record)
+
+    def _claim(self, user, key, record):
+        window = self._probe(key)
+        locked = self._lock_window(window)
+        try:
+            headers = [(slot, self._header(slot)) for slot in window]
+            for slot, (stored, _, _, _) in headers:
+                if stored == key:
+                    # another worker created this user meanwhile
+                    raise StaleSessionError(user)
+            empty = [slot for slot, header in headers if header[0] == 0]
+            if empty:
+                slot = empty[0]
+            else:
+                slot, (evicted, _, _, length) = min(headers, key=lambda item: item[1][1])
+                self.evictions += 1
+                logging.warning('C@user:{}##session_evicted:slot {} reused, probe window full'.format(user, slot))
+                if length == self.SPILLED:
+                    self.spill.delete(str(evicted))
+            return self._write(slot, key, record, 0)
+        finally:
+            self._unlock_window(locked)
+
+    def _write(self, slot, key, record, version):
+        # called with the slot locked, which also serializes the spill writes of a key
+        offset = slot * self.slot_size
+        stored, _, _, length = self._header(slot)
+        was_spilled = stored == key and length == self.SPILLED
+        if len(record) > self.slot_size - self.SLOT_HEADER.size:
+            _, spill_version = self.spill.load(str(key))
+            self.spill.save(str(key), record, spill_version)
+            self.spilled += 1
+            length = self.SPILLED
+        else:
+            if was_spilled:
+                self.spill.delete(str(key))
+            self.map[offset + self.SLOT_HEADER.size:offset + self.SLOT_HEADER.size + len(record)] = record
+            length = len(record)
+        self.SLOT_HEADER.pack_into(self.map, offset, key, time.time(), version + 1, length)
+        return version + 1
+
+    def stats(self):
+        return {"slots": self.slots, "slot_size": self.slot_size, "evictions": self.evictions,
+                "spilled": self.spilled}
+
+    def delete(self, user):
+        key = self._hash(user)
+        slot = self._find(key)
+        if slot is None:
+            return
+        lock = self._lock(slot)
+        try:
+            stored, _, _, length = self._header(slot)
+            if stored == key:
+                if length == self.SPILLED:
+                    self.spill.delete(str(key))
+                self.SLOT_HEADER.pack_into(self.map, slot * self.slot_size, 0, 0.0, 0, 0)
+        finally:
+            self._unlock(slot, lock)
+
+
+def create_store(config):
+    """
+    config['session_store']: None/'off', 'memory', 'sqlite' or 'shm'
+    config['session_store_path']: file for sqlite and shm, shm spills records
+    larger than a slot to a sqlite file next to it
+    """
+    kind = config.get('session_store')
+    if not kind or kind == 'off':
+        return None
+    if kind == 'memory':
+        return MemorySessionStore()
+    if kind == 'sqlite':
+        return SqliteSessionStore(config.get('session_store_path', '/tmp/memory_sessions.db'))
+    if kind == 'shm':
+        path = config.get('session_store_path', '/dev/shm/memory_sessions')
+        return ShmSessionStore(path, spill=SqliteSessionStore(path + '.spill.db'))
+    raise ValueError('unknown session store ' + kind)
+
+
+def test():
+    import tempfile
+    record = encode_record(({'category': '空调', 'price': '[2700 TO 3300]'}, ['brand'],
+                            'api_request_state', 'node-id', {}, {'brand': ['美的', '格力']},
+                            {}, {}, {}, True, 0, [['PAD'], ['空调']]))
+    tmp = tempfile.mkdtemp()
+    stores = [MemorySessionStore(), SqliteSessionStore(os.path.join(tmp, 's.db')),
+              ShmSessionStore(os.path.join(tmp, 'shm'), slots=1024)]
+    for store in stores:
+        assert store.load('u') == (None, 0)
+        version = store.save('u', record, 0)
+        assert store.load('u') == (record, version)
+        try:
+            store.save('u', record, 0)
+            raise AssertionError('stale write accepted by ' + type(store).__name__)
+        except StaleSessionError:
+            pass
+        start = time.time()
+        n = 2000
+        for i in range(n):
+            data, version = store.load('u')
+            version = store.save('u', data, version)
+        print(type(store).__name__, len(record), 'bytes', 'load+save {0:.1f}us'.format(
+            (time.time() - start) / n * 1e6))
+        store.delete('u')
+        assert store.load('u') == (None, 0)
+
+    # a context past the slot size is spilled, not refused
+    store = ShmSessionStore(os.path.join(tmp, 'spill'), slots=64,
+                            spill=SqliteSessionStore(os.path.join(tmp, 'spill.db')))
+    big = encode_record([['token{}'.format(i)] for i in range(2000)])
+    version = store.save('big', big, 0)
+    assert store.load('big') == (big, 1)
+    version = store.save('big', record, version)
+    assert store.load('big') == (record, 2) and store.spill.load(str(store._hash('big'))) == (None, 0)
+    store.save('big', big, version)
+    store.delete('big')
+    assert store.load('big') == (None, 0) and store.spill.load(str(store._hash('big'))) == (None, 0)
+    assert store.stats()['spilled'] == 2
+
+    # new users racing for the slots of one probe window, from threads and
+    # processes: none of them may lose its session
+    path = os.path.join(tmp, 'race')
+    store = ShmSessionStore(path, slots=ShmSessionStore.PROBE)
+    users = ['user{}'.format(i) for i in range(ShmSessionStore.PROBE)]
+
+    def save_new(names):
+        other = ShmSessionStore(path, slots=ShmSessionStore.PROBE)
+        for name in names:
+            other.save(name, name.encode('utf-8'), 0)
+
+    threads = [threading.Thread(target=save_new, args=([u],)) for u in users[:4]]
+    pids = []
+    for u in users[4:]:
+        pid = os.fork()
+        if pid == 0:
+            save_new([u])
+            os._exit(0)
+        pids.append(pid)
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for pid in pids:
+        assert os.waitpid(pid, 0)[1] == 0
+    for u in users:
+        assert store.load(u) == (u.encode('utf-8'), 1), u
+    try:
+        store.save(users[0], b'again', 0)
+        raise AssertionError('second creation of a user accepted')
+    except StaleSessionError:
+        pass
+    # a full window evicts the oldest session and says so
+    store.save('late', b'late', 0)
+    assert store.evictions == 1 and store.load('late') == (b'late', 1)
+    assert [store.load(u)[0] is None for u in users].count(True) == 1
+    print('shm session store race test passed', store.stats())
+
+
+if __name__ == '__main__':
+    test()
@@ -44,6 +44,12 @@ class Memn2nSession():
             self.context = self.context[-history:]
         self.nid = 1
 
+    def dump_context(self):
+        return [list(tokens) for tokens in self.context]
+
+    def load_context(self, context):
+        self.context = [list(tokens) for tokens in context]
+
     def append_memory(self, m):
         if not m:
             return
@@ -1,89 +1,298 @@
-import requests
+"""
+Base Kernel
+
+The third party chat api, the last resort of web_2.chat. Every call has a
+hard deadline, at most max_concurrent calls are in flight, and a circuit
+breaker stops calling a failing upstream for reset_timeout seconds; in all
+those cases the canned answer is returned right away, so a slow upstream
+never holds a flask thread longer than the deadline. Answers are kept in a
+ttl lru. The transport is pluggable, HttpTransport posts to the api.
+"""
 import json
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
 import numpy as np
-import schedule, time
+import requests
 
-from lru import LRU
-from threading import Thread
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
 
-'''
-import schedule
-import time
+from utils.ttl_cache import TTLCache
+
+API_URL = "http://idc.emotibot.com/api/ApiKey/openapi.php"
+CANNED = 'base kernel is detached'
+DEADLINE = 1.5  # seconds
+MAX_CONCURRENT = 8
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+CACHE_SIZE = 300
+CACHE_TTL = 3600  # the cache used to be cleared every hour
+
+
+class HttpTransport:
+    """
+    params -> parsed json of the api
+    """
+
+    def __init__(self, url=API_URL, connect_timeout=0.5):
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.session = requests.Session()
+
+    def __call__(self, params, timeout):
+        r = self.session.post(self.url, params=params, timeout=(min(self.connect_timeout, timeout), timeout))
+        r.raise_for_status()
+        return r.json()
+
+
+class CircuitBreaker:
+    """
+    closed -> open after failure_threshold failures in a row, open -> half
+    open after reset_timeout, where one trial call closes or opens it again
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial = False
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial = False
+            if self.state == self.HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            return False
 
-def job():
-    print("I'm working...")
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial = False
 
-schedule.every(10).minutes.do(job)
-schedule.every().hour.do(job)
-schedule.every().day.at("10:30").do(job)
-schedule.every(5).to(10).minutes.do(job)
-schedule.every().monday.do(job)
-schedule.every().wednesday.at("13:15").do(job)
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self.trial = False
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
-'''
 
 class BaseKernel:
     appid = "841e6cd456e05713213f413e8765648e"
     user_ids = np.array(['0112DBCD5299791D5A53287D27F4E18A5',
                          '0480704B8A3471FF360DD22AB5C3D9F8E',
                          '09B78AFBFCF3F97F34F12F945769FBD8B'])
-    def __init__(self):
+
+    def __init__(self, transport=None, deadline=DEADLINE, max_concurrent=MAX_CONCURRENT,
+                 failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT,
+                 cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL, canned=CANNED):
         # if not self.user_ids or self.user_ids.size == 0:
         #     self.uid = self.register()
         # else:
         self.uid = self.user_ids[1]#np.random.choice(self.user_ids, 1)[0]
-        self.cache = LRU(300)
-        # thread = Thread(target=self.schedule)
-        # thread.start()
+        self.transport = transport
+        self.deadline = deadline
+        self.max_concurrent = max_concurrent
+        self.canned = canned
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.pool = None  # created on the first call, most kernels never call out
+        self.lock = threading.Lock()
+        self.counts = {"calls": 0, "ok": 0, "timeouts": 0, "errors": 0, "rejected": 0, "open": 0}
 
     def kernel(self, q):
-        # if q in self.cache:
-        #     return self.cache[q]
+        answer = self.cache.get(q)
+        if answer is not None:
+            return answer
         answer = self.chat(q)
-        # self.cache[q] = answer
+        if answer and answer != self.canned:
+            self.cache.set(q, answer)
         return answer
 
     def register(self):
         register_data = {"cmd": "register", "appid": self.appid}
-        url = "http://idc.emotibot.com/api/ApiKey/openapi.php"
-        r = requests.post(url, params=register_data)
+        r = requests.post(API_URL, params=register_data, timeout=self.deadline)
         response = json.dumps(r.json(), ensure_ascii=False)
         jsondata = json.loads(response)
         datas = jsondata.get('data')
         for data in datas:
             return data.get('value')
 
+    def _count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def _call(self, q):
+        if self.transport is None:
+            self.transport = HttpTransport()
+        register_data = {"cmd": "chat", "appid": self.appid, "userid": self.uid, "text": q,
+                         "location": "南京"}
+        jsondata = self.transport(register_data, self.deadline)
+        response = json.dumps(jsondata, ensure_ascii=False)
+        datas = jsondata.get("data")
+        for data in datas:
+            response = data.get('value')
+            if response:
+                break
+        return response
+
     def chat(self, q):
+        self._count('calls')
+        # the slot first, a half open breaker gives its single trial only to
+        # a call that will really go out
+        if not self.slots.acquire(blocking=False):
+            # a full house means the upstream is slow already, do not queue behind it
+            self._count('rejected')
+            return self.canned
+        if not self.breaker.allow():
+            self.slots.release()
+            self._count('open')
+            return self.canned
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.max_concurrent)
+        future = self.pool.submit(self._call, q)
+        # the slot is held until the call really ends, not only until the deadline
+        future.add_done_callback(lambda _: self.slots.release())
         try:
-            register_data = {"cmd": "chat", "appid": self.appid, "userid": self.uid, "text": q,
-                             "location": "南京"}
-            url = "http://idc.emotibot.com/api/ApiKey/openapi.php"
-            r = requests.post(url, params=register_data)
-            response = json.dumps(r.json(), ensure_ascii=False)
-            jsondata = json.loads(response)
-            datas = jsondata.get("data")
-            for data in datas:
-                response = data.get('value')
-                if response:
-                    break
-            return response
+            response = future.result(timeout=self.deadline)
+        except TimeoutError:
+            self._count('timeouts')
+            self.breaker.failure()
+            return self.canned
         except Exception:
-            return 'base kernel is detached'
+            self._count('errors')
+            self.breaker.failure()
+            return self.canned
+        self._count('ok')
+        self.breaker.success()
+        return response
 
     def clear_cache(self):
         print('clear')
         self.cache.clear()
 
-    def schedule(self):
-        schedule.every().hour.do(self.clear_cache)
-        while True:
-            schedule.run_pending()
-            time.sleep(60)
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats['breaker'] = self.breaker.state
+        stats['cache'] = self.cache.stats()
+        return stats
+
+
+def stub_server(delay=0.0, fail=False):
+    """
+    a local stand in for the chat api, (server, url); delay and fail can be
+    changed on server while it runs
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            pass  # clients past their deadline hang up on a slow reply
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            time.sleep(self.server.delay)
+            if self.server.fail:
+                self.send_response(500)
+                self.end_headers()
+                return
+            text = parse_qs(urlparse(self.path).query).get('text', [''])[0]
+            body = json.dumps({"return": 0, "data": [{"type": "text", "value": 'echo ' + text}]},
+                              ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.delay = delay
+    server.fail = fail
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/api'.format(server.server_address[1])
+
+
+def test():
+    server, url = stub_server()
+    bk = BaseKernel(transport=HttpTransport(url), deadline=0.2, max_concurrent=4,
+                    failure_threshold=3, reset_timeout=0.5)
+    assert bk.kernel('你好') == 'echo 你好'
+    assert bk.kernel('你好') == 'echo 你好' and bk.stats()['calls'] == 1
+    # a degraded upstream, chat still answers within the deadline
+    server.delay = 1.0
+    latencies = []
+    for i in range(20):
+        start = time.time()
+        bk.kernel('q{}'.format(i))
+        latencies.append(time.time() - start)
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print('p99 with a slow upstream {0:.0f}ms'.format(p99 * 1000), bk.stats())
+    assert p99 < 0.3, p99
+    assert bk.breaker.state == CircuitBreaker.OPEN
+    # recovered, the half open trial closes the breaker again
+    server.delay = 0.0
+    time.sleep(1.2)
+    assert bk.kernel('再见') == 'echo 再见', bk.stats()
+    assert bk.breaker.state == CircuitBreaker.CLOSED
+    server.fail = True
+    for i in range(3):
+        assert bk.kernel('e{}'.format(i)) == CANNED
+    assert bk.breaker.state == CircuitBreaker.OPEN
+    server.shutdown()
+    # the trial of a half open breaker is not lost to a call rejected for a
+    # slot still held by a timed out call
+    delay = [1.0]
+
+    def transport(params, timeout):
+        time.sleep(delay[0])  # ignores the timeout, as a hung connection does
+        return {"data": [{"value": 'echo ' + params['text']}]}
+
+    bk = BaseKernel(transport=transport, deadline=0.05, max_concurrent=1,
+                    failure_threshold=1, reset_timeout=0.1)
+    assert bk.kernel('slow') == CANNED and bk.breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.2)
+    assert bk.kernel('held') == CANNED and bk.stats()['rejected'] == 1
+    assert bk.breaker.state == CircuitBreaker.OPEN and not bk.breaker.trial
+    delay[0] = 0.0
+    time.sleep(1.0)
+    assert bk.kernel('back') == 'echo back', bk.stats()
+    assert bk.breaker.state == CircuitBreaker.CLOSED
+    print('base kernel test passed')
+
 
 if __name__ == '__main__':
+    if '--test' in sys.argv:
+        test()
+        sys.exit(0)
     bk = BaseKernel()
     # bk.register()
-    print(bk.kernel(u'吴中万达有6楼吗'))
\ No newline at end of file
+    print(bk.kernel(u'吴中万达有6楼吗'))
@@ -2,30 +2,32 @@ import numpy as np
 import sys
 import os
 import requests
+import traceback
 
-import schedule, time
-import pylru
 
 parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, parentdir)
 
 from utils.query_util import tokenize
-from utils.solr_util import solr_qa
+from utils.solr_util import solr_qa_async
+from utils.log_util import debug
 from utils.embedding_util import ff_embedding, mlt_ff_embedding
 from qa.base import BaseKernel
 
-from lru import LRU
-from threading import Thread
-
 from amq.sim import BenebotSim
-from dmn.dmn_fasttext.vector_helper import computeSentenceSim
-CACHE_SIZE = 50 #2017/12/26 设置缓存大小
+from dmn.dmn_fasttext.vector_helper import mostSimilar
+from qa.vector_index import VectorIndex, INDEX_DIR
+from qa.qa_cache import QaCache
+from utils.single_flight import SingleFlight
+
 
 class Qa:
 
     static_bt = None
-    cache = pylru.lrucache(CACHE_SIZE)
+    cache = QaCache()  # shared by all Qa, namespaced by (core, cls)
     THRESHOLD = 0.90
+    indexes = dict()  # core -> VectorIndex, shared by all Qa of a core
+    flight = SingleFlight()  # identical lookups in flight, by the cache key (core, cls, query)
 
     def __init__(self, core, question_key='question', answer_key='answer'):
         self.core = core
@@ -33,6 +35,7 @@ class Qa:
         self.answer_key = answer_key
         self.base = BaseKernel()
         self.REACH = 1
+        self.index = Qa.load_index(core)
 
         # if Qa.static_bt:
         #     self.bt = Qa.static_bt
@@ -40,23 +43,34 @@ class Qa:
         #     self.bt = BenebotSim()
         #     Qa.static_bt = self.bt
 
-        # self.schedule()
-        thread = Thread(target=self.schedule)
-        thread.start()
-        # thread.join()
         # self.solr_addr = solr_addr
 
     def get_responses(self, query, user='solr', cls=''):
-        if query in self.cache:
-            best_query = self.cache[query]['query']
-            best_answer = np.random.choice(self.cache[query]['answer'])
-            best_score = self.cache[query]['score']
-            best_doc = self.cache[query]['doc']
-            return best_query, best_answer, best_score, best_doc
-        docs = solr_qa(self.core, query, field=self.question_key + '_str', cls=cls)
+        cached = self.cache.get(self.core, cls, query)
+        if not cached:
+            # users asking the same at the same moment share one lookup
+            # keyed as the cache and the exact solr lookup are, by the query as it is
+            cached = Qa.flight.do((self.core, cls, query), self.lookup, query, cls)
+        # every caller draws its own answer of the entry
+        return cached['query'], np.random.choice(cached['answer']), cached['score'], cached['doc']
+
+    def lookup(self, query, cls=''):
+        """
+        the cache entry {"query", "answer", "score", "doc"} of a query, cached
+        """
+        if self.index:
+            try:
+                return self.index_responses(query, cls)
+            except Exception:
+                traceback.print_exc()
+        # exact and text lookup are sent together, the text one is only used on an exact miss
+        exact = solr_qa_async(self.core, query, field=self.question_key + '_str', cls=cls)
+        fuzzy = solr_qa_async(self.core, query, field=self.question_key, cls=cls)
+        docs = exact.result().docs
         if len(docs) == 0:
-            docs = solr_qa(self.core, query, field=self.question_key, cls=cls)
+            docs = fuzzy.result().docs
         else:
+            fuzzy.cancel()
             doc = np.random.choice(docs)
             best_query = doc[self.question_key]
             best_answer = doc[self.answer_key]
@@ -65,8 +79,8 @@ class Qa:
             if 'uid' not in best_doc:
                 best_doc['uid'] = 'uid_not_defined'
             cached = {"query": best_query, "answer": best_answer, "score": best_score, "doc": best_doc}
-            self.cache[query] = cached
-            return best_query, np.random.choice(best_answer), best_score, best_doc
+            self.cache.put(self.core, cls, query, cached)
+            return cached
 
         # docs = solr_qa(self.core, query, self.question_key)
         # print(docs)
@@ -74,44 +88,70 @@ class Qa:
         best_answer = None
         best_score = -1
         best_doc = {'uid': "third_party"}
-        for index, doc in enumerate(docs):
-            if index > 10:
-                break
-            b = doc[self.answer_key]
-            g = doc[self.question_key]
-            # for _g in g:
-            #     score = self.similarity(query, _g)
-            #     if score > best_score:
-            #         best_score = score
-            #         best_query = _g
-            #         best_answer = b
-            #         if score >= REACH:
-            #             break
-            # score, _g = self.m_similarity(query, g)
-            score, _g = self.w2v_local_similarity(query, g)
-            if score > best_score:
-                best_score = score
-                best_query = _g
-                best_answer = b
-                best_doc = doc
-                if 'uid' not in best_doc:
-                    best_doc['uid'] = 'uid_not_defined'
-            # if score >= REACH:
-            #     break
-            # print(score)
+        # all paraphrases of the first 11 docs in one similarity call,
+        # the first of equal scores wins as in a doc by doc loop
+        candidates = []
+        owners = []
+        for index, doc in enumerate(docs[:11]):
+            for t in doc[self.question_key]:
+                candidates.append(tokenize(t, 3))
+                owners.append(doc)
+        score, i = mostSimilar(tokenize(query, 3), candidates)
+        if score > best_score:
+            best_score = score
+            best_query = candidates[i]
+            best_doc = owners[i]
+            best_answer = best_doc[self.answer_key]
+            if 'uid' not in best_doc:
+                best_doc['uid'] = 'uid_not_defined'
 
+        return self.threshold(query, best_query, best_answer, best_score, best_doc, cls)
+
+    @staticmethod
+    def load_index(core):
+        """
+        index exported by qa/vector_index.py to model/qa/<core>, None without one
+        """
+        if core not in Qa.indexes:
+            prefix = os.path.join(INDEX_DIR, core)
+            Qa.indexes[core] = VectorIndex.load(prefix) if VectorIndex.exists(prefix) else None
+        return Qa.indexes[core]
+
+    def index_responses(self, query, cls=''):
+        """
+        same entries as the solr path, from the local index
+        """
+        docs = self.index.exact(query, cls)
+        if docs:
+            doc = docs[np.random.randint(len(docs))]
+            cached = {"query": doc[self.question_key], "answer": doc[self.answer_key], "score": 1, "doc": doc}
+            self.cache.put(self.core, cls, query, cached)
+            return cached
+        best_query = None
+        best_answer = None
+        best_score = -1
+        best_doc = {'uid': "third_party"}
+        found = self.index.search(tokenize(query, 3), cls)
+        # nan scores never beat -1 in the solr path, the index leaves them out
+        if found and found[0] > best_score:
+            best_score, best_query, best_doc = found
+            best_answer = best_doc[self.answer_key]
+        return self.threshold(query, best_query, best_answer, best_score, best_doc, cls)
+
+    def threshold(self, query, best_query, best_answer, best_score, best_doc, cls=''):
         if best_score < self.THRESHOLD:
-            print('redirecting to third party', best_score)
+            debug('redirecting to third party', best_score)
             # answer = self.base.kernel(query)
             answer = 'null'
             cached = {"query": query, "answer": [answer], "score": best_score, "doc":best_doc}
-            # self.cache[query] = cached
-            return query, answer, best_score, best_doc
+            # short lived, the third party answer is not ours to keep
+            self.cache.put(self.core, cls, query, cached, negative=True)
+            return cached
             # return query, 'api_call_base', best_score
         else:
             cached = {"query": best_query, "answer": best_answer, "score": best_score, "doc": best_doc}
-            self.cache[query] = cached
-            return best_query, np.random.choice(best_answer), best_score, best_doc
+            self.cache.put(self.core, cls, query, cached)
+            return cached
 
     def embed(self, tokens):
         embeddings = [ff_embedding(word) for word in tokens]
@@ -148,23 +188,13 @@ class Qa:
         tokens1 = tokenize(query1, 3)
         tokens2 = [tokenize(t, 3) for t in query2]
 
-        max_sim = -10
-        _g = query2[0]
-        for words2 in tokens2:
-            sim = computeSentenceSim(tokens1, words2)
-            if sim > max_sim:
-                max_sim = sim
-                _g = words2
-        return float(max_sim), _g
+        max_sim, i = mostSimilar(tokens1, tokens2)
+        if i < 0:
+            return float(max_sim), query2[0]
+        return float(max_sim), tokens2[i]
 
     def clear_cache(self):
-        self.cache.clear()
-
-    def schedule(self):
-        schedule.every().day.at("01:00").do(self.clear_cache)
-        while True:
-            schedule.run_pending()
-            time.sleep(60)
+        self.cache.invalidate(core=self.core)
 
 def test():
     query1 = '我的名字是小明'
@@ -0,0 +1,94 @@
+"""
+Qa Cache
+
+Answers of Qa.get_responses, namespaced by (core, cls) so cores and classes
+never see each other's entries. Misses below the threshold are cached too,
+with a short ttl, so third party queries do not hit solr every time. Entries
+are indexed by doc uid, an update of a doc in solr can drop exactly the
+answers built from it.
+"""
+import threading
+
+from utils.ttl_cache import TTLCache
+
+CACHE_SIZE = 5000
+TTL = 24 * 3600  # the old cache was flushed once a day
+NEGATIVE_TTL = 60
+
+
+class QaCache:
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=TTL, negative_ttl=NEGATIVE_TTL):
+        self.negative_ttl = negative_ttl
+        self.by_uid = dict()  # uid -> keys
+        self.uid_lock = threading.Lock()
+        self.cache = TTLCache(max_size, ttl, on_remove=self._removed)
+
+    @staticmethod
+    def _uid(entry):
+        doc = entry.get('doc') or {}
+        return doc.get('uid')
+
+    def _removed(self, key, entry):
+        uid = self._uid(entry)
+        with self.uid_lock:
+            keys = self.by_uid.get(uid)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.by_uid[uid]
+
+    def get(self, core, cls, query):
+        """
+        {"query", "answer", "score", "doc"} or None
+        """
+        return self.cache.get((core, cls, query))
+
+    def put(self, core, cls, query, entry, negative=False):
+        key = (core, cls, query)
+        uid = self._uid(entry)
+        # under the cache lock, an invalidate_uid never sees the entry unindexed;
+        # a replaced entry leaves the index of its own uid through _removed
+        with self.cache.lock:
+            self.cache.set(key, entry, ttl=self.negative_ttl if negative else None)
+            if uid:
+                with self.uid_lock:
+                    self.by_uid.setdefault(uid, set()).add(key)
+
+    def invalidate_uid(self, uid):
+        with self.cache.lock:
+            with self.uid_lock:
+                keys = list(self.by_uid.get(uid, ()))
+            for key in keys:
+                self.cache.pop(key)
+        return len(keys)
+
+    def invalidate(self, core=None, cls=None):
+        """
+        drops a namespace, everything of a core when cls is None
+        """
+        return self.cache.purge(lambda key, _: (core is None or key[0] == core)
+                                and (cls is None or key[1] == cls))
+
+    def configure(self, max_size=None, ttl=None, negative_ttl=None):
+        if negative_ttl is not None:
+            self.negative_ttl = negative_ttl
+        self.cache.resize(max_size, ttl)
+
+    def clear(self):
+        self.cache.clear()
+
+    def keys(self):
+        """
+        cached queries
+        """
+        return [key[2] for key in self.cache.keys()]
+
+    def __len__(self):
+        return len(self.cache)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['negative_ttl'] = self.negative_ttl
+        stats['uids'] = len(self.by_uid)
+        return stats
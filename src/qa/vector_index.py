@@ -0,0 +1,230 @@
+"""
+Vector Index
+
+Local retrieval for Qa. Every paraphrase of every doc of a qa core is
+embedded once (mean word vector of tokenize(p, 3), as computeSentenceSim
+does) into an L2 normalized float32 matrix, so scoring a query against the
+whole core is one matrix-vector product. Paraphrases whose vector is zero are
+left out, their cosine is nan and never wins in w2v_local_similarity either.
+
+exact()  replaces the question_str lookup, search() the question lookup plus
+w2v_local_similarity. With nlist > 0 an IVF (k-means coarse quantizer) only
+scores the rows of the nprobe closest lists, for large cores.
+
+    python qa/vector_index.py --core base --out model/qa/base
+"""
+import argparse
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+grandfatherdir = os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, parentdir)
+
+from utils.query_util import tokenize
+
+INDEX_DIR = os.path.join(grandfatherdir, 'model/qa')
+DOC_FIELDS = ('uid', 'emotion', 'media', 'class')
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def sentence_vectors(token_lists):
+    """
+    float32 (n, dim), unnormalized, see vector_helper.getSentenceVectors
+    """
+    from dmn.dmn_fasttext.vector_helper import getSentenceVectors
+    return getSentenceVectors(token_lists, cache=False)
+
+
+class VectorIndex:
+
+    def __init__(self, question_key='question', answer_key='answer', nlist=0, nprobe=8):
+        self.question_key = question_key
+        self.answer_key = answer_key
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.docs = []  # minimal doc dicts as Qa returns them
+        self.doc_cls = []  # set of classes per doc
+        self.exact_map = dict()  # paraphrase string -> doc ids
+        self.vectors = None  # (rows, dim) normalized
+        self.row_doc = None  # (rows,) doc id
+        self.row_tokens = []  # tokens of the paraphrase of a row
+        self.centroids = None
+        self.lists = None
+        self._cls_masks = dict()
+
+    def build(self, docs):
+        token_lists = []
+        row_doc = []
+        for doc in docs:
+            questions = _as_list(doc.get(self.question_key))
+            answers = _as_list(doc.get(self.answer_key))
+            if not questions or not answers:
+                continue
+            doc_id = len(self.docs)
+            kept = {self.question_key: questions, self.answer_key: answers}
+            for field in DOC_FIELDS:
+                if field in doc:
+                    kept[field] = doc[field]
+            if 'uid' not in kept:
+                kept['uid'] = 'uid_not_defined'
+            self.docs.append(kept)
+            self.doc_cls.append(frozenset(_as_list(doc.get('class'))))
+            for question in questions:
+                self.exact_map.setdefault(question, []).append(doc_id)
+                token_lists.append(tokenize(question, 3))
+                row_doc.append(doc_id)
+        vectors = sentence_vectors(token_lists) if token_lists else np.zeros((0, 1), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1) if len(vectors) else np.zeros(0)
+        keep = np.isfinite(norms) & (norms > 0)
+        self.vectors = np.ascontiguousarray(vectors[keep] / norms[keep, np.newaxis], dtype=np.float32)
+        self.row_doc = np.asarray(row_doc, dtype=np.int32)[keep] if row_doc else np.zeros(0, dtype=np.int32)
+        self.row_tokens = [tokens for tokens, k in zip(token_lists, keep) if k]
+        if self.nlist:
+            self._train_ivf()
+        return self
+
+    def _train_ivf(self, iterations=10, seed=0):
+        n = len(self.vectors)
+        nlist = min(self.nlist, n)
+        if nlist < 2:
+            self.centroids = None
+            return
+        rng = np.random.RandomState(seed)
+        centroids = self.vectors[rng.choice(n, nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(self.vectors.dot(centroids.T), axis=1)
+            for c in range(nlist):
+                members = self.vectors[assign == c]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    norm = np.linalg.norm(centroid)
+                    if norm > 0:
+                        centroids[c] = centroid / norm
+        assign = np.argmax(self.vectors.dot(centroids.T), axis=1)
+        self.centroids = centroids.astype(np.float32)
+        self.lists = [np.flatnonzero(assign == c).astype(np.int32) for c in range(nlist)]
+
+    def _cls_mask(self, cls):
+        mask = self._cls_masks.get(cls)
+        if mask is None:
+            doc_mask = np.asarray([cls in classes for classes in self.doc_cls], dtype=bool)
+            mask = doc_mask[self.row_doc] if len(self.row_doc) else np.zeros(0, dtype=bool)
+            self._cls_masks[cls] = mask
+        return mask
+
+    def exact(self, query, cls=''):
+        """
+        docs having query as one of their paraphrases, like question_str:query
+        """
+        ids = self.exact_map.get(query, [])
+        return [self.docs[i] for i in ids if not cls or cls in self.doc_cls[i]]
+
+    def query_vector(self, tokens):
+        vector = sentence_vectors([tokens])[0]
+        norm = np.linalg.norm(vector)
+        if not np.isfinite(norm) or norm == 0:
+            return None
+        return vector / norm
+
+    def search(self, tokens, cls=''):
+        """
+        best paraphrase over the core
+        :return: (score, paraphrase tokens, doc) or None when nothing is comparable
+        """
+        if not len(self.vectors):
+            return None
+        q = self.query_vector(tokens)
+        if q is None:
+            return None
+        if self.centroids is not None:
+            probes = np.argsort(-self.centroids.dot(q))[:self.nprobe]
+            rows = np.concatenate([self.lists[c] for c in probes])
+            if cls:
+                rows = rows[self._cls_mask(cls)[rows]]
+            if not len(rows):
+                return None
+            rows.sort()  # first row wins a tie, as in the exact mode
+            scores = self.vectors[rows].dot(q)
+            best = rows[int(np.argmax(scores))]
+            score = float(scores.max())
+        else:
+            scores = self.vectors.dot(q)
+            if cls:
+                mask = self._cls_mask(cls)
+                if not mask.any():
+                    return None
+                scores = np.where(mask, scores, -np.inf)
+            best = int(np.argmax(scores))
+            score = float(scores[best])
+        return score, self.row_tokens[best], self.docs[self.row_doc[best]]
+
+    def save(self, prefix):
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        np.save(prefix + '.npy', self.vectors)
+        state = dict(self.__dict__)
+        del state['vectors']
+        state['_cls_masks'] = dict()
+        with open(prefix + '.pkl', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(prefix):
+        index = VectorIndex()
+        with open(prefix + '.pkl', 'rb') as f:
+            index.__dict__.update(pickle.load(f))
+        index.vectors = np.load(prefix + '.npy', mmap_mode='r')
+        return index
+
+    @staticmethod
+    def exists(prefix):
+        return os.path.exists(prefix + '.npy') and os.path.exists(prefix + '.pkl')
+
+
+def solr_docs(core, rows=1000):
+    """
+    all docs of a core, paged by start
+    """
+    from utils.solr_util import solr
+    start = 0
+    while True:
+        docs = solr.query(core, {'q': '*:*', 'rows': rows, 'start': start, 'sort': 'id asc'}).docs
+        for doc in docs:
+            yield doc
+        if len(docs) < rows:
+            return
+        start += rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--core', default='base')
+    parser.add_argument('--out', default=None, help='index prefix, model/qa/<core> by default')
+    parser.add_argument('--nlist', type=int, default=0, help='ivf lists, 0 for exact search')
+    args = parser.parse_args()
+    start = time.time()
+    index = VectorIndex(nlist=args.nlist).build(solr_docs(args.core))
+    index.save(args.out or os.path.join(INDEX_DIR, args.core))
+    print('indexed', len(index.docs), 'docs,', len(index.row_tokens), 'paraphrases in',
+          '{0:.1f}s'.format(time.time() - start))
+    tokens = tokenize('你叫什么名字', 3)
+    start = time.time()
+    for _ in range(100):
+        result = index.search(tokens)
+    print(result[:2] if result else None, '{0:.3f}ms per search'.format((time.time() - start) * 10))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,596 @@
+"""
+Catalog Engine
+
+The product catalog (category, bookstore_map) is small and changes slowly,
+so the facet queries of solr_util can be answered in process. Each core is
+kept column by column: the values of a field are dictionary encoded, a
+single valued field as one code per doc, a multi valued one as a bitmap per
+value, and numeric values also as a float array. A compose_fq filter is
+parsed with the lucene classic rules of solr_gateway.parse_fq and evaluated
+with bitmap ops, facets, sort and range buckets follow solr (and FakeSolr).
+
+CatalogEngine is a backend like SolrGateway: queries it can not answer (an
+unknown core, a text query, an unsupported param) or every query while
+enabled is False go to the fallback, the solr it was put in front of.
+
+Supported fields: string fields (solr StrField, facet_*_str) match a filter
+value exactly, numeric fields (int, long, float, double, point or trie)
+match exactly and in ranges, both single or multi valued. Analyzed text
+fields are not: a field:value filter on one is compared as an exact string
+here, while solr matches the tokens, so a core filtered on text fields must
+stay on solr. Before enabling the engine in web_2, replay logged queries
+against the live cores:
+
+    python utils/catalog_engine.py --compare http://localhost:11403/solr --queries logs/solr_queries.jsonl
+
+the queries are written by QueryLog (web_2 config "solr_query_log").
+
+    import utils.solr_util as solr_util
+    solr_util.use_catalog(CatalogEngine.load('data/catalog'))
+
+    python utils/catalog_engine.py --snapshot category,bookstore_map --out data/catalog
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import Future
+
+import numpy as np
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+
+from utils.solr_gateway import SolrResult, parse_fq, _RANGE, _CLAUSE, _format_bucket
+
+CATALOG_CORES = ('category', 'bookstore_map')
+SUPPORTED = {'q', 'fq', 'q.op', 'sort', 'rows', 'start', 'wt', 'facet', 'facet.field', 'facet.range',
+             'facet.range.start', 'facet.range.end', 'facet.range.gap', 'facet.mincount', 'facet.limit'}
+EXTENSIONS = ('.json', '.jsonl', '.txt')
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class Column:
+    """
+    dictionary encoded values of one field
+    """
+
+    def __init__(self, n, values):
+        """
+        :param values: list of value lists, one per doc
+        """
+        self.n = n
+        self.terms = sorted(set(v for vs in values for v in vs), key=str)
+        self.term_ids = {str(term): i for i, term in enumerate(self.terms)}
+        self.term_numbers = np.asarray([_number(term) for term in self.terms], dtype=np.float64)
+        self.multi = any(len(vs) > 1 for vs in values)
+        self.present = np.asarray([len(vs) > 0 for vs in values], dtype=bool)
+        if self.multi:
+            self.codes = None
+            self.bitmaps = np.zeros((len(self.terms), n), dtype=bool)
+            for doc, vs in enumerate(values):
+                for v in vs:
+                    self.bitmaps[self.term_ids[str(v)], doc] = True
+        else:
+            self.codes = np.asarray([self.term_ids[str(vs[0])] if vs else -1 for vs in values], dtype=np.int32)
+            self.bitmaps = None
+            self._bitmaps = dict()
+        # first value as float, nan for missing or not numeric, for sort and ranges
+        self.numbers = np.asarray([_number(vs[0]) if vs else np.nan for vs in values], dtype=np.float64)
+
+    def bitmap(self, term_id):
+        if self.multi:
+            return self.bitmaps[term_id]
+        bitmap = self._bitmaps.get(term_id)
+        if bitmap is None:
+            bitmap = self.codes == term_id
+            bitmap.setflags(write=False)
+            self._bitmaps[term_id] = bitmap
+        return bitmap
+
+    def term(self, value):
+        term_id = self.term_ids.get(value)
+        if term_id is not None:
+            return self.bitmap(term_id)
+        # 2999.0 in the filter still finds the int 2999 of a numeric field
+        number = _number(value)
+        if np.isnan(number):
+            return np.zeros(self.n, dtype=bool)
+        return self.any_of(self.term_numbers == number)
+
+    def any_of(self, selected):
+        """
+        docs holding one of the selected terms
+        """
+        if not selected.any():
+            return np.zeros(self.n, dtype=bool)
+        if self.multi:
+            return self.bitmaps[selected].any(axis=0)
+        return selected[self.codes] & (self.codes >= 0)
+
+    def range(self, low, high, low_inclusive=True, high_inclusive=True):
+        v = self.term_numbers if self.multi else self.numbers
+        with np.errstate(invalid='ignore'):
+            selected = ~np.isnan(v)
+            if low is not None:
+                selected &= (v >= low) if low_inclusive else (v > low)
+            if high is not None:
+                selected &= (v <= high) if high_inclusive else (v < high)
+        return self.any_of(selected) if self.multi else selected
+
+    def counts(self, mask):
+        """
+        docs per term within mask
+        """
+        if self.multi:
+            return np.count_nonzero(self.bitmaps & mask, axis=1)
+        codes = self.codes[mask]
+        return np.bincount(codes[codes >= 0], minlength=len(self.terms))
+
+    def bucket_counts(self, mask, edges):
+        """
+        docs per [edges[i], edges[i + 1]) within mask
+        """
+        if not self.multi:
+            v = self.numbers[mask]
+            v = v[(v >= edges[0]) & (v < edges[-1])]
+            return np.bincount(np.searchsorted(edges, v, side='right') - 1, minlength=len(edges) - 1)
+        counts = np.zeros(len(edges) - 1, dtype=np.int64)
+        for i in range(len(edges) - 1):
+            counts[i] = np.count_nonzero(self.range(edges[i], edges[i + 1], True, False) & mask)
+        return counts
+
+
+class CatalogTable:
+    """
+    the docs of one core and a column per field
+    """
+
+    def __init__(self, docs):
+        self.docs = list(docs)
+        self.n = len(self.docs)
+        fields = set()
+        for doc in self.docs:
+            fields.update(doc.keys())
+        self.columns = {field: Column(self.n, [_as_list(doc.get(field)) for doc in self.docs])
+                        for field in fields}
+        self.all = np.ones(self.n, dtype=bool)
+        self.all.setflags(write=False)
+        self.none = np.zeros(self.n, dtype=bool)
+        self.none.setflags(write=False)
+
+    def clause(self, field, value):
+        if field == '*' and value == '*':
+            return self.all
+        column = self.columns.get(field)
+        if column is None:
+            return self.none
+        if value == '*':
+            return column.present
+        match = _RANGE.match(value)
+        if match:
+            low = None if match.group(2) == '*' else float(match.group(2))
+            high = None if match.group(3) == '*' else float(match.group(3))
+            return column.range(low, high, match.group(1) == '[', match.group(4) == ']')
+        return column.term(value.strip('"'))
+
+    def filter(self, fq, qop='OR'):
+        must, should = parse_fq(fq, qop)
+        mask = self.all.copy()
+        for field, value in must:
+            mask &= self.clause(field, value)
+        if not must and should:
+            # only optional clauses, at least one has to match
+            mask = self.none.copy()
+            for field, value in should:
+                mask |= self.clause(field, value)
+        return mask
+
+
+def _local_query(q):
+    """
+    true for *:* and field:value filters, text queries need solr's analyzers
+    """
+    return all(':' in part for i, part in enumerate(_CLAUSE.split(q.strip())) if not i % 2)
+
+
+class CatalogEngine:
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback
+        self.enabled = True
+        self.tables = dict()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.local = 0
+        self.latency = 0.0
+
+    def add(self, core, docs, copy_facets=False):
+        """
+        (re)builds a core, copy_facets adds the facet_<field>_str copies solr's
+        schema makes, for docs that were not exported from solr
+        """
+        docs = list(docs)
+        if copy_facets:
+            docs = [_with_facets(doc) for doc in docs]
+        table = CatalogTable(docs)
+        with self.lock:
+            self.tables[core] = table
+        return table
+
+    def cores(self):
+        return {core: table.n for core, table in self.tables.items()}
+
+    def answers(self, core, params):
+        return (self.enabled and core in self.tables and set(params) <= SUPPORTED
+                and _local_query(params.get('q', '*:*')))
+
+    def query(self, core, params, timeout=None):
+        with self.lock:
+            self.calls += 1
+            table = self.tables.get(core)
+        if table is None or not self.answers(core, params):
+            if self.fallback is None:
+                raise KeyError('core {} is not in the catalog'.format(core))
+            return self.fallback.query(core, params, timeout)
+        start = time.time()
+        result = self._query(table, params)
+        with self.lock:
+            self.local += 1
+            self.latency += time.time() - start
+        return result
+
+    def _query(self, table, params):
+        qop = params.get('q.op', 'OR')
+        mask = table.filter(params.get('q', '*:*'), qop)
+        for fq in _as_list(params.get('fq')):
+            mask &= table.filter(fq, qop)
+        if 'sort' in params:
+            field, _, order = params['sort'].partition(' ')
+            column = table.columns.get(field)
+            if column is None:
+                ids = np.zeros(0, dtype=np.int64)
+            else:
+                # docs without the field are left out, as FakeSolr does
+                ids = np.flatnonzero(mask & column.present)
+                keys = column.numbers[ids]
+                if np.isnan(keys).any():
+                    # not a numeric field, sorted by the values themselves
+                    keys = [_as_list(table.docs[i][field])[0] for i in ids]
+                    order_ids = sorted(range(len(ids)), key=lambda i: keys[i], reverse=order.strip() == 'desc')
+                    ids = ids[np.asarray(order_ids, dtype=np.int64)]
+                elif order.strip() == 'desc':
+                    ids = ids[np.argsort(-keys, kind='stable')]
+                else:
+                    ids = ids[np.argsort(keys, kind='stable')]
+            num_found = len(ids)
+        else:
+            ids = None
+            num_found = int(np.count_nonzero(mask))
+        data = {"response": {"numFound": num_found}}
+        if params.get('facet') in (True, 'true', 'on'):
+            data['facet_counts'] = self._facets(table, mask, params)
+        start = int(params.get('start', 0))
+        rows = int(params.get('rows', 10))
+        if ids is None:
+            ids = np.flatnonzero(mask)
+        data['response']['docs'] = [table.docs[i] for i in ids[start:start + rows]]
+        return SolrResult(data)
+
+    def _facets(self, table, mask, params):
+        mincount = int(params.get('facet.mincount', 0))
+        limit = int(params.get('facet.limit', 100))
+        result = {"facet_fields": {}, "facet_ranges": {}}
+        for field in _as_list(params.get('facet.field')):
+            column = table.columns.get(field)
+            flat = []
+            if column is not None:
+                counts = column.counts(mask)
+                ordered = sorted(((-int(n), str(column.terms[i]), i) for i, n in enumerate(counts)
+                                  if n > 0 or mincount == 0))
+                for negative, _, i in ordered[:limit]:
+                    if -negative >= mincount:
+                        flat.extend([column.terms[i], -negative])
+            result['facet_fields'][field] = flat
+        for field in _as_list(params.get('facet.range')):
+            start = float(params['facet.range.start'])
+            end = float(params['facet.range.end'])
+            gap = float(params['facet.range.gap'])
+            # the same float additions as solr's and FakeSolr's bucket loop,
+            # hardend=false so the last bucket may pass end
+            edges = []
+            low = start
+            while low < end:
+                edges.append(low)
+                low += gap
+            flat = []
+            column = table.columns.get(field)
+            if edges and column is not None:
+                edges.append(edges[-1] + gap)
+                counts = column.bucket_counts(mask, np.asarray(edges))
+                for low, n in zip(edges, counts):
+                    if n >= mincount:
+                        flat.extend([_format_bucket(low), int(n)])
+            elif edges and mincount == 0:
+                for low in edges:
+                    flat.extend([_format_bucket(low), 0])
+            result['facet_ranges'][field] = {"counts": flat, "gap": gap, "start": start, "end": end}
+        return result
+
+    def submit(self, core, params, timeout=None):
+        if self.fallback is not None and not self.answers(core, params):
+            return self.fallback.submit(core, params, timeout)
+        future = Future()
+        try:
+            future.set_result(self.query(core, params, timeout))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def fan_out(self, queries, timeout=None):
+        futures = [self.submit(core, params, timeout) for core, params in queries]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        with self.lock:
+            stats = {"calls": self.calls, "local": self.local, "enabled": self.enabled,
+                     "cores": self.cores(),
+                     "mean_local_latency_ms": self.latency / self.local * 1000 if self.local else 0.0}
+        if self.fallback is not None:
+            stats['fallback'] = self.fallback.stats()
+        return stats
+
+    @staticmethod
+    def load(directory, fallback=None, copy_facets=False):
+        """
+        a core per <core>.json/.jsonl/.txt file of directory
+        """
+        engine = CatalogEngine(fallback)
+        for name in sorted(os.listdir(directory)):
+            core, ext = os.path.splitext(name)
+            if ext in EXTENSIONS:
+                engine.add(core, read_docs(os.path.join(directory, name)), copy_facets)
+        return engine
+
+    @staticmethod
+    def snapshot(solr, cores=CATALOG_CORES, fallback=None):
+        """
+        the catalog cores as they are in solr now
+        """
+        engine = CatalogEngine(fallback)
+        for core in cores:
+            engine.add(core, solr_docs(solr, core))
+        return engine
+
+
+def _with_facets(doc):
+    doc = dict(doc)
+    for field, value in list(doc.items()):
+        if field.startswith('facet_') or field in ('id', '_version_'):
+            continue
+        values = [v for v in _as_list(value) if isinstance(v, str)]
+        if values:
+            doc.setdefault('facet_' + field + '_str', values if isinstance(value, list) else values[0])
+    return doc
+
+
+def read_docs(path):
+    """
+    docs of a solr json export ({"response": {"docs": [..]}} or a json list)
+    or of a json lines file as written by product_gen
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    stripped = text.lstrip()
+    if stripped.startswith('['):
+        return json.loads(text)
+    if stripped.startswith('{') and '"response"' in stripped[:200]:
+        try:
+            return json.loads(text)['response']['docs']
+        except ValueError:
+            pass
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def solr_docs(solr, core, rows=1000):
+    start = 0
+    while True:
+        docs = solr.query(core, {'q': '*:*', 'rows': rows, 'start': start, 'sort': 'id asc'}).docs
+        for doc in docs:
+            doc = dict(doc)
+            doc.pop('_version_', None)
+            yield doc
+        if len(docs) < rows:
+            return
+        start += rows
+
+
+def save(engine, directory):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for core, table in engine.tables.items():
+        with open(os.path.join(directory, core + '.jsonl'), 'w', encoding='utf-8') as f:
+            for doc in table.docs:
+                f.write(json.dumps(doc, ensure_ascii=False) + '\n')
+
+
+class QueryLog:
+    """
+    a backend that writes every query as a json line {"core", "params"}
+    before passing it on, the input of compare
+    """
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _log(self, core, params):
+        line = json.dumps({"core": core, "params": params}, ensure_ascii=False)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def query(self, core, params, timeout=None):
+        self._log(core, params)
+        return self.backend.query(core, params, timeout)
+
+    def submit(self, core, params, timeout=None):
+        self._log(core, params)
+        return self.backend.submit(core, params, timeout)
+
+    def fan_out(self, queries, timeout=None):
+        futures = [self.submit(core, params, timeout) for core, params in queries]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        return self.backend.stats()
+
+    def __getattr__(self, name):
+        # fallback, enabled, ... of the backend behind
+        return getattr(self.backend, name)
+
+
+def logged_queries(path):
+    """
+    (core, params) of a QueryLog file
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry['core'], entry['params']
+
+
+def _comparable(result, params):
+    """
+    the parts of a result solr and the engine must agree on; docs only where
+    their order is defined, by the sort values, or as a set for a full page
+    """
+    summary = {"numFound": result.num_found}
+    rows = int(params.get('rows', 10))
+    if 'sort' in params:
+        field = params['sort'].partition(' ')[0]
+        summary['sorted'] = [doc.get(field) for doc in result.docs]
+    elif result.num_found <= rows:
+        summary['ids'] = sorted(str(doc.get('id')) for doc in result.docs)
+    if params.get('facet') in (True, 'true', 'on'):
+        summary['facets'] = {field: list(counts.items()) for field, counts in result.get_facets().items()}
+        summary['ranges'] = {field: list(counts.items()) for field, counts in result.get_facets_ranges().items()}
+    return summary
+
+
+def compare(solr, engine, queries, show=20):
+    """
+    runs every query the engine answers on both, returns
+    {"compared", "skipped", "mismatches": [(core, params, solr part, engine part)]}
+    """
+    report = {"compared": 0, "skipped": 0, "mismatches": []}
+    for core, params in queries:
+        table = engine.tables.get(core)
+        if table is None or not engine.enabled or not engine.answers(core, params):
+            report['skipped'] += 1
+            continue
+        expected = _comparable(solr.query(core, params), params)
+        got = _comparable(engine._query(table, params), params)
+        report['compared'] += 1
+        if expected != got:
+            diff = {key: (expected.get(key), got.get(key)) for key in expected
+                    if expected.get(key) != got.get(key)}
+            report['mismatches'].append((core, params, diff))
+            if len(report['mismatches']) <= show:
+                print('mismatch', core, json.dumps(params, ensure_ascii=False))
+                for key, (a, b) in diff.items():
+                    print('   ', key, 'solr:', a, 'engine:', b)
+    print('{compared} compared, {skipped} skipped, {0} mismatches'.format(len(report['mismatches']), **report))
+    return report
+
+
+def test():
+    from utils.solr_gateway import FakeSolr
+    rng = np.random.RandomState(0)
+    brands = ['美的', '格力', '海尔', '松下']
+    docs = []
+    for i in range(500):
+        doc = {"id": str(i), "category": str(rng.choice(['空调', '冰箱'])), "brand": str(rng.choice(brands)),
+               "price": int(rng.randint(2000, 10000)), "ac.power_float": float(rng.choice([1.0, 1.5, 2.0, 3.0]))}
+        if rng.uniform() < 0.3:
+            doc['discount'] = ['满1000减200', '双十一大促销'][:rng.randint(1, 3)]
+        docs.append(_with_facets(doc))
+    fake = FakeSolr()
+    fake.add('category', docs)
+    engine = CatalogEngine()
+    engine.add('category', docs)
+    queries = [
+        {'q': '*:*', 'fq': '*:* AND category:空调 AND brand:美的', 'facet': True,
+         'facet.field': 'facet_discount_str', 'facet.mincount': 1, 'q.op': 'AND'},
+        {'q': '*:*', 'fq': '*:* AND category:空调 OR price:[2000 TO 5000]', 'facet': True,
+         'facet.field': 'facet_brand_str', 'facet.mincount': 1, 'q.op': 'AND'},
+        {'q': '*:*', 'fq': '*:* AND category:冰箱 OR price:[2000 TO 5000]', 'facet': True,
+         'facet.field': 'facet_brand_str', 'facet.mincount': 1, 'q.op': 'OR'},
+        {'q': '*:*', 'fq': '*:* AND category:空调', 'q.op': 'AND', 'sort': 'price desc', 'rows': 1},
+        {'q': '*:*', 'fq': '*:* AND brand:格力', 'q.op': 'AND', 'sort': 'ac.power_float asc', 'rows': 3},
+        {'q': '*:*', 'facet': True, 'facet.range': 'price', 'facet.mincount': 1, 'facet.range.start': 2001.0,
+         'facet.range.end': 9999.0 + 10, 'facet.range.gap': 799.8, 'fq': '*:* AND category:空调'},
+    ]
+    for params in queries:
+        expected, got = fake.query('category', params), engine.query('category', params)
+        assert expected.data == got.data, (params, expected.data, got.data)
+    assert engine.stats()['local'] == len(queries)
+    engine.fallback = fake
+    engine.enabled = False
+    engine.query('category', queries[0])
+    assert engine.stats()['local'] == len(queries)
+    engine.enabled = True
+    params = queries[1]
+    start = time.time()
+    for _ in range(1000):
+        engine.query('category', params)
+    print('{0:.1f}us per facet query'.format((time.time() - start) * 1000))
+    print('catalog engine test passed')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snapshot', default=','.join(CATALOG_CORES), help='solr cores to export')
+    parser.add_argument('--out', default=None, help='directory of <core>.jsonl, loaded by CatalogEngine.load')
+    parser.add_argument('--test', action='store_true')
+    parser.add_argument('--compare', default=None, help='solr url, replays --queries on it and on a snapshot of it')
+    parser.add_argument('--queries', default=None, help='json lines written by QueryLog')
+    args = parser.parse_args()
+    if args.compare:
+        if not args.queries:
+            parser.error('--compare needs --queries')
+        from utils.solr_gateway import SolrGateway
+        solr = SolrGateway(args.compare)
+        engine = CatalogEngine.snapshot(solr, args.snapshot.split(','))
+        report = compare(solr, engine, logged_queries(args.queries))
+        sys.exit(1 if report['mismatches'] else 0)
+    if args.test or not args.out:
+        test()
+        return
+    from utils.solr_util import solr
+    engine = CatalogEngine.snapshot(solr, args.snapshot.split(','))
+    save(engine, args.out)
+    print('exported', engine.cores())
+
+
+if __name__ == '__main__':
+    main()
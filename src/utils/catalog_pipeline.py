@@ -0,0 +1,203 @@
+"""
+Catalog Pipeline
+
+Rebuilds the product files of utils.product_gen from the data/gen_product
+tables in one command: each table is a job of a process pool, every output
+is written to a temporary file and moved in place, so a reader never sees a
+half written file. A manifest keeps the hash of the table, of product_gen.py
+and the seed of every job, tables that did not change are not generated
+again. Each job seeds numpy's rng from its table, the forked workers would
+otherwise all draw the same products, and a rerun gives the same products.
+
+The same pass writes the solr docs of the whole catalog, the product files
+concatenated, to data/catalog/category.jsonl, the input of
+utils.solr_indexer and of utils.catalog_engine.CatalogEngine.load.
+
+    python utils/catalog_pipeline.py --workers 8
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+grandfatherdir = os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, parentdir)
+
+import utils.product_gen as product_gen
+
+TABLE_DIR = os.path.join(grandfatherdir, 'data/gen_product')
+RAW_DIR = os.path.join(grandfatherdir, 'data/raw')
+CATALOG_DIR = os.path.join(grandfatherdir, 'data/catalog')
+MANIFEST = '.catalog_manifest.json'
+HOUSEHOLD_FILE = 'household.txt'
+# generator, table, product file; the commented calls of product_gen's main
+PRODUCT_JOBS = [('phone_product_gen', '手机.txt', 'product_phone.txt'),
+                ('ac_product_gen', '空调.txt', 'product_ac.txt'),
+                ('tv_product_gen', '电视.txt', 'product_tv.txt'),
+                ('pc_product_gen', '电脑.txt', 'pc.txt'),
+                ('fr_product_gen', '冰箱.txt', 'product_fr.txt')]
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def replace_atomic(tmp, path):
+    with open(tmp, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _tmp(path):
+    return '{}.tmp.{}'.format(path, os.getpid())
+
+
+def write_json_atomic(path, data):
+    tmp = _tmp(path)
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1, sort_keys=True)
+    replace_atomic(tmp, path)
+
+
+def concat_atomic(parts, path):
+    """
+    :return: lines written
+    """
+    tmp = _tmp(path)
+    lines = 0
+    with open(tmp, 'wb') as output:
+        for part in parts:
+            with open(part, 'rb') as f:
+                for line in f:
+                    if line.strip():
+                        output.write(line if line.endswith(b'\n') else line + b'\n')
+                        lines += 1
+    replace_atomic(tmp, path)
+    return lines
+
+
+def jobs(table_dir=TABLE_DIR, raw_dir=RAW_DIR):
+    """
+    [{name, generator, table, output}], tables missing in table_dir are left out
+    """
+    found = []
+    missing = []
+    parts_dir = os.path.join(raw_dir, HOUSEHOLD_FILE + '.parts')
+    specs = list(PRODUCT_JOBS)
+    specs += [('household_products', table, os.path.join(parts_dir, table))
+              for table in product_gen.HOUSEHOLD_CATEGORIES]
+    for generator, table, output in specs:
+        path = os.path.join(table_dir, table)
+        if not os.path.exists(path):
+            missing.append(table)
+            continue
+        found.append({"name": generator + ':' + table, "generator": generator, "table": path,
+                      "output": os.path.join(raw_dir, output)})
+    if missing:
+        print('{} tables not in {}: {}'.format(len(missing), table_dir, ','.join(missing)))
+    return found
+
+
+def job_seed(name, table_hash, seed):
+    key = '{}|{}|{}'.format(name, table_hash, seed).encode('utf-8')
+    return int(hashlib.sha1(key).hexdigest()[:8], 16)
+
+
+def run_job(job, seed):
+    """
+    runs in a worker process
+    :return: (name, output hash)
+    """
+    np.random.seed(seed)
+    output = job['output']
+    directory = os.path.dirname(output)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    tmp = _tmp(output)
+    getattr(product_gen, job['generator'])(tmp, job['table'])
+    replace_atomic(tmp, output)
+    return job['name'], file_hash(output)
+
+
+def build(table_dir=TABLE_DIR, raw_dir=RAW_DIR, catalog_dir=CATALOG_DIR, workers=None, seed=0, force=False):
+    start = time.time()
+    manifest_file = os.path.join(raw_dir, MANIFEST)
+    manifest = dict()
+    if os.path.exists(manifest_file) and not force:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    code = file_hash(product_gen.__file__)
+    todo = []
+    entries = dict()
+    all_jobs = jobs(table_dir, raw_dir)
+    for job in all_jobs:
+        table_hash = file_hash(job['table'])
+        entry = {"table": table_hash, "code": code, "seed": job_seed(job['name'], table_hash, seed)}
+        old = manifest.get(job['name'], {})
+        if (os.path.exists(job['output']) and all(old.get(k) == v for k, v in entry.items())
+                and old.get('output') == file_hash(job['output'])):
+            entries[job['name']] = old
+            continue
+        entries[job['name']] = entry
+        todo.append(job)
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_job, job, entries[job['name']]['seed']) for job in todo]
+            for future in futures:
+                name, output_hash = future.result()
+                entries[name]['output'] = output_hash
+
+    changed = set(job['name'] for job in todo)
+    household = [job for job in all_jobs if job['generator'] == 'household_products']
+    outputs = [job['output'] for job in all_jobs if job['generator'] != 'household_products']
+    if household:
+        household_file = os.path.join(raw_dir, HOUSEHOLD_FILE)
+        if not os.path.exists(household_file) or any(job['name'] in changed for job in household):
+            concat_atomic([job['output'] for job in household], household_file)
+        outputs.append(household_file)
+    catalog_file = os.path.join(catalog_dir, 'category.jsonl')
+    docs = None
+    if outputs and (changed or not os.path.exists(catalog_file)):
+        if not os.path.exists(catalog_dir):
+            os.makedirs(catalog_dir)
+        docs = concat_atomic(outputs, catalog_file)
+    write_json_atomic(manifest_file, entries)
+    summary = {"jobs": len(all_jobs), "generated": len(todo), "skipped": len(all_jobs) - len(todo),
+               "solr_docs": docs, "seconds": time.time() - start}
+    print(json.dumps(summary, ensure_ascii=False))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tables', default=TABLE_DIR)
+    parser.add_argument('--raw', default=RAW_DIR)
+    parser.add_argument('--catalog', default=CATALOG_DIR, help='where category.jsonl, the solr docs, is written')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--force', action='store_true', help='generate every table again')
+    parser.add_argument('--index', default=None, help='solr url to load category.jsonl into, e.g. http://localhost:11403/solr')
+    args = parser.parse_args()
+    summary = build(args.tables, args.raw, args.catalog, args.workers, args.seed, args.force)
+    if args.index and summary['generated']:
+        from utils.solr_gateway import SolrGateway
+        from utils.solr_indexer import SolrIndexer, invalidate, json_lines
+        indexer = SolrIndexer(SolrGateway(args.index), 'category', key_field=None)
+        print(indexer.index(json_lines(os.path.join(args.catalog, 'category.jsonl'))))
+        invalidate('category')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,12 @@
+import functools
+import os
+import re
+import sys
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import pycnnum
 
 chs_arabic_map = {'零': 0, '一': 1, '二': 2, '三': 3, '四': 4,
@@ -30,7 +39,183 @@ lead_digits = ['一', '二', '三', '四',
              '两']
 
 
+# the tables above compiled once: a numeral run is a maximal span of
+# digit_list chars, everything between runs is copied as it is
+CN_DIGITS = frozenset(digit_list)
+SKIP_GRAMS = frozenset(skip_gram)
+CN_NUMERAL_RUN = re.compile('[' + ''.join(re.escape(c) for c in digit_list) + ']+')
+
+
+@functools.lru_cache(maxsize=4096)
+def cached_cn2num(numstring):
+    return pycnnum.cn2num(numstring)
+
+
+@functools.lru_cache(maxsize=8192)
+def _convert_run(run, before_digit, after):
+    """
+    new_cn2arab_legacy on one numeral run, before_digit tells whether the
+    char before the run is a numeral (only at the start of the query, where
+    the legacy walk looks at the last char), after is the char after the
+    run, '' at the end of the query
+    """
+    result = []
+    numstring = []
+    last = len(run) - 1
+    for i, char in enumerate(run):
+        if char == '点':
+            if i == last and not after:
+                continue  # the legacy walk drops a trailing 点
+            if (before_digit if i == 0 else True) and i < last:
+                numstring.append(char)
+            else:
+                result.append(char)
+            continue
+        following = run[i + 1] if i < last else after
+        if following and char + following in SKIP_GRAMS:
+            result.append(char)
+            continue
+        numstring.append(char)
+    if numstring:
+        result.append(str(cached_cn2num(''.join(numstring))))
+    return ''.join(result)
+
+
 def new_cn2arab(query):
+    """
+    chinese numerals of query to arabic, 两千到三千 -> 2000到3000; same
+    answers as new_cn2arab_legacy, quirks included
+    """
+    if query.isdigit():
+        return float(query)
+
+    if len(query) == 0:
+        return query
+
+    parts = []
+    pos = 0
+    size = len(query)
+    for match in CN_NUMERAL_RUN.finditer(query):
+        start, end = match.span()
+        parts.append(query[pos:start])
+        parts.append(_convert_run(match.group(0), query[start - 1] in CN_DIGITS,
+                                  query[end] if end < size else ''))
+        pos = end
+    if pos == 0:
+        return query
+    parts.append(query[pos:])
+    return ''.join(parts)
+
+
+def _normalize_line(line):
+    """
+    (normalized, None), or (line, error) when pycnnum rejects a numeral run
+    """
+    try:
+        return str(new_cn2arab(line)), None
+    except Exception as e:
+        return line, '{}: {}'.format(type(e).__name__, e)
+
+
+def _normalize_lines(lines):
+    return [_normalize_line(line) for line in lines]
+
+
+def _results(lines, workers, chunk_size):
+    if workers <= 1:
+        for line in lines:
+            yield _normalize_line(line)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                pending.append(pool.submit(_normalize_lines, chunk))
+                chunk = []
+                if len(pending) >= 2 * workers:
+                    for result in pending.popleft().result():
+                        yield result
+        if chunk:
+            pending.append(pool.submit(_normalize_lines, chunk))
+        while pending:
+            for result in pending.popleft().result():
+                yield result
+
+
+def normalize_lines(lines, workers=4, chunk_size=2000, errors=None):
+    """
+    str(new_cn2arab(line)) of every line, in order; lines is read lazily in
+    chunks, at most 2 * workers chunks are in flight. A line that can not be
+    converted is passed through as it is and, when errors is a list,
+    (line number from 1, line, error) is appended to it.
+    """
+    for number, (normalized, error) in enumerate(_results(lines, workers, chunk_size), 1):
+        if error is not None and errors is not None:
+            errors.append((number, normalized, error))
+        yield normalized
+
+
+def normalize_file(in_file, out_file, workers=4, chunk_size=2000):
+    """
+    normalizes a corpus, one query per line, returns (lines, errors) with
+    errors as in normalize_lines. The output is written to a temp file next
+    to out_file and moved in place at the end, a failed run leaves no
+    partial output.
+    """
+    count = 0
+    errors = []
+    tmp_file = out_file + '.tmp{}'.format(os.getpid())
+    try:
+        with open(in_file, 'r') as fin, open(tmp_file, 'w') as fout:
+            lines = (line.rstrip('\n') for line in fin)
+            for normalized in normalize_lines(lines, workers, chunk_size, errors):
+                fout.write(normalized + '\n')
+                count += 1
+        os.replace(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return count, errors
+
+
+def check_cn2arab(queries):
+    """
+    queries where new_cn2arab and the legacy function differ
+    """
+    mismatches = []
+    for query in queries:
+        try:
+            expected = new_cn2arab_legacy(query)
+        except Exception as e:
+            expected = type(e)
+        try:
+            answer = new_cn2arab(query)
+        except Exception as e:
+            answer = type(e)
+        if answer != expected:
+            mismatches.append((query, expected, answer))
+    print('{} queries, {} mismatches'.format(len(queries), len(mismatches)))
+    return mismatches
+
+
+def benchmark_cn2arab(queries, rounds=3):
+    for name, fn in [('legacy', new_cn2arab_legacy), ('table', new_cn2arab)]:
+        best = None
+        for _ in range(rounds):
+            start = time.time()
+            for query in queries:
+                fn(query)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('{:>8} {:.1f} us/q'.format(name, best / len(queries) * 1e6))
+
+
+def new_cn2arab_legacy(query):
+    """
+    the reference implementation, char by char
+    """
 
     if query.isdigit():
         return float(query)
@@ -171,6 +356,23 @@ def cn2arab_core(chinese_digits):
 
 if __name__ == '__main__':
     s = ['十五哪点事','那点,42到50买一个三星手机两千一点五','3千','五十点二','三百','3百','两万','2万','2十万','100万','35','两千','1千零1百', '我要买一个两千到三千点二的手机']
-    for ss in s:
-        # print(ss, cn2arab(ss)[1])
-        print(new_cn2arab(ss))
+    if len(sys.argv) > 2 and sys.argv[1] == 'file':
+        # python utils/cn2arab.py file <in> <out> [workers]
+        start = time.time()
+        count, errors = normalize_file(sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else 4)
+        for number, line, error in errors[:20]:
+            print('line {} kept as it is, {}: {}'.format(number, error, line))
+        print('{} lines in {:.1f}s, {} not converted'.format(count, time.time() - start, len(errors)))
+    elif len(sys.argv) > 2 and sys.argv[1] == 'check':
+        # python utils/cn2arab.py check <corpus>, one query per line
+        with open(sys.argv[2], 'r') as f:
+            queries = [line.rstrip('\n') for line in f]
+        for mismatch in check_cn2arab(queries)[:20]:
+            print(mismatch)
+        benchmark_cn2arab(queries)
+    else:
+        for ss in s:
+            # print(ss, cn2arab(ss)[1])
+            print(new_cn2arab(ss))
+        check_cn2arab(s)
+        benchmark_cn2arab(s * 1000)
@@ -0,0 +1,229 @@
+"""
+Log Util
+
+Asynchronous logging for the kernel. Records are put on a queue by the
+request thread (QueueHandler) and written by a single background thread that
+drains the queue in batches into a buffered file, one flush per batch. The
+file is opened in append mode and switches to a new one when the date
+changes, so a restart never truncates the log of the day.
+
+Lines are json, corpus records (see log_corpus) carry their fields
+structured instead of the old C@user:..##query:.. string.
+
+Debug prints of the hot path go through debug(), which is silent unless
+MEMORY_DEBUG=1 is set or set_debug(True) is called.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+
+from queue import Queue, Empty
+
+LOG_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'logs')
+PREFIX = 'log_corpus_'
+BATCH_SIZE = 512
+FLUSH_INTERVAL = 1.0  # seconds a record may wait in the file buffer at most
+CORPUS = 'corpus'
+
+_debug = os.environ.get('MEMORY_DEBUG', '0').lower() not in ('', '0', 'false', 'no')
+
+
+def set_debug(flag):
+    global _debug
+    _debug = bool(flag)
+
+
+def is_debug():
+    return _debug
+
+
+def debug(*args, **kwargs):
+    if _debug:
+        print(*args, **kwargs)
+
+
+def _default(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        line = {"time": time.strftime('%Y.%m.%dT%H:%M:%S', time.localtime(record.created)),
+                "level": record.levelname}
+        fields = getattr(record, CORPUS, None)
+        if fields is not None:
+            line[CORPUS] = fields
+        else:
+            line["msg"] = record.getMessage()
+        if record.exc_info:
+            line["exc"] = self.formatException(record.exc_info)
+        return json.dumps(line, ensure_ascii=False, default=_default)
+
+
+class DailyFileWriter:
+    """
+    buffered append only file named <prefix><Y.m.d>.log, reopened when the date changes
+    """
+
+    def __init__(self, log_dir=LOG_DIR, prefix=PREFIX, buffering=1 << 16):
+        self.log_dir = log_dir
+        self.prefix = prefix
+        self.buffering = buffering
+        self.date = None
+        self.stream = None
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+    def _open(self, date):
+        if self.stream:
+            self.stream.close()
+        path = os.path.join(self.log_dir, self.prefix + date + '.log')
+        self.stream = open(path, 'a', encoding='utf-8', buffering=self.buffering)
+        self.date = date
+
+    def write(self, lines):
+        date = time.strftime('%Y.%m.%d')
+        if date != self.date:
+            self._open(date)
+        self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+
+class BatchQueueListener:
+    """
+    same role as logging.handlers.QueueListener, but drains everything that is
+    pending and writes it with a single write/flush
+    """
+    _sentinel = None
+
+    def __init__(self, queue, writer, formatter=None, batch_size=BATCH_SIZE):
+        self.queue = queue
+        self.writer = writer
+        self.formatter = formatter or JsonFormatter()
+        self.batch_size = batch_size
+        self.written = 0
+        self.dropped = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _drain(self):
+        records = []
+        stop = False
+        try:
+            record = self.queue.get(timeout=FLUSH_INTERVAL)
+            while True:
+                if record is self._sentinel:
+                    stop = True
+                    break
+                records.append(record)
+                if len(records) >= self.batch_size:
+                    break
+                record = self.queue.get_nowait()
+        except Empty:
+            pass
+        return records, stop
+
+    def _monitor(self):
+        while True:
+            records, stop = self._drain()
+            if records:
+                lines = []
+                for record in records:
+                    try:
+                        lines.append(self.formatter.format(record))
+                    except Exception:
+                        self.dropped += 1
+                try:
+                    self.writer.write(lines)
+                    self.written += len(lines)
+                except Exception:
+                    self.dropped += len(lines)
+                    print('log writer failed', sys.exc_info()[1], file=sys.stderr)
+            if stop:
+                self.writer.close()
+                return
+
+    def stop(self):
+        if self._thread:
+            self.queue.put(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
+_listener = None
+_lock = threading.Lock()
+
+
+def setup_logging(log_dir=LOG_DIR, prefix=PREFIX, level=logging.INFO):
+    """
+    routes the root logger through the async writer, safe to call from every
+    module that used to call logging.basicConfig, only the first call counts
+    """
+    global _listener
+    with _lock:
+        if _listener:
+            return _listener
+        queue = Queue(-1)
+        _listener = BatchQueueListener(queue, DailyFileWriter(log_dir, prefix))
+        _listener.start()
+        root = logging.getLogger()
+        root.addHandler(logging.handlers.QueueHandler(queue))
+        root.setLevel(level)
+        atexit.register(shutdown)
+        return _listener
+
+
+def shutdown():
+    global _listener
+    with _lock:
+        if _listener:
+            _listener.stop()
+            _listener = None
+
+
+def log_corpus(**fields):
+    """
+    one structured corpus line, e.g. log_corpus(user=u, query=q, api=api, prob=prob, render=render)
+    """
+    logging.getLogger(CORPUS).info(CORPUS, extra={CORPUS: fields})
+
+
+def test():
+    import tempfile
+    log_dir = tempfile.mkdtemp()
+    setup_logging(log_dir)
+    n = 100000
+    start = time.time()
+    for i in range(n):
+        log_corpus(user='u%d' % (i % 100), model='memory', query='我要买手机', api='api_call_slot_category:手机',
+                   prob=[[0.9]], render={"answer": "您要什么品牌的?"})
+    print('enqueue {0:.1f}us per record'.format((time.time() - start) / n * 1e6))
+    logging.error('an error line')
+    shutdown()
+    path = os.path.join(log_dir, PREFIX + time.strftime('%Y.%m.%d') + '.log')
+    with open(path, encoding='utf-8') as f:
+        lines = f.readlines()
+    assert len(lines) == n + 1, len(lines)
+    print(json.loads(lines[0]))
+    print(json.loads(lines[-1]))
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,205 @@
+"""
+Multi Replace
+
+Replaces many keys in one scan of the query with an Aho-Corasick automaton
+built once, instead of a str.replace per dictionary entry.
+
+Two modes:
+    sequential  the same result as
+                    for key, value in rules: q = q.replace(key, value)
+                a scan finds the keys in the query, only those rules run, in
+                rule order, and the query is scanned again after a rule changed
+                it (a value may create or break a later key). The cost grows
+                with the query and the rules that fire, not with the number
+                of rules.
+    longest     one pass, leftmost-longest: at each position the longest key
+                is replaced, replaced text is not looked at again.
+
+    python utils/multi_replace.py  # benchmark
+"""
+import time
+
+from collections import deque
+
+SEQUENTIAL = 'sequential'
+LONGEST = 'longest'
+
+
+class MultiReplacer:
+
+    def __init__(self, rules, mode=SEQUENTIAL):
+        """
+        :param rules: dict or [(key, value)], in the order they are applied
+        """
+        if mode not in (SEQUENTIAL, LONGEST):
+            raise ValueError('unknown mode ' + mode)
+        self.rules = list(rules.items()) if isinstance(rules, dict) else list(rules)
+        self.mode = mode
+        # str.replace('', v) puts v around every char, those rules always fire
+        self.always = frozenset(i for i, (key, _) in enumerate(self.rules) if not key)
+        self._build()
+
+    def _build(self):
+        goto = [dict()]
+        out = [[]]
+        for i, (key, _) in enumerate(self.rules):
+            if not key:
+                continue
+            state = 0
+            for ch in key:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append(dict())
+                    out.append([])
+                state = nxt
+            out[state].append(i)
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt].extend(out[fail[nxt]])
+        self.goto = goto
+        self.fail = fail
+        self.out = [tuple(o) for o in out]
+
+    def finditer(self, text):
+        """
+        (end, rule index) of every occurrence, overlapping ones included
+        """
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for end, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for i in out[state]:
+                yield end, i
+
+    def present(self, text):
+        """
+        indexes of the rules whose key is in text
+        """
+        found = set(self.always)
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+    def replace(self, text):
+        if not self.rules:
+            return text
+        if self.mode == SEQUENTIAL:
+            return self._sequential(text)
+        return self._longest(text)
+
+    def _sequential(self, text):
+        present = self.present(text)
+        last = -1
+        while True:
+            following = [i for i in present if i > last]
+            if not following:
+                return text
+            last = min(following)
+            key, value = self.rules[last]
+            replaced = text.replace(key, value)
+            if replaced != text:
+                text = replaced
+                present = self.present(text)
+
+    def _longest(self, text):
+        best = dict()  # start -> rule index of the longest key starting there
+        for end, i in self.finditer(text):
+            start = end - len(self.rules[i][0]) + 1
+            j = best.get(start)
+            if j is None or len(self.rules[i][0]) > len(self.rules[j][0]) or \
+                    (len(self.rules[i][0]) == len(self.rules[j][0]) and i < j):
+                best[start] = i
+        if not best:
+            return text
+        parts = []
+        pos = 0
+        n = len(text)
+        while pos < n:
+            i = best.get(pos)
+            if i is None:
+                parts.append(text[pos])
+                pos += 1
+            else:
+                key, value = self.rules[i]
+                parts.append(value)
+                pos += len(key)
+        return ''.join(parts)
+
+    def __len__(self):
+        return len(self.rules)
+
+
+def naive_replace(rules, text):
+    for key, value in rules:
+        text = text.replace(key, value)
+    return text
+
+
+def test():
+    import random
+    rng = random.Random(0)
+    alphabet = 'abcab_'
+    for _ in range(2000):
+        rules = [(''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 3))),
+                  ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 3))))
+                 for _ in range(rng.randint(0, 6))]
+        if rng.random() < 0.05:
+            rules.append(('', 'x'))
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+        assert MultiReplacer(rules).replace(text) == naive_replace(rules, text), (rules, text)
+    longest = MultiReplacer([('api_call_', ''), ('api_call_search_', 'S'), ('slot_', '')], mode=LONGEST)
+    assert longest.replace('api_call_search_brand slot_x') == 'Sbrand x'
+    print('multi replace test passed')
+
+
+def benchmark():
+    import random
+    rng = random.Random(1)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 2000)]
+    queries = [''.join(rng.choice(chars) for _ in range(rng.randint(5, 30))) for _ in range(1000)]
+    print('{:>8} {:>12} {:>12}'.format('rules', 'loop us/q', 'automaton us/q'))
+    for size in (10, 100, 1000, 10000):
+        rules = []
+        seen = set()
+        while len(rules) < size:
+            key = ''.join(rng.choice(chars) for _ in range(rng.randint(2, 4)))
+            if key not in seen:
+                seen.add(key)
+                rules.append((key, ''.join(rng.choice(chars) for _ in range(2))))
+        replacer = MultiReplacer(rules)
+        start = time.time()
+        for q in queries:
+            naive_replace(rules, q)
+        loop = (time.time() - start) / len(queries) * 1e6
+        start = time.time()
+        for q in queries:
+            replacer.replace(q)
+        automaton = (time.time() - start) / len(queries) * 1e6
+        print('{:>8} {:>12.1f} {:>12.1f}'.format(size, loop, automaton))
+
+
+if __name__ == '__main__':
+    test()
+    benchmark()
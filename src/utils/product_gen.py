@@ -36,6 +36,9 @@ sys.path.insert(0, parentdir)
 import json
 import numpy as np
 
+from utils.solr_gateway import SolrGateway
+from utils.solr_indexer import SolrIndexer, invalidate, json_lines
+
 ac_power = [1.0, 1.5, 2, 1.5, 3, 2.5, 4]
 ac_type = ["圆柱", "立式", "挂壁式", "立柜式", "中央空调"]
 ac_brand = ["三菱", "松下", "科龙", "惠而浦", "大金", "目立", "海尔", "美的", "卡萨帝",
@@ -74,6 +77,22 @@ phone_content = {"brand": phone_brand, "phone.sys": phone_sys, "phone.net": phon
 
 N = 4000
 
+HOUSEHOLD_CATEGORIES = ["净水器.txt",
+                        "剃毛器.txt", "加湿器.txt", "取暖器.txt", "吸尘器.txt",
+                        '咖啡机.txt', '垃圾处理机.txt', '多用途锅.txt', '干衣机.txt',
+                        '微波炉.txt', '打蛋器.txt', '扫地机器人.txt', '挂烫机.txt',
+                        '按摩器.txt', '按摩椅.txt', '排气扇.txt', '搅拌机.txt',
+                        '料理机.txt', '榨汁机.txt', '油烟机.txt', '洗碗机.txt',
+                        '洗衣机.txt', '浴霸.txt', '消毒柜.txt', '烟灶套装.txt',
+                        '烤箱.txt', '热水器.txt', '煮蛋器.txt', '燃气灶.txt',
+                        '电动剃须刀.txt', '电动牙刷.txt', '电压力锅.txt', '电吹风.txt',
+                        '电子秤.txt', '电水壶.txt', '电炖锅.txt', '电磁炉.txt',
+                        '电蒸炉.txt', '电风扇.txt', '电饭煲.txt', '电饼铛.txt',
+                        '相机.txt', '空气净化器.txt', '空调扇.txt', '美发器.txt',
+                        '美容器.txt', '豆浆机.txt', '足浴盆.txt', '酸奶机.txt',
+                        '采暖炉.txt', '除湿机.txt', '集成灶.txt', '面包机.txt',
+                        "饮水机.txt"]
+
 
 def ac_product_gen(product_file, data_file):
     profile = dict()
@@ -460,12 +479,19 @@ def pc_product_gen(product_file, data_file):
 
 
 def household_product_gen(product_file, data_file):
-    profile = dict()
-    title = []
     _data_file = data_file.replace(" ", "")
     _product_file = product_file.replace(" ", "")
     data_file = "../../data/gen_product/" + _data_file.replace(" ","")
     product_file = '../../data/raw/' + _product_file.replace(" ","")
+    household_products(product_file, data_file, mode='a')
+
+
+def household_products(product_file, data_file, mode='w'):
+    """
+    5 products of a household table, household_product_gen without the path rewriting
+    """
+    profile = dict()
+    title = []
     with open(data_file, 'r') as infile:
         line = infile.readline()
         title = line.strip('\n').split("|")[4].split(',')
@@ -476,7 +502,7 @@ def household_product_gen(product_file, data_file):
                 continue
             profile[b] = c.split(",")
 
-    with open(product_file, 'a') as output:
+    with open(product_file, mode) as output:
         for i in range(5):
             household = dict()
             for key, value in profile.items():
@@ -486,7 +512,6 @@ def household_product_gen(product_file, data_file):
             household['price'] = np.random.randint(low=200, high=1000)
             if np.random.uniform() < 0.4:
                 household['discount'] = np.random.choice(discount)
-            print(household)
             tt = []
             for t in title:
                 tt.append(household[t])
@@ -495,40 +520,20 @@ def household_product_gen(product_file, data_file):
             output.write(json.dumps(household, ensure_ascii=False) + '\n')
 
 
-def update_solr(solr_file):
-
-    with open(solr_file, 'r', encoding='utf-8') as data_file:
-        for line in data_file:
-            line = "[" + line + "]"
-            # line = str.encode(line)
-            print(line)
-            line = str.encode(line)
-            req = urllib.request.Request(url='http://10.89.100.12:11403/solr/category/update?commit=true',
-                                         data=line)
-            headers = {"content-type": "text/json"}
-            req.add_header('Content-type', 'application/json')
-            f = urllib.request.urlopen(req)
-            # Begin using data like the following
-            print
-            f.read()
+def update_solr(solr_file, notify=None):
+    """
+    adds the products of a product file to the category core, in batches;
+    products already in the core (same content) are skipped on a rerun
+    """
+    indexer = SolrIndexer(SolrGateway('http://10.89.100.12:11403/solr'), 'category', key_field=None)
+    counts = indexer.index(json_lines(solr_file))
+    invalidate('category', notify=notify)
+    print(counts)
+    return counts
 
 
 if __name__ == "__main__":
-    categories = ["净水器.txt",
-                  "剃毛器.txt", "加湿器.txt", "取暖器.txt", "吸尘器.txt",
-                  '咖啡机.txt', '垃圾处理机.txt', '多用途锅.txt', '干衣机.txt',
-                  '微波炉.txt', '打蛋器.txt', '扫地机器人.txt', '挂烫机.txt',
-                  '按摩器.txt', '按摩椅.txt', '排气扇.txt', '搅拌机.txt',
-                  '料理机.txt', '榨汁机.txt', '油烟机.txt', '洗碗机.txt',
-                  '洗衣机.txt', '浴霸.txt', '消毒柜.txt', '烟灶套装.txt',
-                  '烤箱.txt', '热水器.txt', '煮蛋器.txt', '燃气灶.txt',
-                  '电动剃须刀.txt', '电动牙刷.txt', '电压力锅.txt', '电吹风.txt',
-                  '电子秤.txt', '电水壶.txt', '电炖锅.txt', '电磁炉.txt',
-                  '电蒸炉.txt', '电风扇.txt', '电饭煲.txt', '电饼铛.txt',
-                  '相机.txt', '空气净化器.txt', '空调扇.txt', '美发器.txt',
-                  '美容器.txt', '豆浆机.txt', '足浴盆.txt', '酸奶机.txt',
-                  '采暖炉.txt', '除湿机.txt', '集成灶.txt', '面包机.txt',
-                  "饮水机.txt"]
+    categories = HOUSEHOLD_CATEGORIES
     prefix = '../../data/gen_product/'
     data_files = [os.path.join(prefix, d) for d in categories]
     product_file = "../../data/raw/household.txt"
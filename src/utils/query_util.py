@@ -26,9 +26,13 @@ for special treatment for this code
 Belief Tracker
 """
 
+import functools
 import re
 import requests
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import jieba
 
 import os
@@ -55,7 +59,71 @@ STOP_WORDS_0 = set(["！", "？", "，", "。", "，", '*', ":", '_', '.', ' ',
                     "啊", "呢", '呀']) # 吗
 
 MAX_CHAR = 30
+# the same strings come back all the time: candidates, PAD, faq paraphrases
+TOKENIZE_CACHE_SIZE = 50000
+
+
 def tokenize(sent, char=config.TOKENIZE_CHAR):
+    """
+    tokens of sent, memoized by (sent, char); the list is a fresh copy the
+    caller may change
+    """
+    return list(_cached_tokenize(sent, char))
+
+
+@functools.lru_cache(maxsize=TOKENIZE_CACHE_SIZE)
+def _cached_tokenize(sent, char):
+    return tuple(_tokenize(sent, char))
+
+
+def clear_tokenize_cache():
+    """
+    call after the jieba dictionary changed
+    """
+    _cached_tokenize.cache_clear()
+
+
+def _tokenize_chunk(sents, char):
+    return [tokenize(sent, char) for sent in sents]
+
+
+def tokenize_many(sents, char=config.TOKENIZE_CHAR, workers=4, chunk_size=1000):
+    """
+    tokenize of every sent, in order, for preprocessing corpora; sents is
+    read lazily and cut into chunks tokenized by a process pool, at most
+    2 * workers chunks are in flight. Less than a chunk is done in process.
+    """
+    sents = iter(sents)
+    chunk = []
+    for sent in sents:
+        chunk.append(sent)
+        if len(chunk) == chunk_size:
+            break
+    if workers <= 1 or len(chunk) < chunk_size:
+        for sent in chunk:
+            yield tokenize(sent, char)
+        for sent in sents:
+            yield tokenize(sent, char)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque([pool.submit(_tokenize_chunk, chunk, char)])
+        chunk = []
+        for sent in sents:
+            chunk.append(sent)
+            if len(chunk) == chunk_size:
+                pending.append(pool.submit(_tokenize_chunk, chunk, char))
+                chunk = []
+                if len(pending) >= 2 * workers:
+                    for tokens in pending.popleft().result():
+                        yield tokens
+        if chunk:
+            pending.append(pool.submit(_tokenize_chunk, chunk, char))
+        while pending:
+            for tokens in pending.popleft().result():
+                yield tokens
+
+
+def _tokenize(sent, char):
     sent = sent.lower().strip()
     tokens = list()
     sent = sent[0:MAX_CHAR]
@@ -168,7 +236,106 @@ def supersede(query):
     return query
 
 
+NUMBER = r"([-+]?\d*\.\d+|\d+)"
+TO = "到至|"  # the [到|至] class also takes the |
+
+# (wild card key, pattern, chars that must follow a digit for a match)
+NUM_DUAL = [("__inch__", re.compile(NUMBER + "[到|至]" + NUMBER + "寸"), "寸"),
+            ("__meter__", re.compile(NUMBER + "[到|至]" + NUMBER + "米"), "米"),
+            ("ac.power", re.compile(NUMBER + "[到|至]" + NUMBER + "[p|P|匹]"), "pP匹|"),
+            ("price", re.compile(NUMBER + "[到|至]" + NUMBER + "[块|元]"), "块元|")]
+NUM_SINGLE = [("__inch__", re.compile(NUMBER + "寸"), "寸"),
+              ("__meter__", re.compile(NUMBER + "米"), "米"),
+              ("ac.power", re.compile(NUMBER + "[p|P|匹]"), "pP匹|"),
+              ("price", re.compile(NUMBER + "[块|元]"), "块元|"),
+              ("people", re.compile(NUMBER + "人"), "人"),
+              ("height", re.compile("高" + NUMBER + "米"), "米"),
+              ("width", re.compile("宽" + NUMBER + "米"), "米"),
+              ("memory", re.compile(NUMBER + "[g|G]"), "gG|")]
+NUM_MEMORY = NUM_SINGLE[-1][1]
+NUM_PRICE_DUAL_DEFAULT = re.compile(NUMBER + "[到|至]" + NUMBER + "(?!P|匹|米|寸|p|T|t|级|k|K|人|g|G)")
+NUM_PRICE_SINGLE_DEFAULT = re.compile(NUMBER + "(?!P|匹|米|寸|p|T|t|级|k|K|人|g|G)")
+NUM_REMOVE = re.compile(r"\d+[个|只|条|部|本|台]")
+NUM_REMOVE_UNITS = "个只条部本台|"
+NUM_VALUE = re.compile(r"[-+]?\d*\.\d+|\d+")
+DIGIT = re.compile(r"\d")
+DIGIT_FOLLOWER = re.compile(r"\d(\D)")
+
+
+def _followers(query):
+    """
+    the chars right after a digit, one scan; a pattern whose unit is not
+    among them cannot match and is not run
+    """
+    return set(DIGIT_FOLLOWER.findall(query))
+
+
+def _range_numbers(match, single):
+    values = NUM_VALUE.findall(match.group(0))
+    if single:
+        value = float(values[0])
+        return '[' + str(value * 0.9) + " TO " + str(value * 1.1) + "]"
+    values = [float(r) for r in values[0:2]]
+    return '[' + str(values[0]) + " TO " + str(values[1]) + "]"
+
+
+def _has(followers, chars):
+    for c in chars:
+        if c in followers:
+            return True
+    return False
+
+
 def rule_base_num_retreive(query, switch=False):
+    """
+    (range rendered query, wild card) of the numbers with a unit in query,
+    same answers as rule_base_num_retreive_legacy, including its quirks: a
+    single unit overrides a range of the same key, and the rendered query of
+    a unit match only has the memory sizes replaced
+    """
+    if not switch:
+        return query, {}
+
+    query = supersede(query)
+    query = str(new_cn2arab(query))
+    if not DIGIT.search(query):
+        return query, {}
+
+    followers = _followers(query)
+    wild_card = dict()
+    if _has(followers, TO):
+        for key, pattern, units in NUM_DUAL:
+            if _has(followers, units):
+                match = pattern.search(query)
+                if match:
+                    wild_card[key] = _range_numbers(match, False)
+    for key, pattern, units in NUM_SINGLE:
+        if _has(followers, units):
+            match = pattern.search(query)
+            if match:
+                wild_card[key] = _range_numbers(match, True)
+    if wild_card:
+        return NUM_MEMORY.sub('range', query), wild_card
+
+    if _has(followers, NUM_REMOVE_UNITS):
+        query = NUM_REMOVE.sub('', query)
+        followers = _followers(query)
+    if _has(followers, TO):
+        match = NUM_PRICE_DUAL_DEFAULT.search(query)
+        if match:
+            wild_card['number'] = _range_numbers(match, False)
+            return NUM_PRICE_DUAL_DEFAULT.sub('range', query), wild_card
+    match = NUM_PRICE_SINGLE_DEFAULT.search(query)
+    if match:
+        wild_card['number'] = _range_numbers(match, True)
+        return NUM_PRICE_SINGLE_DEFAULT.sub('range', query), wild_card
+    return query, wild_card
+
+
+def rule_base_num_retreive_legacy(query, switch=False):
+    """
+    the reference implementation, rule_base_num_retreive must give the same answer
+    """
     if not switch:
         return query, {}
 
@@ -259,6 +426,116 @@ def range_extract(pattern, query, single, range_render=False):
     return range_rendered_query, numbers
 
 
+NUM_SAMPLES = ['50寸电视', '哪点事三人3000,高4米iphone6s, 大一匹', '40到50寸的电视', '2000到3000块的空调',
+               '1.5匹的空调', '3p空调', '宽2米高1.8米', '64G的手机', '价格五千左右', '买3个4000的',
+               '二十到三十元', '8到10人', '1到2米', '5000', '', '你好', '2|3匹', '1.3p', '一千五百元']
+
+
+def num_retreive_queries(corpus_file=None, size=20000):
+    """
+    the queries of corpus_file, one per line, or mixes of numbers and units
+    """
+    if corpus_file:
+        with open(corpus_file, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+    import random
+    rng = random.Random(0)
+    parts = ['寸', '米', 'p', 'P', '匹', '块', '元', '人', 'g', 'G', '到', '至', '|', '个', '台', '高', '宽',
+             '的', '空调', '电视', '手机', '我要', '.', '-', '+', 'T', 'k', '级', ' ', '三', '十', '五百']
+    queries = list(NUM_SAMPLES)
+    while len(queries) < size:
+        query = []
+        for _ in range(rng.randint(1, 8)):
+            if rng.random() < 0.4:
+                query.append(str(rng.choice([1, 2, 3, 10, 40, 1.5, 2000, 0.5])))
+            else:
+                query.append(rng.choice(parts))
+        queries.append(''.join(query))
+    return queries
+
+
+def check_num_retreive(queries):
+    """
+    queries where rule_base_num_retreive and the legacy function differ
+    """
+    mismatches = []
+    for query in queries:
+        expected = _num_outcome(rule_base_num_retreive_legacy, query)
+        answer = _num_outcome(rule_base_num_retreive, query)
+        if answer != expected or (isinstance(answer, tuple) and list(answer[1]) != list(expected[1])):
+            mismatches.append((query, expected, answer))
+    print('{} queries, {} mismatches'.format(len(queries), len(mismatches)))
+    return mismatches
+
+
+def _num_outcome(fn, query):
+    """
+    the answer of fn, or the type of the exception it raised, e.g. on a
+    numeral pycnnum rejects
+    """
+    try:
+        return fn(query, True)
+    except Exception as e:
+        return type(e)
+
+
+def benchmark_num_retreive(queries, rounds=3):
+    import time
+    for name, fn in [('legacy', rule_base_num_retreive_legacy), ('scanner', rule_base_num_retreive)]:
+        best = None
+        for _ in range(rounds):
+            start = time.time()
+            for query in queries:
+                try:
+                    fn(query, True)
+                except Exception:
+                    pass  # counted by check_num_retreive
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('{:>8} {:.1f} us/q'.format(name, best / len(queries) * 1e6))
+
+
+def dialog_texts(dialog_file):
+    """
+    the u, r and salt of every turn of a dialog file, as parse_dialogs_per_response reads them
+    """
+    texts = []
+    with open(dialog_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if '\t' in line:
+                texts.extend(line.split('\t')[:3])
+    return texts
+
+
+def test_tokenize_many(char=config.TOKENIZE_CHAR):
+    sents = ['我要买{}寸的电视,价格{}元'.format(i % 37, i) for i in range(2500)]
+    expected = [_tokenize(sent, char) for sent in sents]
+    # more chunks than 2 * workers, so the backpressure path runs as well
+    assert list(tokenize_many(sents, char, workers=3, chunk_size=100)) == expected
+    assert list(tokenize_many(iter(sents), char, workers=3, chunk_size=7)) == expected
+    assert list(tokenize_many(sents[:5], char, workers=3, chunk_size=100)) == expected[:5]
+    assert list(tokenize_many([], char, workers=3)) == []
+    print('tokenize_many test passed')
+
+
+def benchmark_tokenize_many(texts, char=config.TOKENIZE_CHAR, workers=None):
+    import time
+    workers = workers or os.cpu_count() or 1
+    # both runs start cold, forked workers would inherit a warm cache
+    clear_tokenize_cache()
+    start = time.time()
+    serial = list(tokenize_many(texts, char, workers=1))
+    serial_time = time.time() - start
+    clear_tokenize_cache()
+    start = time.time()
+    parallel = list(tokenize_many(texts, char, workers=workers))
+    parallel_time = time.time() - start
+    assert parallel == serial
+    print('{} texts, serial {:.2f}s, {} workers {:.2f}s, {:.1f}x'.format(
+        len(texts), serial_time, workers, parallel_time, serial_time / max(parallel_time, 1e-9)))
+
+
 def build_dmn_vocab():
     char_path = os.path.join(
         grandfatherdir, 'data/char_table/char2index_dict_big.txt')
@@ -283,4 +560,20 @@ if __name__ == "__main__":
     # print(rule_base_num_retreive('哪点事三人3000,高4米iphone6s, 大一匹'))
     print(tokenize('一楼呢', char=2))
     # print(rule_base_num_retreive(''))
-    build_dmn_vocab()
+    if len(sys.argv) > 1 and sys.argv[1] == 'num':
+        # python utils/query_util.py num [corpus file, one query per line]
+        queries = num_retreive_queries(sys.argv[2] if len(sys.argv) > 2 else None)
+        for mismatch in check_num_retreive(queries)[:20]:
+            print(mismatch)
+        benchmark_num_retreive(queries)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'tokenize':
+        # python utils/query_util.py tokenize [dialog file, u\tr\tsalt per line] [workers] [char]
+        char = int(sys.argv[4]) if len(sys.argv) > 4 else config.TOKENIZE_CHAR
+        test_tokenize_many(char)
+        if len(sys.argv) > 2:
+            texts = dialog_texts(sys.argv[2])
+        else:
+            texts = ['我要买{}寸的电视,价格{}元,有没有三星的'.format(i % 97, i) for i in range(200000)]
+        benchmark_tokenize_many(texts, char, int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    else:
+        build_dmn_vocab()
@@ -0,0 +1,97 @@
+"""
+Single Flight
+
+Coalesces concurrent calls with the same key: the first caller runs the
+function, the others wait for it and get the same result (or exception).
+Only calls in flight at the same time are shared, nothing is kept after the
+leader returns, that is the job of the caches in front of it.
+"""
+import threading
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self, wait_timeout=None):
+        """
+        :param wait_timeout: seconds a follower waits before running the function itself, None for no limit
+        """
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.leaders = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            if call.event.wait(self.wait_timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            with self.lock:
+                self.timeouts += 1
+            return fn(*args, **kwargs)
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            calls = self.leaders + self.coalesced
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self.calls),
+                    "errors": self.errors, "timeouts": self.timeouts,
+                    "coalesced_rate": float(self.coalesced) / calls if calls else 0.0}
+
+
+def test():
+    import time
+    flight = SingleFlight()
+    runs = []
+
+    def slow(x):
+        runs.append(x)
+        time.sleep(0.2)
+        return x * 2
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('k', slow, 21))) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [42] * 10 and len(runs) == 1, (results, runs)
+    assert flight.stats()['coalesced'] == 9, flight.stats()
+    assert flight.do('k', slow, 1) == 2 and len(runs) == 2
+    print('single flight test passed', flight.stats())
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,354 @@
+"""
+Solr Gateway
+
+One place for every solr call of the kernel: a pooled keep-alive HTTP
+session, connect/read timeouts and an overall deadline per call, retries
+with full jitter on connection errors and 5xx, and fan_out to run
+independent queries concurrently.
+
+SolrResult offers the part of SolrClient's response used in this project
+(docs, get_facet_keys_as_list, get_facets_ranges). FakeSolr answers the same
+queries from docs in memory, for tests and for running without a solr.
+"""
+import random
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+SOLR_URL = 'http://localhost:11403/solr'
+POOL_SIZE = 32
+CONNECT_TIMEOUT = 0.5
+READ_TIMEOUT = 3.0
+RETRIES = 2
+BACKOFF = 0.05  # base of the exponential backoff, seconds
+
+
+class SolrError(Exception):
+    pass
+
+
+class SolrResult:
+
+    def __init__(self, data):
+        self.data = data
+        response = data.get('response', {})
+        self.docs = response.get('docs', [])
+        self.num_found = response.get('numFound', len(self.docs))
+        self._facets = None
+        self._ranges = None
+
+    def get_facets(self):
+        if self._facets is None:
+            self._facets = dict()
+            fields = self.data.get('facet_counts', {}).get('facet_fields', {})
+            for field, counts in fields.items():
+                self._facets[field] = OrderedDict(zip(counts[::2], counts[1::2]))
+        return self._facets
+
+    def get_facet_keys_as_list(self, field):
+        return list(self.get_facets().get(field, ()))
+
+    def get_facets_ranges(self):
+        if self._ranges is None:
+            self._ranges = dict()
+            ranges = self.data.get('facet_counts', {}).get('facet_ranges', {})
+            for field, value in ranges.items():
+                counts = value.get('counts', [])
+                self._ranges[field] = OrderedDict(zip(counts[::2], counts[1::2]))
+        return self._ranges
+
+
+def _encode(params):
+    encoded = dict()
+    for key, value in params.items():
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        encoded[key] = value
+    encoded['wt'] = 'json'
+    return encoded
+
+
+class SolrGateway:
+
+    def __init__(self, url=SOLR_URL, pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+        self.url = url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers=pool_size)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.retried = 0
+        self.latency = 0.0
+
+    def query(self, core, params, timeout=None):
+        """
+        :param timeout: overall deadline of the call in seconds including retries,
+                        read_timeout * (retries + 1) by default
+        """
+        start = time.time()
+        deadline = start + (timeout if timeout else self.read_timeout * (self.retries + 1))
+        url = '{}/{}/select'.format(self.url, core)
+        data = _encode(params)
+        attempt = 0
+        while True:
+            left = deadline - time.time()
+            if left <= 0:
+                error = 'deadline exceeded'
+            else:
+                try:
+                    response = self.session.post(url, data=data,
+                                                 timeout=(min(self.connect_timeout, left),
+                                                          min(self.read_timeout, left)))
+                except requests.RequestException as e:
+                    error = e
+                else:
+                    if response.status_code == 200:
+                        result = SolrResult(response.json())
+                        self._count(start)
+                        return result
+                    error = 'solr {}: {}'.format(response.status_code, response.text[:200])
+                    if response.status_code < 500:
+                        # a bad query does not get better by retrying
+                        self._count(start, failed=True)
+                        raise SolrError('query on {} failed, {}'.format(core, error))
+            sleep = random.uniform(0, self.backoff * (2 ** attempt))
+            if left <= 0 or attempt >= self.retries or time.time() + sleep >= deadline:
+                self._count(start, failed=True)
+                raise SolrError('query on {} failed, {}'.format(core, error))
+            attempt += 1
+            with self.lock:
+                self.retried += 1
+            time.sleep(sleep)
+
+    def _count(self, start, failed=False):
+        with self.lock:
+            self.calls += 1
+            self.latency += time.time() - start
+            if failed:
+                self.failures += 1
+
+    def submit(self, core, params, timeout=None):
+        return self.pool.submit(self.query, core, params, timeout)
+
+    def fan_out(self, queries, timeout=None):
+        """
+        runs [(core, params), ...] concurrently, results in the same order
+        """
+        futures = [self.submit(core, params, timeout) for core, params in queries]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        with self.lock:
+            return {"calls": self.calls, "failures": self.failures, "retries": self.retried,
+                    "mean_latency_ms": self.latency / self.calls * 1000 if self.calls else 0.0}
+
+
+_CLAUSE = re.compile(r'\s+(AND|OR)\s+')
+_RANGE = re.compile(r'^([\[{])\s*(\S+)\s+TO\s+(\S+)\s*([\]}])$')
+
+
+def parse_fq(fq, qop='OR'):
+    """
+    splits a compose_fq style filter ('*:* AND a:x AND b:y OR price:[1 TO 2]')
+    into (must, should) lists of (field, value) with the lucene classic
+    parser rules: AND makes both sides required, OR after a clause makes that
+    clause optional when the default operator is AND, bare clauses follow q.op
+    """
+    parts = _CLAUSE.split(fq.strip())
+    clauses = []  # [field, value, required]
+    conj = None
+    and_op = qop.upper() == 'AND'
+    for i, part in enumerate(parts):
+        if i % 2:
+            conj = part
+            continue
+        if conj == 'AND' and clauses:
+            clauses[-1][2] = True
+        if and_op and conj == 'OR' and clauses:
+            clauses[-1][2] = False
+        if and_op:
+            required = conj != 'OR'
+        else:
+            required = conj == 'AND'
+        field, _, value = part.partition(':')
+        clauses.append([field, value, required])
+        conj = None
+    must = [(field, value) for field, value, required in clauses if required]
+    should = [(field, value) for field, value, required in clauses if not required]
+    return must, should
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def clause_matches(doc, field, value):
+    if field == '*' and value == '*':
+        return True
+    if field not in doc:
+        return False
+    values = _as_list(doc[field])
+    match = _RANGE.match(value)
+    if match:
+        low_inclusive = match.group(1) == '['
+        high_inclusive = match.group(4) == ']'
+        low = None if match.group(2) == '*' else float(match.group(2))
+        high = None if match.group(3) == '*' else float(match.group(3))
+        for v in values:
+            v = _number(v)
+            if v is None:
+                continue
+            if low is not None and (v < low or (v == low and not low_inclusive)):
+                continue
+            if high is not None and (v > high or (v == high and not high_inclusive)):
+                continue
+            return True
+        return False
+    value = value.strip('"')
+    return any(str(v) == value for v in values)
+
+
+def fq_matches(doc, must, should):
+    if not all(clause_matches(doc, field, value) for field, value in must):
+        return False
+    if must or not should:
+        return True
+    return any(clause_matches(doc, field, value) for field, value in should)
+
+
+def _format_bucket(value):
+    return str(float(value))
+
+
+class FakeSolr:
+    """
+    the subset of solr the kernel uses, over docs in memory:
+    q (*:* or field:value), fq, q.op, sort, rows, start,
+    facet.field and facet.range with facet.mincount
+    """
+
+    def __init__(self, cores=None):
+        self.cores = cores if cores is not None else dict()
+        self.calls = 0
+
+    def add(self, core, docs):
+        self.cores.setdefault(core, []).extend(docs)
+
+    def _filter(self, docs, fq, qop):
+        if not fq:
+            return docs
+        must, should = parse_fq(fq, qop)
+        return [doc for doc in docs if fq_matches(doc, must, should)]
+
+    def query(self, core, params, timeout=None):
+        self.calls += 1
+        qop = params.get('q.op', 'OR')
+        docs = self.cores.get(core, [])
+        docs = self._filter(docs, params.get('q', '*:*'), qop)
+        for fq in _as_list(params.get('fq', [])):
+            docs = self._filter(docs, fq, qop)
+        if 'sort' in params:
+            field, _, order = params['sort'].partition(' ')
+            docs = sorted([doc for doc in docs if field in doc],
+                          key=lambda doc: _as_list(doc[field])[0], reverse=order.strip() == 'desc')
+        data = {"response": {"numFound": len(docs)}}
+        if params.get('facet') in (True, 'true', 'on'):
+            data['facet_counts'] = self._facets(docs, params)
+        start = int(params.get('start', 0))
+        data['response']['docs'] = docs[start:start + int(params.get('rows', 10))]
+        return SolrResult(data)
+
+    def _facets(self, docs, params):
+        mincount = int(params.get('facet.mincount', 0))
+        result = {"facet_fields": {}, "facet_ranges": {}}
+        for field in _as_list(params.get('facet.field', [])):
+            counts = dict()
+            for doc in docs:
+                for v in set(_as_list(doc.get(field, []))):
+                    counts[v] = counts.get(v, 0) + 1
+            ordered = sorted(counts.items(), key=lambda kv: (-kv[1], str(kv[0])))
+            flat = []
+            for v, n in ordered[:int(params.get('facet.limit', 100))]:
+                if n >= mincount:
+                    flat.extend([v, n])
+            result['facet_fields'][field] = flat
+        for field in _as_list(params.get('facet.range', [])):
+            start = float(params['facet.range.start'])
+            end = float(params['facet.range.end'])
+            gap = float(params['facet.range.gap'])
+            flat = []
+            low = start
+            while low < end:
+                # solr default facet.range.hardend=false, the last bucket may pass end
+                high = low + gap
+                n = sum(1 for doc in docs
+                        if any(v is not None and low <= v < high
+                               for v in map(_number, _as_list(doc.get(field, [])))))
+                if n >= mincount:
+                    flat.extend([_format_bucket(low), n])
+                low += gap
+            result['facet_ranges'][field] = {"counts": flat, "gap": gap, "start": start, "end": end}
+        return result
+
+    def submit(self, core, params, timeout=None):
+        from concurrent.futures import Future
+        future = Future()
+        try:
+            future.set_result(self.query(core, params, timeout))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def fan_out(self, queries, timeout=None):
+        return [self.query(core, params, timeout) for core, params in queries]
+
+    def stats(self):
+        return {"calls": self.calls, "fake": True}
+
+
+def test():
+    must, should = parse_fq('*:* AND category:空调 AND brand:美的 OR price:[2000 TO 3000]', 'AND')
+    assert must == [('*', '*'), ('category', '空调')], must
+    assert should == [('brand', '美的'), ('price', '[2000 TO 3000]')], should
+    must, should = parse_fq('*:* AND category:空调 AND brand:美的 OR price:[2000 TO 3000]', 'OR')
+    assert must == [('*', '*'), ('category', '空调'), ('brand', '美的')], must
+    fake = FakeSolr()
+    fake.add('category', [{"category": "空调", "brand": "美的", "price": 2999.0, "facet_brand_str": "美的"},
+                          {"category": "空调", "brand": "格力", "price": 3999.0, "facet_brand_str": "格力"},
+                          {"category": "冰箱", "brand": "美的", "price": 1999.0, "facet_brand_str": "美的"}])
+    res = fake.query('category', {'q': '*:*', 'fq': '*:* AND category:空调', 'facet': True,
+                                  'facet.field': 'facet_brand_str', 'facet.mincount': 1, 'q.op': 'AND'})
+    assert res.get_facet_keys_as_list('facet_brand_str') == ['格力', '美的'], res.get_facet_keys_as_list('facet_brand_str')
+    res = fake.query('category', {'q': '*:*', 'fq': '*:*', 'sort': 'price desc', 'rows': 1})
+    assert res.docs[0]['price'] == 3999.0
+    res = fake.query('category', {'q': '*:*', 'facet': True, 'facet.range': 'price', 'facet.mincount': 1,
+                                  'facet.range.start': 1999.0, 'facet.range.end': 4009.0,
+                                  'facet.range.gap': 1000, 'fq': '*:*'})
+    print(res.get_facets_ranges())
+    print('solr gateway test passed')
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,287 @@
+"""
+Solr Indexer
+
+Loads docs into a core in batches instead of one update?commit=true per doc.
+The docs already in the core are read once and hashed; a doc of the input
+whose content hash is in the core is skipped, a changed one replaces the old
+version (delete by key and add in the same update request), so a rerun of an
+unchanged file sends nothing. Updates use commitWithin and are sent by a
+few workers, one hard commit is made at the end.
+
+Docs are keyed by key_field (uid for the qa cores); without one (the product
+catalog) the content hash itself is the key and prune removes the docs of the
+scope that are no longer in the input.
+
+    python utils/solr_indexer.py --core category --file ../data/raw/product_ac.txt
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parentdir)
+
+BATCH_SIZE = 500
+COMMIT_WITHIN = 10000  # ms
+WORKERS = 4
+# fields solr adds itself, never part of the content
+IGNORED = ('id', '_version_')
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _normal(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, (int, float)):
+        return repr(float(value))
+    return str(value)
+
+
+def content_hash(doc):
+    """
+    stable over key order, a single value vs a list of one and 2 vs 2.0,
+    as solr may return a stored field in either form
+    """
+    items = sorted((key, [_normal(v) for v in _as_list(value)]) for key, value in doc.items()
+                   if key not in IGNORED and not key.startswith('facet_'))
+    return hashlib.sha1(json.dumps(items, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _quote(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class SolrIndexer:
+
+    def __init__(self, gateway, core, key_field='uid', scope=None, batch_size=BATCH_SIZE,
+                 commit_within=COMMIT_WITHIN, workers=WORKERS, prune=False):
+        """
+        :param gateway: utils.solr_gateway.SolrGateway of the solr to update
+        :param scope: fq limiting the docs compared and pruned, e.g. class:base
+        :param prune: deletes the docs of the scope missing from the input
+        """
+        self.gateway = gateway
+        self.core = core
+        self.key_field = key_field
+        self.scope = scope
+        self.batch_size = batch_size
+        self.commit_within = commit_within
+        self.workers = workers
+        self.prune = prune
+        self.url = '{}/{}/update'.format(gateway.url, core)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = {"read": 0, "added": 0, "skipped": 0, "deleted": 0, "batches": 0, "failed": 0}
+        self.changed = set()  # keys added or deleted, for cache invalidation
+
+    def _key(self, doc, digest):
+        if self.key_field:
+            return str(doc.get(self.key_field))
+        return digest
+
+    def existing(self, rows=1000):
+        """
+        key -> {hash: [ids]} of the docs in the scope
+        """
+        index = dict()
+        start = 0
+        while True:
+            params = {'q': '*:*', 'rows': rows, 'start': start, 'sort': 'id asc'}
+            if self.scope:
+                params['fq'] = self.scope
+            docs = self.gateway.query(self.core, params).docs
+            for doc in docs:
+                digest = content_hash(doc)
+                index.setdefault(self._key(doc, digest), dict()).setdefault(digest, []).append(doc.get('id'))
+            if len(docs) < rows:
+                return index
+            start += rows
+
+    def _post(self, body):
+        response = self.gateway.session.post(self.url, data=body.encode('utf-8'),
+                                             params={'commitWithin': self.commit_within, 'wt': 'json'},
+                                             headers={'Content-Type': 'application/json'},
+                                             timeout=(self.gateway.connect_timeout, 60))
+        if response.status_code != 200:
+            raise requests.RequestException('solr {}: {}'.format(response.status_code, response.text[:200]))
+
+    def _send(self, adds, deletes):
+        """
+        one update request, the deletes run before the adds
+        """
+        commands = []
+        if deletes and self.key_field:
+            query = '{}:({})'.format(self.key_field, ' OR '.join(_quote(key) for key in deletes))
+            commands.append('"delete":' + json.dumps({"query": query}, ensure_ascii=False))
+        elif deletes:
+            commands.append('"delete":' + json.dumps(deletes, ensure_ascii=False))
+        for doc in adds:
+            commands.append('"add":' + json.dumps({"doc": doc}, ensure_ascii=False))
+        try:
+            self._post('{' + ','.join(commands) + '}')
+        except Exception as e:
+            print('batch of {} adds, {} deletes failed: {}'.format(len(adds), len(deletes), e))
+            with self.lock:
+                self.counts['failed'] += len(adds) + len(deletes)
+            return
+        with self.lock:
+            self.counts['added'] += len(adds)
+            self.counts['deleted'] += len(deletes)
+            self.counts['batches'] += 1
+
+    def commit(self):
+        response = self.gateway.session.post(self.url, params={'commit': 'true', 'wt': 'json'},
+                                             data=b'{"commit":{}}',
+                                             headers={'Content-Type': 'application/json'},
+                                             timeout=(self.gateway.connect_timeout, 120))
+        if response.status_code != 200:
+            raise requests.RequestException('commit failed, solr {}: {}'.format(response.status_code,
+                                                                                response.text[:200]))
+
+    def index(self, docs, report_every=5000):
+        """
+        :param docs: iterable of doc dicts, read once
+        :return: counts with seconds and docs_per_sec
+        """
+        self.reset()
+        start = time.time()
+        existing = self.existing()
+        seen = set()  # keys of the input, key_field mode
+        seen_ids = dict()  # hash -> ids of the core kept, content hash mode
+        adds = []
+        deletes = []
+        inflight = []
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+
+        def flush(drain=False):
+            if adds or deletes:
+                inflight.append(pool.submit(self._send, list(adds), list(deletes)))
+                del adds[:]
+                del deletes[:]
+            # bounded, the reader does not run ahead of the workers
+            while inflight and (drain or len(inflight) > self.workers * 2):
+                inflight.pop(0).result()
+
+        for doc in docs:
+            self.counts['read'] += 1
+            digest = content_hash(doc)
+            key = self._key(doc, digest)
+            versions = existing.get(key, dict())
+            if self.key_field:
+                if key in seen:
+                    # repeated in the input, the last one wins as with per doc
+                    # updates; the earlier add has to be in solr before its delete
+                    flush(drain=True)
+                    deletes.append(key)
+                elif list(versions) == [digest] and len(versions[digest]) == 1:
+                    seen.add(key)
+                    self.counts['skipped'] += 1
+                    continue
+                elif versions:
+                    deletes.append(key)
+                seen.add(key)
+            else:
+                # identical docs are kept as often as they are in the input
+                used = len(seen_ids.get(key, ()))
+                ids = versions.get(digest, [])
+                if used < len(ids):
+                    seen_ids.setdefault(key, []).append(ids[used])
+                    self.counts['skipped'] += 1
+                    continue
+            self.changed.add(key)
+            adds.append(doc)
+            if len(adds) + len(deletes) >= self.batch_size:
+                flush()
+            if report_every and self.counts['read'] % report_every == 0:
+                elapsed = time.time() - start
+                print('{} read, {} skipped, {:.0f} docs/sec'.format(self.counts['read'], self.counts['skipped'],
+                                                                     self.counts['read'] / max(elapsed, 1e-6)))
+        if self.prune:
+            for key, versions in existing.items():
+                if self.key_field:
+                    if key in seen:
+                        continue
+                    deletes.append(key)
+                else:
+                    kept = set(seen_ids.get(key, ()))
+                    stale = [i for ids in versions.values() for i in ids if i is not None and i not in kept]
+                    if not stale:
+                        continue
+                    deletes.extend(stale)
+                self.changed.add(key)
+                if len(deletes) >= self.batch_size:
+                    flush()
+        flush(drain=True)
+        pool.shutdown()
+        self.commit()
+        elapsed = time.time() - start
+        counts = dict(self.counts)
+        counts['seconds'] = elapsed
+        counts['docs_per_sec'] = counts['read'] / max(elapsed, 1e-6)
+        return counts
+
+
+def invalidate(core, uids=(), notify=None):
+    """
+    drops what the caches of this process, and of the web server at notify
+    (http://host:port), hold of a reindexed core
+    """
+    import utils.solr_util as solr_util
+    solr_util.invalidate_facets(core)
+    if not notify:
+        return
+    notify = notify.rstrip('/')
+    try:
+        requests.get(notify + '/e/invalidate_facet_cache', params={'core': core}, timeout=5)
+        uids = list(uids)
+        for i in range(0, len(uids), 200):
+            requests.post(notify + '/e/invalidate_qa_cache', params={'uid': ','.join(uids[i:i + 200])}, timeout=5)
+    except requests.RequestException as e:
+        print('cache invalidation at {} failed: {}'.format(notify, e))
+
+
+def json_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def main():
+    from utils.solr_gateway import SolrGateway
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:11403/solr')
+    parser.add_argument('--core', default='category')
+    parser.add_argument('--file', required=True, help='json lines, one doc per line')
+    parser.add_argument('--key', default='', help='key field, e.g. uid; the content hash when empty')
+    parser.add_argument('--scope', default=None, help='fq of the docs compared and pruned')
+    parser.add_argument('--prune', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--commit_within', type=int, default=COMMIT_WITHIN)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--notify', default=None, help='web server to invalidate caches on, http://host:port')
+    args = parser.parse_args()
+    indexer = SolrIndexer(SolrGateway(args.url), args.core, key_field=args.key or None, scope=args.scope,
+                          batch_size=args.batch_size, commit_within=args.commit_within,
+                          workers=args.workers, prune=args.prune)
+    counts = indexer.index(json_lines(args.file))
+    invalidate(args.core, indexer.changed if args.key else (), args.notify)
+    print(json.dumps(counts))
+
+
+if __name__ == '__main__':
+    main()
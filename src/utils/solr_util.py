@@ -18,12 +18,58 @@ sys.path.append(grandfatherdir)
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
-from SolrClient import SolrClient
+from utils.solr_gateway import SolrGateway
+from utils.ttl_cache import TTLCache
+from utils.single_flight import SingleFlight
 
 import sys
 
-solr = SolrClient('http://localhost:11403/solr')
-# solr = SolrClient('http://10.89.100.14:8999/solr')
+# every query of this module goes through solr, see set_solr for a FakeSolr
+solr = SolrGateway('http://localhost:11403/solr')
+# solr = SolrGateway('http://10.89.100.14:8999/solr')
+
+
+# solr_facet answers only depend on the filter and the facet spec,
+# they are shared by all users until the catalog core is reindexed
+FACET_CACHE_SIZE = 2048
+FACET_TTL = 600
+facet_cache = TTLCache(FACET_CACHE_SIZE, FACET_TTL)
+# misses of the same key at the same moment share one query
+facet_flight = SingleFlight()
+
+
+def set_solr(backend):
+    """
+    swaps the backend of all helpers, e.g. utils.solr_gateway.FakeSolr in tests
+    """
+    global solr
+    solr = backend
+    facet_cache.clear()
+
+
+def use_catalog(engine):
+    """
+    answers the catalog cores from a utils.catalog_engine.CatalogEngine, the
+    current backend stays behind it for everything else; None switches back
+    """
+    if engine is None:
+        if getattr(solr, 'fallback', None) is not None:
+            set_solr(solr.fallback)
+        return
+    if engine.fallback is None:
+        engine.fallback = solr
+    set_solr(engine)
+
+
+def invalidate_facets(core=None):
+    """
+    drops the cached facets of a core, of all cores when None; call after a reindex
+    """
+    if core is None:
+        count = len(facet_cache)
+        facet_cache.clear()
+        return count
+    return facet_cache.purge(lambda key, _: key[0] == core)
 
 def compose_fq(mapper, option_fields=['price']):
     option_mapper = dict()
@@ -62,7 +108,7 @@ def query(must_mappers, option_mapper={}, qop='OR'):
     return docs
 
 
-def solr_qa(core, query, solr=solr, field=None, cls=''):
+def _qa_params(query, field=None, cls=''):
     if not cls:
         if not field:
             params = {'q': query, 'q.op': 'or', 'rows':20}
@@ -73,33 +119,72 @@ def solr_qa(core, query, solr=solr, field=None, cls=''):
             params = {'q': query, 'q.op': 'or', 'rows':20, 'fq':"class:{}".format(cls)}
         else:
             params = {'q': "{}:{}".format(field, query), 'q.op': 'or', 'rows': 20, 'fq':"class:{}".format(cls)}
-    responses = solr.query(core, params)
+    return params
+
+def solr_qa(core, query, solr=None, field=None, cls=''):
+    solr = solr or globals()['solr']
+    responses = solr.query(core, _qa_params(query, field, cls))
     docs = responses.docs
     return docs
 
-def solr_max_value(params, target_field):
-    params['sort'] = target_field + ' desc'
+def solr_qa_async(core, query, field=None, cls=''):
+    """
+    future of the SolrResult of the solr_qa query, .result().docs are its
+    docs; to run several lookups speculatively
+    """
+    return solr.submit(core, _qa_params(query, field, cls))
+
+def _sorted_params(params, target_field, order):
+    params = dict(params)
+    params['sort'] = target_field + ' ' + order
     params['rows'] = 1
+    return params
 
-    res = solr.query('category', params)
+def _first_value(res, target_field):
     docs = res.docs
-    max_val = 0
+    value = 0
     if len(docs) > 0:
-        max_val = docs[0][target_field]
-    return max_val
+        value = docs[0][target_field]
+    return value
+
+def solr_max_value(params, target_field):
+    res = solr.query('category', _sorted_params(params, target_field, 'desc'))
+    return _first_value(res, target_field)
 
 def solr_min_value(params, target_field):
-    params['sort'] = target_field + ' asc'
-    params['rows'] = 1
+    res = solr.query('category', _sorted_params(params, target_field, 'asc'))
+    return _first_value(res, target_field)
 
-    res = solr.query('category', params)
-    docs = res.docs
-    min_val = 0
-    if len(docs) > 0:
-        min_val = docs[0][target_field]
-    return min_val
+def solr_min_max_value(params, target_field):
+    """
+    both in one concurrent round trip
+    """
+    min_res, max_res = solr.fan_out([('category', _sorted_params(params, target_field, 'asc')),
+                                     ('category', _sorted_params(params, target_field, 'desc'))])
+    return _first_value(min_res, target_field), _first_value(max_res, target_field)
+
+def solr_facet(mappers, facet_field, is_range, prefix='facet_', postfix='_str', core='category', qop="AND",
+               use_cache=True):
+    """
+    (facets, count, docs), served from facet_cache for a repeated filter;
+    the lists returned are copies, the docs themselves are shared
+    """
+    if not use_cache:
+        return _solr_facet(mappers, facet_field, is_range, prefix, postfix, core, qop)
+    key = (core, tuple(sorted((str(k), str(v)) for k, v in mappers.items())),
+           facet_field, bool(is_range), prefix, postfix, qop)
+    cached = facet_cache.get(key)
+    if cached is None:
+        cached = facet_flight.do(key, _cached_facet, key, mappers, facet_field, is_range, prefix, postfix, core, qop)
+    facets, count, docs = cached
+    return list(facets), count, list(docs)
+
+def _cached_facet(key, *args):
+    result = _solr_facet(*args)
+    facet_cache.set(key, result)
+    return result
 
-def solr_facet(mappers, facet_field, is_range, prefix='facet_', postfix='_str', core='category', qop="AND"):
+def _solr_facet(mappers, facet_field, is_range, prefix='facet_', postfix='_str', core='category', qop="AND"):
 
     def render_range(a, gap):
         if len(a) == 0:
@@ -156,8 +241,8 @@ def solr_facet(mappers, facet_field, is_range, prefix='facet_', postfix='_str',
             'fq': fq,
             'q.op': qop
         }
-        max_value = solr_max_value(minmax_params, facet_field)
-        min_value = solr_min_value(minmax_params, facet_field)
+        # the range facet needs both bounds, they are fetched together first
+        min_value, max_value = solr_min_max_value(minmax_params, facet_field)
         start = min_value
         gap = max((max_value - min_value) / 5 * 0.5, 0.5)
         end = max_value + 10
@@ -8,6 +8,7 @@ grandfatherdir = os.path.dirname(os.path.dirname(
     os.path.dirname(os.path.abspath(__file__))))
 from graph.belief_graph import Graph
 import utils.query_util as query_util
+from utils.multi_replace import MultiReplacer
 
 
 
@@ -46,22 +47,19 @@ def _pickle():
 class Translator():
     def __init__(self,path=os.path.join(grandfatherdir, "model/graph/translator_graph.pkl")):
         self.dic=self._load(path)
+        # same results as replacing entry by entry in dict order
+        self.en2cn_replacer = MultiReplacer(self.dic)
+        self.cn2en_replacer = MultiReplacer([(v, k) for k, v in self.dic.items()])
 
     def _load(self, path):
         with open(path,'rb') as f:
             return pickle.load(f)
 
     def en2cn(self, query):
-        _q = query
-        for k,v in self.dic.items():
-            query=query.replace(k,v)
-        # print('translated..{}->{}'.format(_q, query))
-        return query
+        return self.en2cn_replacer.replace(query)
 
     def cn2en(self, query):
-        for k,v in self.dic.items():
-            query=query.replace(v,k)
-        return query
+        return self.cn2en_replacer.replace(query)
 
 
 def test():
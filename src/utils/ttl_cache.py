@@ -0,0 +1,129 @@
+"""
+TTL Cache
+
+Thread safe LRU with a time to live per entry. Expired entries are dropped
+lazily when they are read or when they reach the old end of the LRU, so no
+timer thread is needed.
+"""
+import threading
+import time
+
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+
+    def __init__(self, max_size=1024, ttl=3600, on_remove=None):
+        """
+        :param max_size: entries kept, least recently used go first
+        :param ttl: default seconds an entry lives
+        :param on_remove: optional callable(key, value) for evicted, expired, popped and replaced entries
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_remove = on_remove
+        self.entries = OrderedDict()  # key -> (value, expires at)
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key, value):
+        if self.on_remove:
+            self.on_remove(key, value)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires < time.time():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                self._remove(key, value)
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            previous = self.entries.get(key)
+            self.entries[key] = (value, now + (self.ttl if ttl is None else ttl))
+            self.entries.move_to_end(key)
+            if previous is not None:
+                self._remove(key, previous[0])
+            self._shrink(now)
+
+    def _shrink(self, now):
+        while self.entries:
+            key, (value, expires) = next(iter(self.entries.items()))
+            if len(self.entries) > self.max_size:
+                self.evictions += 1
+            elif expires < now:
+                self.expirations += 1
+            else:
+                break
+            del self.entries[key]
+            self._remove(key, value)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            self._remove(key, entry[0])
+            return entry[0]
+
+    def purge(self, predicate):
+        """
+        drops every entry predicate(key, value) is true for, returns how many
+        """
+        with self.lock:
+            keys = [key for key, (value, _) in self.entries.items() if predicate(key, value)]
+            for key in keys:
+                self.pop(key)
+            return len(keys)
+
+    def resize(self, max_size=None, ttl=None):
+        with self.lock:
+            if max_size is not None:
+                self.max_size = max_size
+            if ttl is not None:
+                self.ttl = ttl
+            self._shrink(time.time())
+
+    def clear(self):
+        with self.lock:
+            entries = list(self.entries.items())
+            self.entries.clear()
+        for key, (value, _) in entries:
+            self._remove(key, value)
+
+    def keys(self):
+        now = time.time()
+        with self.lock:
+            return [key for key, (_, expires) in self.entries.items() if expires >= now]
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[1] >= time.time()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "max_size": self.max_size, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "expirations": self.expirations}
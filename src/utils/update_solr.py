@@ -1,18 +1,17 @@
 import os
 import sys
-import urllib.request
 import json
 import traceback
-import requests
 parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-from SolrClient import SolrClient
 sys.path.insert(0, parentdir)
 
-IP = "10.89.100.12"
-solr_client = SolrClient('http://{}:11403/solr'.format(IP))
+from utils.solr_gateway import SolrGateway
+from utils.solr_indexer import SolrIndexer, invalidate
 
-def update_solr(solr_file, cls='base'):
+IP = "10.89.100.12"
+solr = SolrGateway('http://{}:11403/solr'.format(IP))
 
+def faq_docs(solr_file, cls='base'):
     with open(solr_file, 'r', encoding='utf-8') as data_file:
         for line in data_file:
             try:
@@ -20,10 +19,7 @@ def update_solr(solr_file, cls='base'):
                 if not line:
                     continue
                 tokens = line.split('\t')
-                print(tokens)
                 uid = tokens[0]
-                r = solr_client.delete_doc_by_query('base', "uid:"+uid)
-                print(r)
                 representative_q = tokens[1]
                 answer = tokens[2].split('/')
                 question = tokens[3].split('/')
@@ -42,22 +38,23 @@ def update_solr(solr_file, cls='base'):
                 doc['media'] = media
                 doc['store_id'] = '吴江新华书店'
                 doc['class'] = cls
-                line = json.dumps(doc, ensure_ascii=False)
-                line = "[" + line + "]"
-                # line = str.encode(line)
-                print(line)
-                line = str.encode(line)
-                req = urllib.request.Request(url='http://{}:11403/solr/base/update?commit=true'.format(IP),
-                                      data=line)
-                headers = {"content-type": "text/json"}
-                req.add_header('Content-type', 'application/json')
-                f = urllib.request.urlopen(req)
-                # Begin using data like the following
-                print
-                f.read()
+                yield doc
             except:
                 traceback.print_exc()
 
+def update_solr(solr_file, cls='base', notify=None):
+    """
+    loads a faq file into the base core, docs of an unchanged uid are skipped,
+    a changed uid replaces its old doc
+    :param notify: web server whose qa and facet caches drop the changed uids, http://host:port
+    """
+    # compared with the whole core, a uid moved to another class still replaces its old doc
+    indexer = SolrIndexer(solr, 'base', key_field='uid')
+    counts = indexer.index(faq_docs(solr_file, cls))
+    invalidate('base', indexer.changed, notify)
+    print(counts)
+    return counts
+
 
 if __name__ == "__main__":
     # phone_product_gen("../../data/raw/product_phone.txt", '../../data/gen_product/shouji.txt')
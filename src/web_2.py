@@ -1,4 +1,3 @@
-from queue import Queue
 import argparse
 import traceback
 import urllib
@@ -8,8 +7,8 @@ from datetime import datetime
 
 from flask import Flask
 from flask import request
+from flask import Response
 import json
-from tqdm import tqdm
 # from lru import LRU
 
 # pickle
@@ -17,6 +16,8 @@ from graph.belief_graph import Graph
 from kernel_2.main_kernel import MainKernel
 from qa.base import BaseKernel
 from qa.iqa import Qa as QA
+import utils.solr_util as solr_util
+from utils.catalog_engine import CatalogEngine, QueryLog
 
 import sys
 import os
@@ -51,7 +52,8 @@ config = {"belief_graph": parentdir + "/model/graph/belief_graph.pkl",
                 "render_media_file":os.path.join(parentdir, 'model/render_2/render_media.txt'),
               "faq_ad": os.path.join(parentdir, 'model/ad_2/faq_ad_anchor.txt'),
               "location_ad": os.path.join(parentdir, 'model/ad_2/category_ad_anchor.txt'),
-              "clf": 'dmn',  # or memory
+              "clf": 'dmn',  # or memory, or remote to use kernel_2/infer_service.py
+              "infer_socket": '/tmp/memory_infer.sock',
               "shuffle":False,
               "key_word_file": os.path.join(parentdir, 'model/render_2/key_word.txt'),
               "emotion_file": os.path.join(parentdir, 'model/render_2/emotion.txt'),
@@ -59,20 +61,57 @@ config = {"belief_graph": parentdir + "/model/graph/belief_graph.pkl",
               "ad_anchor": os.path.join(parentdir, 'model/render_2/ad_anchor.txt'),
               "machine_profile": os.path.join(parentdir, 'model/render_2/machine_profile_replacement.txt'),
               "synonym": os.path.join(parentdir, 'model/render_2/synonym.txt'),
+              "max_users": 10000,
+              "user_ttl": 1800,
+              "batch_workers": 32,
+              "debug": False,  # hot path prints, MEMORY_DEBUG=1 also turns them on
+              "qa_cache_size": 5000,
+              "qa_cache_ttl": 24 * 3600,
+              "qa_cache_negative_ttl": 60,
+              "session_store": 'off',  # memory, sqlite or shm to share dialogs between workers
+              "session_store_path": '/dev/shm/memory_sessions',
+              # solr to snapshot the catalog cores at start, or a directory of <core>.jsonl;
+              # keep off until utils/catalog_engine.py --compare passes on the live cores
+              "catalog": 'off',
+              "solr_query_log": None,  # a file to record the solr queries in, the input of --compare
               }
 
-kernel = MainKernel(config)
-# https://pypi.python.org/pypi/lru-dict/
-lru_kernels = dict()
+if config['solr_query_log']:
+    solr_util.set_solr(QueryLog(solr_util.solr, config['solr_query_log']))
+if config['catalog'] == 'solr':
+    solr_util.use_catalog(CatalogEngine.snapshot(solr_util.solr))
+elif config['catalog'] != 'off':
+    solr_util.use_catalog(CatalogEngine.load(config['catalog']))
+
+QA.cache.configure(config['qa_cache_size'], config['qa_cache_ttl'], config['qa_cache_negative_ttl'])
 
-QSIZE = 1
-kernel_backups = Queue(1000)
+# one shared kernel, per user dialog states are created on demand inside
+kernel = MainKernel(config)
 
 
 @app.route('/e/info', methods=['GET', 'POST'])
 def info():
-    size = len(lru_kernels)
-    result = {"question": "request info", "result": {"answer": size}, "user": "solr"}
+    size = len(kernel.states)
+    result = {"question": "request info", "result": {"answer": size, "states": kernel.states.stats()}, "user": "solr"}
+    batcher = getattr(kernel.clf, 'batcher', None)
+    if batcher:
+        result['result']['batcher'] = batcher.stats()
+    cache = getattr(kernel.clf, 'cache', None)
+    if cache:
+        result['result']['embedding_cache'] = cache.stats()
+    result['result']['solr'] = solr_util.solr.stats()
+    result['result']['facet_cache'] = solr_util.facet_cache.stats()
+    result['result']['facet_flight'] = solr_util.facet_flight.stats()
+    result['result']['qa_flight'] = QA.flight.stats()
+    result['result']['base'] = base.stats()
+    result['result']['rules'] = kernel.rule_plugin.stats.snapshot()
+    return json.dumps(result, ensure_ascii=False)
+
+@app.route('/e/metrics', methods=['GET', 'POST'])
+def metrics():
+    result = kernel.metrics.snapshot()
+    if 'reset' in request.args:
+        kernel.metrics.reset()
     return json.dumps(result, ensure_ascii=False)
 
 @app.route('/e/faq', methods=['GET', 'POST'])
@@ -85,6 +124,49 @@ def clear_qa_cache():
     QA.cache.clear()
     return 'cache cleared'
 
+@app.route('/e/qa_cache', methods=['GET', 'POST'])
+def qa_cache():
+    result = {"question": "qa cache info", "result": QA.cache.stats(), "user": "solr"}
+    return json.dumps(result, ensure_ascii=False)
+
+@app.route('/e/invalidate_facet_cache', methods=['GET', 'POST'])
+def invalidate_facet_cache():
+    """
+    ?core=.. after the catalog core was reindexed, all cores without it
+    """
+    dropped = solr_util.invalidate_facets(request.args.get('core'))
+    return '{} facet cache entries dropped'.format(dropped)
+
+@app.route('/e/catalog', methods=['GET', 'POST'])
+def catalog():
+    """
+    ?enabled=0 sends the catalog queries back to solr, ?enabled=1 answers them locally again
+    """
+    engine = solr_util.solr
+    if not isinstance(engine, CatalogEngine):
+        return 'catalog engine is off'
+    if 'enabled' in request.args:
+        enabled = request.args['enabled'] not in ('0', 'false', 'off')
+        if enabled != engine.enabled:
+            engine.enabled = enabled
+            # the cached facets were computed by the other backend
+            solr_util.invalidate_facets()
+    return json.dumps(engine.stats(), ensure_ascii=False)
+
+@app.route('/e/invalidate_qa_cache', methods=['GET', 'POST'])
+def invalidate_qa_cache():
+    """
+    ?uid=.. drops the answers of updated docs, ?core=..[&cls=..] a whole namespace
+    """
+    args = request.args
+    if 'uid' in args:
+        dropped = sum(QA.cache.invalidate_uid(uid) for uid in args['uid'].split(','))
+    elif 'core' in args:
+        dropped = QA.cache.invalidate(core=args['core'], cls=args.get('cls'))
+    else:
+        return 'expect uid or core'
+    return '{} cache entries dropped'.format(dropped)
+
 @app.route('/e/set_sim', methods=['GET', 'POST'])
 def set_sim():
     try:
@@ -121,33 +203,18 @@ def render_plugin_reload():
 
 @app.route('/e/chat', methods=['GET', 'POST'])
 def chat():
+    u = 'solr'
     try:
         # q_time=time.time()
         args = request.args
         q = args['q']
         q = urllib.parse.unquote(q)
-        u = 'solr'
         if 'u' in args:
             u = args['u']
-            if u not in lru_kernels:
-                if kernel_backups.qsize() > 0:
-                    ek = kernel_backups.get_nowait()
-                    lru_kernels[u] = ek
-                else:
-                    result = {"question": q,"sentence": q,
-                              "result": {"sentence": q,"answer": "maximum user reached hence rejecting request"}, "user": u}
-                    return json.dumps(result, ensure_ascii=False)
-            u_i_kernel = lru_kernels[u]
-            result = u_i_kernel.kernel(q=q, user=u)
-            # a_time=time.time()
-            output = {"question": q, "sentence": q,"result": result, "user": u, "version":_VERSION_}
-            return json.dumps(output, ensure_ascii=False)
-
-        else:
-            result= kernel.kernel(q=q)
-            # a_time = time.time()
-            output = {"question": q, "sentence": q, "result": result, "user": 'solr', "version": _VERSION_}
-            return json.dumps(output, ensure_ascii=False)
+        result = kernel.kernel(q=q, user=u)
+        # a_time=time.time()
+        output = {"question": q, "sentence": q, "result": result, "user": u, "version": _VERSION_}
+        return json.dumps(output, ensure_ascii=False)
     except Exception:
         logging.error("C@user:{}##error_details:{}".format(u, traceback.format_exc()))
         traceback.print_exc()
@@ -155,19 +222,43 @@ def chat():
         result = {"question": q, "result": {"answer": answer, 'media':'null'}, "user": "solr"}
         return json.dumps(result, ensure_ascii=False)
 
+@app.route('/e/chat_batch', methods=['POST'])
+def chat_batch():
+    """
+    body: json list of [u, q] pairs or {"u": .., "q": ..} objects, in dialog order
+    response: one json line per turn as soon as it is answered,
+              "index" is the position of the turn in the request
+    """
+    try:
+        items = json.loads(request.get_data(as_text=True))
+        pairs = [(item['u'], item['q']) if isinstance(item, dict) else (item[0], item[1])
+                 for item in items]
+    except Exception:
+        return Response(json.dumps({"error": "expect a json list of [u, q] pairs"}),
+                        status=400, mimetype='application/json')
+
+    def generate():
+        for index, u, q, result in kernel.kernel_batch(pairs):
+            if isinstance(result, dict) and 'error' in result:
+                result = {"answer": base.kernel(q), 'media': 'null'}
+            output = {"index": index, "question": q, "sentence": q, "result": result,
+                      "user": u, "version": _VERSION_}
+            yield json.dumps(output, ensure_ascii=False) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
 if __name__ == "__main__":
     # SK = SceneKernel()
     # print(SK.kernel('你叫什么名字'))
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--qsize', choices={'1', '20', '200'},
-                        default='200', help='q_size initializes number of the starting instances...')
+    parser.add_argument('--max_users', type=int,
+                        default=config['max_users'], help='maximum number of dialog states kept in memory')
+    parser.add_argument('--user_ttl', type=int,
+                        default=config['user_ttl'], help='seconds an idle dialog state is kept')
     args = parser.parse_args()
 
-    QSIZE = int(args.qsize)
-
-    for i in tqdm(range(QSIZE)):
-        k = MainKernel(config)
-        kernel_backups.put_nowait(k)
+    kernel.states.max_size = args.max_users
+    kernel.states.ttl = args.user_ttl
     print('web started...')
     app.run(host='0.0.0.0', port=21304, threaded=True)
\ No newline at end of file